@@ -0,0 +1,57 @@
+'''
+Cold-start cost of importing each pyHelper module. Every sample is a fresh interpreter, so nothing is
+shared with the previous import. Also lists which of the heavy dependencies the import pulled in
+(all of them should stay unloaded until a helper is actually used).
+
+    python benchmarks/bench_import_time.py [--number 5] [--module pyHelper.awsUtils.s3 ...]
+'''
+from __future__ import print_function
+import os, sys, json, argparse, subprocess
+
+ROOT    = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODULES = ['pyHelper',
+           'pyHelper.awsUtils.clients',
+           'pyHelper.awsUtils.s3',
+           'pyHelper.awsUtils.sts',
+           'pyHelper.awsUtils.ssm',
+           'pyHelper.awsUtils.athena',
+           'pyHelper.awsUtils.redshift',
+           'pyHelper.pySparkUtils.SparkUtils',
+           'pyHelper.pyUtils']
+HEAVY   = ['boto3', 'botocore', 's3fs', 'pyarrow', 'numpy', 'pandas', 'requests', 'bs4', 'lxml',
+           'psycopg2', 'pyspark', 'cryptography']
+
+PROBE = '''
+import sys, time, json
+t = time.perf_counter()
+import %s
+secs = time.perf_counter() - t
+print(json.dumps({'secs': secs, 'heavy': [m for m in %r if m in sys.modules]}))
+'''
+
+def sample(module: str) -> dict:
+    ''' Import `module` in a new interpreter; None if it can't be imported here '''
+    out = subprocess.run([sys.executable, '-c', PROBE % (module, HEAVY)],
+                         cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if out.returncode != 0:
+        return {'error': out.stderr.strip().splitlines()[-1]}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--number', type=int, default=5)
+    ap.add_argument('--module', nargs='*', default=MODULES)
+    args = ap.parse_args()
+
+    print("%-34s %10s   %s" % ('module', 'ms (min)', 'heavy deps loaded'))
+    for module in args.module:
+        runs = [sample(module) for _ in range(args.number)]
+        errs = [r['error'] for r in runs if 'error' in r]
+        if errs:
+            print("%-34s %10s   %s" % (module, 'n/a', errs[0]))
+            continue
+        secs = min(r['secs'] for r in runs)
+        print("%-34s %10.1f   %s" % (module, secs * 1000, ', '.join(runs[0]['heavy']) or '-'))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+'''
+Micro-benchmark of the SAML/ADFS page parsing done by pyHelper.awsUtils.sts during a login.
+Compares the BeautifulSoup+lxml / full XML tree path with the streaming (fastParse) path on the
+fixture pages (synthetic pages shaped like the AD FS login form and SAMLResponse auto-post page).
+
+    python benchmarks/bench_saml_parse.py [--number 200] [--role Prod-BigDataETL]
+'''
+from __future__ import print_function
+import os, sys, timeit, base64, argparse
+from xml.etree import ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pyHelper.awsUtils import sts
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def readFixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+def treePrincipalArn(assertion: str, roleArn: str) -> str:
+    ''' The pre-fastParse lookup: build the whole tree and walk every Role value '''
+    principalArn = ''
+    root = ET.fromstring(base64.b64decode(assertion))
+    for attr in root.iter(sts.SAML_ATTRIBUTE):
+        if attr.get('Name') == sts.SAML_ROLE_ATTRIBUTE:
+            for val in attr.iter(sts.SAML_ATTRIBUTE_VALUE):
+                if roleArn in val.text:
+                    chunks = val.text.split(',')
+                    principalArn = chunks[0] if 'saml-provider' in chunks[0] else chunks[1]
+    return principalArn
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--number', type=int, default=200)
+    ap.add_argument('--role',   default='Prod-BigDataETL')
+    args = ap.parse_args()
+
+    login     = readFixture('adfs_login_form.html')
+    post      = readFixture('adfs_saml_post.html')
+    assertion = dict(sts.extractFormTags(post, 'SAMLResponse')[0])['SAMLResponse']
+
+    assert sts.extractFormTags(login, fastParse=True) == sts.extractFormTags(login, fastParse=False)
+    assert sts.findPrincipalArn(assertion, args.role)[0] == treePrincipalArn(assertion, args.role)
+
+    cases = [
+        ('login form  : bs4+lxml ', lambda : sts.extractFormTags(login, fastParse=False)),
+        ('login form  : streaming', lambda : sts.extractFormTags(login, fastParse=True)),
+        ('SAML post   : bs4+lxml ', lambda : sts.extractFormTags(post, 'SAMLResponse', fastParse=False)),
+        ('SAML post   : streaming', lambda : sts.extractFormTags(post, 'SAMLResponse', fastParse=True)),
+        ('principalArn: full tree', lambda : treePrincipalArn(assertion, args.role)),
+        ('principalArn: pull/stop', lambda : sts.findPrincipalArn(assertion, args.role)),
+    ]
+    print("%-26s %12s" % ('case', 'ms/call'))
+    for name, fn in cases:
+        secs = min(timeit.repeat(fn, number=args.number, repeat=3)) / args.number
+        print("%-26s %12.3f" % (name, secs * 1000))
+
+if __name__ == "__main__":
+    main()
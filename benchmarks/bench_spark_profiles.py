@@ -0,0 +1,92 @@
+'''
+Runs a reference local-mode workload under each SparkUtils tuning profile (SPARK_PROFILES) and reports the
+time of each phase. Static Spark settings can't change once a session runs, so every profile runs in its
+own interpreter.
+
+    python benchmarks/bench_spark_profiles.py [--rows 2000000] [--profile default wide-shuffle ...]
+                                              [--master local[4]] [--sparkConf k=v,k=v]
+
+Phases: wide aggregation (shuffle), star join on a small dimension (broadcast), skewed join,
+parquet write + read back through the HDFS persist (local temp folder).
+'''
+from __future__ import print_function
+import os, sys, json, time, shutil, logging, argparse, tempfile, subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+def workload(profile: str, rows: int, master: str, sparkConf: str) -> dict:
+    from pyHelper.pySparkUtils.SparkUtils import SparkUtils
+    from pyspark.sql import functions as F
+
+    tmp   = tempfile.mkdtemp(prefix='pyhelper-bench-')
+    parms = {'--runEnv': 'local', '--master': master, '--sparkProfile': profile, '--logLevel': 'WARN',
+             '--tempHDFS': 'file://%s' % tmp}
+    if sparkConf:
+        parms['--sparkConf'] = sparkConf
+    log = logging.getLogger('bench')
+    res = {}
+
+    started = time.time()
+    su      = SparkUtils(log=log, parms=parms, appName='bench-%s' % profile)
+    spark   = su.sqlC.sparkSession
+    res['startup'] = time.time() - started
+
+    spark.range(rows).select(F.col('id'),
+                             (F.col('id') % 100000).alias('k'),
+                             (F.col('id') % 50).alias('d'),
+                             F.when(F.col('id') % 10 < 7, F.lit(0)).otherwise(F.col('id') % 1000).alias('s'),
+                             F.rand(7).alias('v')).createOrReplaceTempView('fact')
+    spark.range(50).select(F.col('id').alias('d'), F.concat(F.lit('dim-'), F.col('id')).alias('name')) \
+         .createOrReplaceTempView('dim')
+    spark.range(1000).select(F.col('id').alias('s'), F.rand(9).alias('w')).createOrReplaceTempView('skewed')
+
+    phases = [
+        ('wideAgg'  , "select k, count(*) c, sum(v) v from fact group by k"),
+        ('starJoin' , "select f.*, d.name from fact f join dim d on f.d = d.d"),
+        ('skewJoin' , "select f.id, f.v * s.w x from fact f join skewed s on f.s = s.s"),
+    ]
+    for name, sql in phases:
+        t = time.time()
+        spark.sql(sql).write.format('noop').mode('overwrite').save()
+        res[name] = time.time() - t
+
+    t  = time.time()
+    df = su.sql('persisted', "select id, k, d, v from fact distribute by d", persistType='HDFS')
+    df.agg(F.sum('v')).collect()
+    res['persistHDFS'] = time.time() - t
+
+    spark.stop()
+    shutil.rmtree(tmp, ignore_errors=True)
+    return res
+
+def main():
+    from pyHelper.pySparkUtils.SparkUtils import SPARK_PROFILES
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--rows',      type=int, default=2000000)
+    ap.add_argument('--profile',   nargs='*', default=[p for p in SPARK_PROFILES if p != 's3-magic-committer'])
+    ap.add_argument('--master',    default='local[4]')
+    ap.add_argument('--sparkConf', default=None)
+    ap.add_argument('--worker',    default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(workload(args.worker, args.rows, args.master, args.sparkConf)))
+        return
+
+    cols = ['startup', 'wideAgg', 'starJoin', 'skewJoin', 'persistHDFS']
+    print(("%-20s" + " %12s" * len(cols)) % tuple(['profile'] + cols))
+    for profile in args.profile:
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker', profile,
+               '--rows', str(args.rows), '--master', args.master]
+        if args.sparkConf:
+            cmd += ['--sparkConf', args.sparkConf]
+        out = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if out.returncode != 0:
+            print("%-20s failed: %s" % (profile, (out.stderr.strip().splitlines() or ['?'])[-1]))
+            continue
+        res = json.loads(out.stdout.strip().splitlines()[-1])
+        print(("%-20s" + " %12.2f" * len(cols)) % tuple([profile] + [res[c] for c in cols]))
+
+if __name__ == "__main__":
+    main()
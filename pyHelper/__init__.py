@@ -1,9 +1,28 @@
-#from .awsUtils.s3             import S3       as AwsS3
-#from .awsUtils.sts            import STS      as AwsSTS
-#from .awsUtils.ssm            import SSM      as AwsSSM
-#from .awsUtils.athena         import Athena   as AwsAthena
-#from .awsUtils.redshift       import Redshift as AwsRedshift
-#from .pySparkUtils.SparkUtils import SparkUtils
+import importlib
+
+#Helpers exposed on the package, imported on first access (PEP 562) so `import pyHelper` stays cheap
+#and e.g. a Lambda using only AwsSSM never loads pyarrow/pyspark.
+_LAZY_ATTRS = {
+    'AwsS3'      : ('.awsUtils.s3',             'S3'),
+    'AwsSTS'     : ('.awsUtils.sts',            'STS'),
+    'AwsSSM'     : ('.awsUtils.ssm',            'SSM'),
+    'AwsAthena'  : ('.awsUtils.athena',         'Athena'),
+    'AwsRedshift': ('.awsUtils.redshift',       'Redshift'),
+    'SparkUtils' : ('.pySparkUtils.SparkUtils', 'SparkUtils'),
+    'PyUtils'    : ('.pyUtils',                 'PyUtils'),
+}
 
 name        = 'pyUtils'
 __version__ = '0.1'
+__all__     = list(_LAZY_ATTRS)
+
+def __getattr__(attr: str):
+    if attr not in _LAZY_ATTRS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, attr))
+    module, cls = _LAZY_ATTRS[attr]
+    value = getattr(importlib.import_module(module, __name__), cls)
+    globals()[attr] = value         #Later look ups don't come back here
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
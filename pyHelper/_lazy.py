@@ -0,0 +1,48 @@
+'''
+Deferred imports of the heavy dependencies (boto3/botocore, pyarrow, numpy, s3fs, requests, bs4, psycopg2,
+pyspark, ...) so importing a pyHelper module only costs what is used.
+
+    pa = lazyImport('pyarrow')          #Nothing is imported yet
+    pa.table({'a': [1]})                #pyarrow is imported here, once
+
+Classes needed in `except` clauses / `isinstance` must be reached through the proxy at the time of use
+(`except botoExc.ClientError`), never bound at module load. Annotations are kept unevaluated with
+`from __future__ import annotations` in the modules using the proxies.
+'''
+import importlib, threading
+
+_LOCK = threading.RLock()
+
+class LazyModule:
+    ''' Stand-in for a module, imported on the first attribute access '''
+    def __init__(self, name: str):
+        self.__dict__['_LazyModule__name']   = name
+        self.__dict__['_LazyModule__module'] = None
+
+    def load(self):
+        ''' Import (once) and return the real module '''
+        module = self.__module
+        if module is None:
+            with _LOCK:
+                module = self.__module
+                if module is None:
+                    module = importlib.import_module(self.__name)
+                    self.__dict__['_LazyModule__module'] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr: str, value):
+        setattr(self.load(), attr, value)
+
+    def __dir__(self):
+        return dir(self.load())
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self.__module is not None else 'not loaded'
+        return "<lazy module '%s' (%s)>" % (self.__name, state)
+
+def lazyImport(name: str) -> LazyModule:
+    ''' `import name` deferred to the first use '''
+    return LazyModule(name)
@@ -1,2 +1,2 @@
 name = "awsUtils"
-__all__ = ["athena", "sts", "redshift", "s3"]
+__all__ = ["athena", "sts", "redshift", "s3", "ssm", "clients"]
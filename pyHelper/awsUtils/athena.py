@@ -1,20 +1,373 @@
-from __future__ import print_function # Python 2/3 compatibility
-import time,uuid
+from __future__ import print_function, annotations # Python 2/3 compatibility
+import time,uuid,io,os,re,json,hashlib,threading
+from collections import OrderedDict
+from .clients import REGISTRY
+from .._lazy  import lazyImport
+pa       = lazyImport('pyarrow')
+pc       = lazyImport('pyarrow.compute')
+pcsv     = lazyImport('pyarrow.csv')
+pq       = lazyImport('pyarrow.parquet')
+transfer = lazyImport('boto3.s3.transfer')
 #from  sts import STS  --> uncomment this line if you are running with main()
 
+#Athena (presto/trino) column types which can be cast from their text form by arrow (as arrow type aliases).
+#Everything not listed here (varchar, char, json, array, map, row, varbinary, time, ...) is kept as string.
+ATHENA_ARROW_TYPES = {
+    'boolean'  : 'bool',
+    'tinyint'  : 'int8',
+    'smallint' : 'int16',
+    'integer'  : 'int32',
+    'int'      : 'int32',
+    'bigint'   : 'int64',
+    'float'    : 'float32',
+    'real'     : 'float32',
+    'double'   : 'float64',
+    'date'     : 'date32',
+    'timestamp': 'timestamp[us]',     #Parses timestamp(3) and timestamp(6) text; finer precisions get ns
+}
+
+TERMINAL_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+
+#Leading keywords of the statements whose result may be served from the result cache / stored in it
+READ_ONLY_STATEMENTS = ('SELECT', 'WITH', 'SHOW', 'DESCRIBE')
+CACHEABLE_STATEMENTS = ('SELECT', 'WITH')
+
+class AthenaQuery:
+    ''' Handle of a query submitted with `Athena.submit` '''
+    def __init__(self, queryId: str, sql: str, wait, results):
+        self.queryId    = queryId
+        self.sql        = sql
+        self.execution  = None     #Latest QueryExecution seen for the query
+        self.__wait     = wait
+        self.__results  = results
+        self.__fetched  = False
+        self.__value    = None
+
+    def state(self) -> str:
+        return self.execution['Status']['State'] if self.execution else 'QUEUED'
+
+    def done(self) -> bool:
+        ''' True once the query reached a terminal state (as of the last poll) '''
+        return self.state() in TERMINAL_STATES
+
+    def result(self):
+        ''' Wait for the query (if needed) and return its results. Raises if the query failed. '''
+        if not self.__fetched:
+            self.execution = self.__wait(self.execution)
+            self.__value   = self.__results(self.execution)
+            self.__fetched = True
+        return self.__value
+
+class AthenaResultCache:
+    '''
+    Cache of the query results keyed by the normalized SQL text (+ the settings affecting the result).
+    Entries live in an in-memory LRU and, if diskDir is set, on local disk (parquet for the typed
+    results, json for the tuples) so they survive across runs. Both expire after `ttl` seconds and the
+    disk files are evicted least recently read first once they exceed `maxDiskBytes`.
+    One instance can be shared by several Athena objects.
+    '''
+    def __init__(self, maxEntries: int = 128, ttl: float = 300, diskDir: str = None,
+                       maxDiskBytes: int = 1024 ** 3):
+        self.maxEntries   = maxEntries
+        self.ttl          = ttl
+        self.diskDir      = diskDir
+        self.maxDiskBytes = maxDiskBytes
+        self.__entries    = OrderedDict()    #key -> (expiresAt, value)
+        self.__lock       = threading.Lock()
+        self.__stats      = {'hits': 0, 'diskHits': 0, 'misses': 0, 'evictions': 0, 'diskEvictions': 0}
+        if diskDir:
+            os.makedirs(diskDir, exist_ok=True)
+
+    @staticmethod
+    def normalizeSQL(sql_str: str) -> str:
+        ''' Drop the comments, collapse the whitespace and trailing ';' outside of the quoted literals '''
+        parts = re.findall(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|\s+|[^'\"\s/-]+|.",
+                           sql_str, re.S)
+        out = []
+        for part in parts:
+            if part.startswith('--') or part.startswith('/*'):
+                part = ' '
+            if part.isspace():
+                if out and out[-1] != ' ':
+                    out.append(' ')
+            else:
+                out.append(part)
+        return ''.join(out).strip().rstrip(';').strip()
+
+    @staticmethod
+    def leadingKeyword(sql_str: str) -> str:
+        ''' First keyword of the statement (upper case), ignoring the comments and opening parentheses '''
+        m = re.match(r"[\s(]*([A-Za-z]+)", AthenaResultCache.normalizeSQL(sql_str))
+        return m.group(1).upper() if m else ''
+
+    @staticmethod
+    def isReadOnly(sql_str: str) -> bool:
+        return AthenaResultCache.leadingKeyword(sql_str) in READ_ONLY_STATEMENTS
+
+    def key(self, sql_str: str, *settings) -> str:
+        return hashlib.sha256(json.dumps([AthenaResultCache.normalizeSQL(sql_str)] + list(settings),
+                                         default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        ''' Return the cached value or None '''
+        now = time.time()
+        with self.__lock:
+            hit = self.__entries.get(key)
+            if hit and hit[0] > now:
+                self.__entries.move_to_end(key)
+                self.__stats['hits'] += 1
+            elif hit:
+                del self.__entries[key]
+                hit = None
+        if hit:
+            self.__touchDisk(key, now)
+            return hit[1]
+
+        value = self.__readDisk(key, now)
+        with self.__lock:
+            if value is None:
+                self.__stats['misses'] += 1
+            else:
+                self.__stats['diskHits'] += 1
+        if value is not None:
+            self.__putMemory(key, value, now)
+        return value
+
+    def put(self, key: str, value):
+        now = time.time()
+        self.__putMemory(key, value, now)
+        if self.diskDir:
+            self.__writeDisk(key, value)
+
+    def __putMemory(self, key: str, value, now: float):
+        with self.__lock:
+            self.__entries[key] = (now + self.ttl, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxEntries:
+                self.__entries.popitem(last=False)
+                self.__stats['evictions'] += 1
+
+    def __readDisk(self, key: str, now: float):
+        if not self.diskDir:
+            return None
+        for ext in ('parquet', 'json'):
+            path = os.path.join(self.diskDir, "%s.%s" % (key, ext))
+            if not os.path.exists(path):
+                continue
+            if os.path.getmtime(path) + self.ttl <= now:
+                os.remove(path)
+                return None
+            self.__touchDisk(key, now)
+            if ext == 'parquet':
+                return pq.read_table(path)
+            with open(path) as f:
+                return [tuple(row) for row in json.load(f)]
+        return None
+
+    def __touchDisk(self, key: str, now: float):
+        ''' Mark the disk entry as read: atime = last read (LRU order), mtime = written (ttl) '''
+        if not self.diskDir:
+            return
+        for ext in ('parquet', 'json'):
+            path = os.path.join(self.diskDir, "%s.%s" % (key, ext))
+            try:
+                os.utime(path, (now, os.path.getmtime(path)))
+                return
+            except FileNotFoundError:
+                continue
+
+    def __writeDisk(self, key: str, value):
+        ''' Write to a temp file and rename it, so a concurrent reader never sees a partial entry '''
+        isTable = isinstance(value, pa.Table)
+        path    = os.path.join(self.diskDir, "%s.%s" % (key, 'parquet' if isTable else 'json'))
+        tmp     = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+        if isTable:
+            pq.write_table(value, tmp)
+        else:
+            with open(tmp, 'w') as f:
+                json.dump(value, f)
+        os.replace(tmp, path)
+        self.__evictDisk()
+
+    def __evictDisk(self):
+        ''' Drop the expired files, then the least recently read ones until the directory fits maxDiskBytes '''
+        now   = time.time()
+        files = []
+        for name in os.listdir(self.diskDir):
+            if not (name.endswith('.parquet') or name.endswith('.json')):
+                continue
+            path = os.path.join(self.diskDir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:       #Evicted by another process
+                continue
+            files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, stat.st_mtime, path))
+        total = sum(f[1] for f in files)
+        for lastUsed, size, written, path in sorted(files):
+            if written + self.ttl > now and (self.maxDiskBytes is None or total <= self.maxDiskBytes):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self.__lock:
+                self.__stats['diskEvictions'] += 1
+
+    def stats(self) -> dict:
+        ''' Hit/miss counters plus the number of entries in memory '''
+        with self.__lock:
+            return dict(self.__stats, entries=len(self.__entries))
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
 class Athena:
-    def __init__(self, botoSession, tempS3: str, sse : dict ):
-        self.__athena = botoSession.client('athena')
+    def __init__(self, botoSession, tempS3: str, sse : dict,
+                       pollInitial : float             = 0.05,
+                       pollMax     : float             = 5.0,
+                       workGroup   : str               = None,
+                       cache       : AthenaResultCache = None,
+                       reuseMaxAge : int               = None):
+        '''
+        parms:
+            workGroup  : Athena workgroup to run the queries in (default: the account's primary)
+            cache      : Opt-in AthenaResultCache for the results of repeated queries
+            reuseMaxAge: Minutes for which Athena may serve a query from its own result reuse (engine v3)
+        '''
+        self.__athena = REGISTRY.client(botoSession, 'athena')
+        self.__s3     = REGISTRY.client(botoSession, 's3')
         self.__tempS3 = tempS3
+        self.__pollInitial = pollInitial   #Seconds before the first re-check of a running query
+        self.__pollMax     = pollMax       #Cap of the exponential poll backoff
+        self.__workGroup   = workGroup
+        self.__cache       = cache
+        self.__reuseMaxAge = reuseMaxAge
         self.__sseTyp = 'SSE_S3'
+        self.__KmsKey = None
         if sse :
             self.__sseTyp = sse['type']
 
         if self.__sseTyp != 'SSE_S3' :
             self.__KmsKey = sse['KmsKey']
 
-    def query(self,sql_str: str, retainHeader: bool = True) -> [(tuple)] :
+    def cacheStats(self) -> dict:
+        ''' Hit/miss counters of the result cache (empty if no cache is configured) '''
+        return self.__cache.stats() if self.__cache else {}
+
+    def query(self,sql_str: str, retainHeader: bool = True, resultFormat: str = 'tuples',
+                   fetch         : str  = 'api',
+                   s3MinBytes    : int  = 1024 * 1024,
+                   s3Concurrency : int  = 10,
+                   cleanup       : bool = False,
+                   useCache      : bool = True):
+        '''
+        Run the query and return the results.
+        parms:
+            sql_str      : Query to run
+            retainHeader : Keep the column names as the first tuple ('tuples' only)
+            resultFormat : 'tuples' -> list of tuples of strings (None for NULL)
+                           'arrow'  -> pyarrow.Table with the columns typed as per the result metadata
+                           'pandas' -> pandas DataFrame built from the typed arrow table
+            fetch        : 'api' -> page the results through get_query_results (1000 rows per call)
+                           's3'  -> read the result CSV Athena wrote to tempS3 ('arrow'/'pandas' only).
+                                    Falls back to 'api' for results smaller than s3MinBytes or non CSV output (DDL).
+            s3Concurrency: Number of parallel ranged GETs used to download the result CSV
+            cleanup      : Delete the result file (and its .metadata) from tempS3 once read
+            useCache     : Serve/store the result from/to the result cache (if one is configured). Only read-only
+                           statements (SELECT/WITH/SHOW/DESCRIBE) are looked up and only SELECT results stored.
+        '''
+        return self.submit(sql_str, retainHeader, resultFormat, fetch, s3MinBytes, s3Concurrency, cleanup,
+                           useCache).result()
+
+    def submit(self,sql_str: str, retainHeader: bool = True, resultFormat: str = 'tuples',
+                    fetch         : str  = 'api',
+                    s3MinBytes    : int  = 1024 * 1024,
+                    s3Concurrency : int  = 10,
+                    cleanup       : bool = False,
+                    useCache      : bool = True) -> AthenaQuery:
+        '''
+        Start the query without waiting for it. Takes the same parms as `query`.
+        Returns an AthenaQuery handle; `handle.result()` waits and returns what `query` would.
+        Use `wait_all` to wait for many handles with batched status polls.
+        '''
+        if resultFormat not in ('tuples', 'arrow', 'pandas'):
+            raise ValueError("Invalid resultFormat '%s'. Supported: tuples, arrow, pandas" % (resultFormat))
+        if fetch not in ('api', 's3'):
+            raise ValueError("Invalid fetch '%s'. Supported: api, s3" % (fetch))
+        if fetch == 's3' and resultFormat == 'tuples':
+            raise ValueError("fetch='s3' needs resultFormat 'arrow' or 'pandas'")
+
+        cacheKey = None
+        if self.__cache and useCache and AthenaResultCache.isReadOnly(sql_str):
+            cacheKey = self.__cache.key(sql_str, self.__workGroup, self.__sseTyp, self.__KmsKey,
+                                        ('tuples', retainHeader) if resultFormat == 'tuples' else 'typed')
+            hit = self.__cache.get(cacheKey)
+            if hit is not None:
+                handle = AthenaQuery(None, sql_str,
+                                     wait    = lambda execution : execution,
+                                     results = lambda execution : Athena.__asFormat(hit, resultFormat))
+                handle.execution = {'Status': {'State': 'SUCCEEDED'}, 'CacheHit': True}
+                return handle
+
+        query_id = self.__startQuery(sql_str)
+
+        def results(execution):
+            if resultFormat == 'tuples':
+                res = self.__fetchTuples(query_id, retainHeader)
+            else:
+                res = self.__fetchTableFromS3(execution, s3MinBytes, s3Concurrency) if fetch == 's3' else None
+                if res is None:
+                    res = self.__fetchTable(query_id, execution.get('StatementType') == 'DML')
 
+            if cleanup:
+                self.__cleanupResult(execution)
+            if cacheKey and execution.get('StatementType') == 'DML' \
+                        and AthenaResultCache.leadingKeyword(sql_str) in CACHEABLE_STATEMENTS:
+                self.__cache.put(cacheKey, res)
+            return Athena.__asFormat(res, resultFormat)
+
+        return AthenaQuery(query_id, sql_str,
+                           wait    = lambda execution : self.__waitForQuery(query_id, sql_str, execution),
+                           results = results)
+
+    @staticmethod
+    def __asFormat(res, resultFormat: str):
+        ''' Fresh copy of a (cacheable) result in the requested format '''
+        if resultFormat == 'tuples':
+            return list(res)
+        return res if resultFormat == 'arrow' else res.to_pandas()
+
+    def wait_all(self, handles: list, timeout: float = None) -> list:
+        '''
+        Wait for all the submitted queries, polling their status with `batch_get_query_execution`
+        (50 ids per call) and the same adaptive backoff as `query`. Failed queries raise on `result()`.
+        '''
+        start   = time.time()
+        delay   = self.__pollInitial
+        pending = {h.queryId : h for h in handles if not h.done()}
+        while pending:
+            ids = list(pending)
+            for i in range(0, len(ids), 50):
+                for execution in self.__athena.batch_get_query_execution(
+                                    QueryExecutionIds = ids[i:i + 50])['QueryExecutions']:
+                    handle           = pending[execution['QueryExecutionId']]
+                    handle.execution = execution
+                    if handle.done():
+                        del pending[handle.queryId]
+                    else:
+                        delay = max(delay, self.__engineDelay(execution))
+            if not pending:
+                break
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError("%d Athena queries still running after %d secs" % (len(pending), timeout))
+            time.sleep(delay)
+            delay = min(self.__pollMax, delay * 2)
+        return handles
+
+    def __startQuery(self, sql_str: str) -> str:
+        ''' Submit the query and return the QueryExecutionId '''
         queryId = str(uuid.uuid4())
 
         tempS3 = self.__tempS3 + queryId if self.__tempS3.endswith('/') \
@@ -26,38 +379,141 @@ class Athena:
         if self.__sseTyp != 'SSE_S3' :
             resConf['EncryptionConfiguration']['KmsKey'] = self.__KmsKey
 
-        query_id = self.__athena.start_query_execution(
+        extra = {}
+        if self.__workGroup :
+            extra['WorkGroup'] = self.__workGroup
+        if self.__reuseMaxAge :
+            extra['ResultReuseConfiguration'] = {'ResultReuseByAgeConfiguration' :
+                                                    {'Enabled' : True, 'MaxAgeInMinutes' : self.__reuseMaxAge}}
+
+        return self.__athena.start_query_execution(
             QueryString         = sql_str,
             ClientRequestToken  = queryId,
-            ResultConfiguration = resConf
+            ResultConfiguration = resConf,
+            **extra
             )['QueryExecutionId']
 
-        query_status = None
-        while query_status == 'QUEUED' or \
-              query_status == 'RUNNING' or \
-              query_status is None:
-            query_status = self.__athena.get_query_execution(QueryExecutionId=query_id)['QueryExecution']['Status']
-            if query_status['State']   == 'FAILED' :
-                raise Exception('Athena query with the string "{}" failed'.format(sql_str))
-            elif query_status['State'] ==  'CANCELLED':
-                raise Exception('Athena query with the string "{}" was cancelled'.format(sql_str))
-            time.sleep(10)
+    def __waitForQuery(self, query_id: str, sql_str: str, execution: dict = None) -> dict:
+        '''
+        Wait for the query to complete and return its QueryExecution.
+        Polls right away, then backs off exponentially from pollInitial up to pollMax.
+        '''
+        delay = self.__pollInitial
+        while execution is None or execution['Status']['State'] not in TERMINAL_STATES:
+            if execution is not None:
+                time.sleep(delay)
+                delay = min(self.__pollMax, max(delay * 2, self.__engineDelay(execution)))
+            execution = self.__athena.get_query_execution(QueryExecutionId=query_id)['QueryExecution']
 
+        query_status = execution['Status']['State']
+        if query_status   == 'FAILED' :
+            raise Exception('Athena query with the string "{}" failed: {}'.format(
+                                sql_str, execution['Status'].get('StateChangeReason', '')))
+        elif query_status ==  'CANCELLED':
+            raise Exception('Athena query with the string "{}" was cancelled'.format(sql_str))
+        return execution
 
-        results_iter = self.__athena.get_paginator('get_query_results').paginate(
+    def __engineDelay(self, execution: dict) -> float:
+        '''
+        Poll delay suggested by the execution statistics: a query which already ran/queued for
+        N seconds is unlikely to finish in the next N/10 seconds.
+        '''
+        stats = execution.get('Statistics', {})
+        spent = stats.get('EngineExecutionTimeInMillis', 0) + stats.get('QueryQueueTimeInMillis', 0)
+        return min(self.__pollMax, spent / 10000.0)
+
+    def __resultPages(self, query_id: str):
+        return self.__athena.get_paginator('get_query_results').paginate(
             QueryExecutionId=query_id,
             PaginationConfig={
                 'PageSize': 1000
             }
         )
+
+    def __fetchTuples(self, query_id: str, retainHeader: bool) -> [(tuple)]:
         results = []
-        data_list = []
-        for results_page in results_iter:
+        for results_page in self.__resultPages(query_id):
             for row in results_page['ResultSet']['Rows']:
-                data_list.append(row['Data'])
-        for datum in data_list[0 if retainHeader else 1:]:
-            results.append([x['VarCharValue'] for x in datum])
-        return [tuple(x) for x in results]
+                results.append(tuple(x.get('VarCharValue') for x in row['Data']))
+        return results[0 if retainHeader else 1:]
+
+    def __fetchTable(self, query_id: str, hasHeader: bool):
+        ''' Decode the result pages straight into one list per column and build the typed arrow table '''
+        colInfo = None
+        columns = None
+        for results_page in self.__resultPages(query_id):
+            if colInfo is None:
+                colInfo = results_page['ResultSet']['ResultSetMetadata']['ColumnInfo']
+                columns = [[] for _ in colInfo]
+            rows = results_page['ResultSet']['Rows']
+            if hasHeader:
+                rows, hasHeader = rows[1:], False
+            for col, cells in zip(columns, zip(*[row['Data'] for row in rows])):
+                col.extend([cell.get('VarCharValue') for cell in cells])
+
+        return pa.Table.from_arrays([Athena.decodeColumn(vals, info) for vals, info in zip(columns, colInfo)],
+                                    names=[info['Name'] for info in colInfo])
+
+    def __fetchTableFromS3(self, execution: dict, minBytes: int, concurrency: int):
+        '''
+        Read the result CSV of the query from its OutputLocation into a typed arrow table.
+        Returns None when the API should be used instead (non CSV output or small result).
+        '''
+        outLoc = execution.get('ResultConfiguration', {}).get('OutputLocation', '')
+        if not outLoc.endswith('.csv'):
+            return None
+        (bkt, key) = Athena.getBucketNKeyTuple(outLoc)
+        if self.__s3.head_object(Bucket=bkt, Key=key)['ContentLength'] < minBytes:
+            return None
+
+        colInfo = self.__athena.get_query_results(QueryExecutionId = execution['QueryExecutionId'],
+                                                  MaxResults       = 1
+                                                 )['ResultSet']['ResultSetMetadata']['ColumnInfo']
+        names   = [info['Name'] for info in colInfo]
+
+        buf = io.BytesIO()
+        self.__s3.download_fileobj(bkt, key, buf,
+                                   Config=transfer.TransferConfig(max_concurrency    = concurrency,
+                                                                  multipart_chunksize= 8 * 1024 * 1024))
+        #Athena quotes every value and writes NULL as an empty unquoted field
+        table = pcsv.read_csv(pa.BufferReader(buf.getbuffer()),
+                              read_options   = pcsv.ReadOptions(column_names=names, skip_rows=1),
+                              parse_options  = pcsv.ParseOptions(newlines_in_values=True),
+                              convert_options= pcsv.ConvertOptions(column_types              = {n: pa.string() for n in names},
+                                                                   strings_can_be_null       = True,
+                                                                   quoted_strings_can_be_null= False))
+        return pa.Table.from_arrays([Athena.decodeColumn(table.column(i), info) for i, info in enumerate(colInfo)],
+                                    names=names)
+
+    def __cleanupResult(self, execution: dict):
+        ''' Delete the result file of the query and its .metadata from tempS3 '''
+        outLoc = execution.get('ResultConfiguration', {}).get('OutputLocation')
+        if outLoc:
+            (bkt, key) = Athena.getBucketNKeyTuple(outLoc)
+            self.__s3.delete_objects(Bucket = bkt,
+                                     Delete = {'Objects': [{'Key': key}, {'Key': key + '.metadata'}],
+                                               'Quiet'  : True})
+
+    @staticmethod
+    def getBucketNKeyTuple(uriStr: str) -> (str,str):
+        splt = uriStr.replace("s3://","").split("/")
+        return (splt[0], "/".join(splt[1:]))
+
+    @staticmethod
+    def decodeColumn(values, colInfo: dict):
+        '''
+        Convert the text values of the column (list with None for NULL or an arrow string array)
+        to an arrow array of its Athena type.
+        '''
+        typ = colInfo['Type'].lower()
+        arr = values if isinstance(values, (pa.Array, pa.ChunkedArray)) else pa.array(values, type=pa.string())
+        if typ == 'decimal':
+            return pc.cast(arr, pa.decimal128(colInfo.get('Precision', 38), colInfo.get('Scale', 0)))
+        if typ == 'timestamp' and (colInfo.get('Precision') or 0) > 6:
+            return pc.cast(arr, pa.timestamp('ns'))
+        if typ in ATHENA_ARROW_TYPES:
+            return pc.cast(arr, pa.type_for_alias(ATHENA_ARROW_TYPES[typ]))
+        return arr
 '''
 def main():
 
@@ -0,0 +1,85 @@
+from __future__ import print_function
+import copy, json, threading, weakref
+from .._lazy import lazyImport
+botoConfig = lazyImport('botocore.config')
+
+class ClientRegistry:
+    '''
+    Shared boto3 clients/resources keyed by (session, service, region, config), so all the helpers
+    (S3, Athena, SSM, Redshift, SparkUtils) built on a session re-use the same warm connection pools
+    instead of each paying the client creation, endpoint resolution and TLS handshakes.
+    Entries are dropped with their session (weak references). Clients are thread safe and shared by all
+    the threads; resources are not, so each thread gets its own resource.
+    '''
+    def __init__(self, maxPoolConnections : int  = 50,
+                       tcpKeepalive       : bool = True,
+                       maxAttempts        : int  = 10,
+                       retryMode          : str  = 'adaptive'):
+        self.__lock     = threading.Lock()
+        self.__sessions = weakref.WeakKeyDictionary()   #session -> {key: client/resource}
+        self.configure(maxPoolConnections, tcpKeepalive, maxAttempts, retryMode)
+
+    def configure(self, maxPoolConnections : int  = 50,
+                        tcpKeepalive       : bool = True,
+                        maxAttempts        : int  = 10,
+                        retryMode          : str  = 'adaptive'):
+        '''
+        Set the defaults of the botocore Config used for the clients created from now on.
+            maxPoolConnections: Size of the urllib3 connection pool of each client
+            tcpKeepalive      : Keep the idle connections alive at the TCP level
+            maxAttempts/retryMode: botocore retry settings ('adaptive' adds client side rate limiting)
+        '''
+        with self.__lock:
+            self.__defaults = {'max_pool_connections': maxPoolConnections,
+                               'tcp_keepalive'       : tcpKeepalive,
+                               'retries'             : {'max_attempts': maxAttempts, 'mode': retryMode}}
+
+    def client(self, session, service: str, region: str = None, **config):
+        ''' Shared `session.client(service)`. `config` takes botocore Config kwargs overriding the defaults. '''
+        return self.__get(session, 'client', service, region, config)
+
+    def resource(self, session, service: str, region: str = None, **config):
+        ''' `session.resource(service)` shared within the calling thread (resources aren't thread safe) '''
+        return self.__get(session, 'resource', service, region, config)
+
+    def s3fs(self, session, region: str = None):
+        '''
+        S3FileSystem running under the credentials of the session (instead of the default chain).
+        Rebuilt when the (refreshable) credentials of the session rotate.
+        '''
+        from s3fs import S3FileSystem
+        region = region or getattr(session, 'region_name', None)
+        creds  = session.get_credentials()
+        frozen = creds.get_frozen_credentials() if creds else None
+        ident  = (frozen.access_key, frozen.token) if frozen else None
+        with self.__lock:
+            entries = self.__sessions.setdefault(session, {})
+            cached  = entries.get(('s3fs', region))
+            if cached and cached[0] == ident:
+                return cached[1]
+            fs = S3FileSystem(key           = frozen.access_key if frozen else None,
+                              secret        = frozen.secret_key if frozen else None,
+                              token         = frozen.token      if frozen else None,
+                              client_kwargs = {'region_name': region} if region else None)
+            entries[('s3fs', region)] = (ident, fs)
+            return fs
+
+    def clear(self):
+        with self.__lock:
+            self.__sessions = weakref.WeakKeyDictionary()
+
+    def __get(self, session, kind: str, service: str, region: str, config: dict):
+        region = region or getattr(session, 'region_name', None)
+        with self.__lock:
+            cnf = dict(self.__defaults, **config)
+            key = (kind, service, region, json.dumps(cnf, sort_keys=True, default=str))
+            if kind == 'resource':
+                key += (threading.get_ident(),)
+            entries = self.__sessions.setdefault(session, {})
+            if key not in entries:
+                create = session.client if kind == 'client' else session.resource
+                #deepcopy: botocore rewrites the retries dict of the Config in place
+                entries[key] = create(service, region_name=region, config=botoConfig.Config(**copy.deepcopy(cnf)))
+            return entries[key]
+
+REGISTRY = ClientRegistry()
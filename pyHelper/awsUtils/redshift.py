@@ -1,59 +1,177 @@
-from __future__ import print_function
-import psycopg2
+from __future__ import print_function, annotations
+import time, threading, uuid, json, math, logging, itertools, weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from sys import exc_info
 from .sts import STS
+from .clients import REGISTRY
+from .s3  import S3
+from .._lazy import lazyImport
+psycopg2 = lazyImport('psycopg2')
+pgExtras = lazyImport('psycopg2.extras')
+pa       = lazyImport('pyarrow')
+pcsv     = lazyImport('pyarrow.csv')
+
+#Postgres/Redshift type OIDs (cursor.description type_code) with a fixed arrow type (as arrow type aliases).
+#numeric gets a decimal of its precision/scale; the other types are inferred from the values.
+PG_ARROW_TYPES = {
+    16  : 'bool',
+    21  : 'int16',
+    23  : 'int32',
+    20  : 'int64',
+    700 : 'float32',
+    701 : 'float64',
+    19  : 'string',
+    25  : 'string',
+    1042: 'string',
+    1043: 'string',
+    17  : 'binary',
+    1082: 'date32',
+    1114: 'timestamp[us]',
+}
+PG_TIMESTAMPTZ = 1184
+PG_NUMERIC     = 1700
+
+def arrowTypes(description) -> list:
+    ''' Arrow type of each column of a cursor description, None where it has to be inferred from the values '''
+    types = []
+    for col in description:
+        oid = col[1] if len(col) > 1 else None
+        if oid in PG_ARROW_TYPES:
+            types.append(pa.type_for_alias(PG_ARROW_TYPES[oid]))
+        elif oid == PG_TIMESTAMPTZ:
+            types.append(pa.timestamp('us', tz='UTC'))
+        elif oid == PG_NUMERIC and len(col) > 5 and col[4] and col[5] is not None:
+            types.append(pa.decimal128(col[4], col[5]))
+        else:
+            types.append(None)
+    return types
+
+def retryablePgErrors() -> tuple:
+    ''' Errors after which re-running the same batch may succeed (serialization conflicts, deadlocks) '''
+    return (psycopg2.extensions.TransactionRollbackError,)
+
+def __getattr__(name: str):
+    #Kept for the callers of the constant; resolving it needs psycopg2
+    if name == 'RETRYABLE_PG_ERRORS':
+        return retryablePgErrors()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 class Redshift:
 
-    def __init__(self, boto, region,clusterId, dbName,dbUser):
+    __endpoints     = {}                 #(region, clusterId) -> (host, port). Shared by all the instances
+    __endpointsLock = threading.Lock()
+
+    def __init__(self, boto, region,clusterId, dbName,dbUser,
+                       pooled          : bool = False,
+                       minConn         : int  = 1,
+                       maxConn         : int  = 5,
+                       credDuration    : int  = 3600,
+                       refreshMargin   : int  = 300,
+                       healthCheckIdle : int  = 60):
+        '''
+        parms:
+            pooled         : Keep a thread safe pool of connections instead of the single connection
+            minConn/maxConn: Connections opened upfront / max connections open at the same time (pooled)
+            credDuration   : Seconds the IAM DB credentials are requested for
+            refreshMargin  : Refresh the IAM DB credentials when they expire in less than these many seconds
+            healthCheckIdle: Run 'select 1' on a pooled connection idle for more than these many seconds before handing it out
+        '''
         self.__boto          = boto
         self.__region        = region or 'us-east1'
         self.__clusterId     = clusterId
         self.__dbName        = dbName
         self.__dbUser        = dbUser
-        self.__rsClient      = self.__boto.client('redshift', region_name=self.__region)
+        self.__rsClient      = REGISTRY.client(self.__boto, 'redshift', self.__region)
         self.__rsConn        = None
         self.__rsCurr        = None
         self.__host          = ''
         self.__port          = ''
         self.__iamUsr        = ''
         self.__iamPwd        = ''
+        self.__credDuration  = credDuration
+        self.__refreshMargin = refreshMargin
+        self.__credExpiry    = 0
+        self.__credLock      = threading.Lock()
+
+        self.__pooled        = pooled
+        self.__minConn       = minConn
+        self.__maxConn       = max(maxConn, minConn, 1)
+        self.__healthIdle    = healthCheckIdle
+        self.__idle          = []          #LIFO of (connection, lastUsed)
+        self.__open          = 0           #Connections handed out + idle
+        self.__poolCond      = threading.Condition()
+        self.__s3            = None
+        self.__slices        = None
 
         self.__continue()
+        if self.__pooled:
+            conns = [self.__checkout() for _ in range(self.__minConn)]
+            for conn in conns:
+                self.__checkin(conn)
 
     def __del__(self):
         self.close()
 
     def close(self):
-        ''' Close the cursor and the connection '''
-        if self.__rsConn:
-           self.__rsCurr.close()
+        ''' Close the cursor and the connection (and all the pooled connections) '''
+        if getattr(self, '_Redshift__rsConn', None):
+           if self.__rsCurr:
+               self.__rsCurr.close()
            self.__rsConn.close()
+           self.__rsConn = None
+        if getattr(self, '_Redshift__poolCond', None):
+            with self.__poolCond:
+                for conn, _ in self.__idle:
+                    conn.close()
+                self.__open -= len(self.__idle)
+                self.__idle  = []
 
     def __continue(self):
         ''' Initialize the class variables '''
-        desc = self.__rsClient.describe_clusters(ClusterIdentifier=self.__clusterId)
-        self.__host   = desc['Clusters'][0]['Endpoint']['Address']
-        self.__port   = desc['Clusters'][0]['Endpoint']['Port']
-
-        cred = self.__rsClient.get_cluster_credentials(
-                ClusterIdentifier= self.__clusterId,
-                DbName           = self.__dbName,
-                DbUser           = self.__dbUser,
-                DurationSeconds=3600)
-        self.__iamUsr = cred['DbUser']
-        self.__iamPwd = cred['DbPassword']
+        endpointKey = (self.__region, self.__clusterId)
+        with Redshift.__endpointsLock:
+            endpoint = Redshift.__endpoints.get(endpointKey)
+        if endpoint is None:
+            desc = self.__rsClient.describe_clusters(ClusterIdentifier=self.__clusterId)
+            endpoint = (desc['Clusters'][0]['Endpoint']['Address'],
+                        desc['Clusters'][0]['Endpoint']['Port'])
+            with Redshift.__endpointsLock:
+                Redshift.__endpoints[endpointKey] = endpoint
+        (self.__host, self.__port) = endpoint
 
-    def connect(self):
-        ''' Connect to the Redshift cluster  '''
-        if self.__rsConn == None:
-            try:
-                self.__rsConn = psycopg2.connect(
+        self.__refreshCred()
+
+    def __refreshCred(self, force: bool = False):
+        ''' Get new IAM DB credentials if the current ones expire within the refresh margin '''
+        with self.__credLock:
+            if not force and time.time() < self.__credExpiry - self.__refreshMargin:
+                return
+            cred = self.__rsClient.get_cluster_credentials(
+                    ClusterIdentifier= self.__clusterId,
+                    DbName           = self.__dbName,
+                    DbUser           = self.__dbUser,
+                    DurationSeconds  = self.__credDuration)
+            self.__iamUsr     = cred['DbUser']
+            self.__iamPwd     = cred['DbPassword']
+            expiry            = cred.get('Expiration')
+            self.__credExpiry = expiry.timestamp() if expiry else time.time() + self.__credDuration
+
+    def __newConnection(self):
+        self.__refreshCred()
+        return psycopg2.connect(
                     dbname   = self.__dbName,
                     host     = self.__host,
                     port     = self.__port,
                     user     = self.__iamUsr,
                     password = self.__iamPwd)
+
+    def connect(self):
+        ''' Connect to the Redshift cluster  '''
+        if self.__rsConn == None:
+            try:
+                self.__rsConn = self.__newConnection()
                 self.__rsCurr = self.__rsConn.cursor()
             except (Exception, psycopg2.Error) as error :
                 print("Failed to connect to RS. Error : ", error)
@@ -63,8 +181,101 @@ class Redshift:
         else :
             print("self.__rsConn  is already initialized")
 
+    @contextmanager
+    def connection(self, timeout: float = None):
+        '''
+        Context manager handing out a connection. In pooled mode the connection is checked out of the
+        pool (health checked) and returned to it on exit, rolling back any open transaction.
+        Without pooling it is the single connection of the object.
+        '''
+        if not self.__pooled:
+            if self.__rsConn is None:
+                self.connect()
+            yield self.__rsConn
+            return
+
+        conn   = self.__checkout(timeout)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.__checkin(conn, broken)
+
+    def __checkout(self, timeout: float = None):
+        while True:
+            with self.__poolCond:
+                conn = None
+                while True:
+                    if self.__idle:
+                        (conn, lastUsed) = self.__idle.pop()
+                        break
+                    if self.__open < self.__maxConn:
+                        self.__open += 1
+                        break
+                    if not self.__poolCond.wait(timeout):
+                        raise TimeoutError("No Redshift connection free after %s secs" % (timeout))
+
+            if conn is None:
+                try:
+                    return self.__newConnection()
+                except Exception:
+                    self.__discard(None)
+                    raise
+
+            if self.__isHealthy(conn, lastUsed):
+                return conn
+            self.__discard(conn)
+
+    def __isHealthy(self, conn, lastUsed: float) -> bool:
+        if conn.closed:
+            return False
+        if time.time() - lastUsed < self.__healthIdle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("select 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def __checkin(self, conn, broken: bool = False):
+        if broken or conn.closed:
+            self.__discard(conn)
+            return
+        try:
+            if conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+        except psycopg2.Error:
+            self.__discard(conn)
+            return
+        with self.__poolCond:
+            self.__idle.append((conn, time.time()))
+            self.__poolCond.notify()
+
+    def __discard(self, conn):
+        if conn is not None and not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        with self.__poolCond:
+            self.__open -= 1
+            self.__poolCond.notify()
+
     def runSQL(self,sql):
         ''' execute a select query and return the results as list'''
+        if self.__pooled:
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql)
+                    res = cur.fetchall() if cur.description else None
+                conn.commit()
+            return res
+
         try:
             if self.__rsCurr != None :
                 self.__rsCurr = self.__rsConn.cursor()
@@ -82,6 +293,328 @@ class Redshift:
 
         self.__rsCurr.close()
         return res
+
+    def executeMany(self, sql: str, argslist,
+                          template      : str   = None,
+                          pageSize      : int   = 1000,
+                          batchSize     : int   = None,
+                          useSavepoints : bool  = False,
+                          maxReTry      : int   = 3,
+                          backoff       : float = 0.5) -> int:
+        '''
+        Run a multi-row statement (e.g 'INSERT INTO t (a,b) VALUES %s') for all the argslist with
+        psycopg2 `execute_values`: `pageSize` rows are sent per statement/round trip.
+        See `executeBatch` for batchSize/useSavepoints/maxReTry. Returns the number of rows sent.
+        '''
+        return self.__executeBatched(
+                    lambda cur, chunk : pgExtras.execute_values(cur, sql, chunk, template=template, page_size=pageSize),
+                    argslist, batchSize or pageSize * 10, useSavepoints, maxReTry, backoff)
+
+    def executeBatch(self, sql: str, argslist,
+                           pageSize      : int   = 100,
+                           batchSize     : int   = None,
+                           useSavepoints : bool  = False,
+                           maxReTry      : int   = 3,
+                           backoff       : float = 0.5) -> int:
+        '''
+        Run a parameterized statement (e.g 'UPDATE t SET b = %s WHERE a = %s') for all the argslist
+        with psycopg2 `execute_batch`: `pageSize` statements are sent per round trip.
+        parms:
+            batchSize    : Rows per transaction unit (default pageSize * 10)
+            useSavepoints: Run everything in one transaction with a SAVEPOINT per batch (Postgres).
+                           Redshift has no SAVEPOINT, so by default each batch is committed on its own.
+            maxReTry     : Re-tries of a batch failing with a serialization conflict/deadlock
+            backoff      : Base seconds of the exponential backoff between the re-tries
+        Return,
+            Number of rows sent
+        '''
+        return self.__executeBatched(
+                    lambda cur, chunk : pgExtras.execute_batch(cur, sql, chunk, page_size=pageSize),
+                    argslist, batchSize or pageSize * 10, useSavepoints, maxReTry, backoff)
+
+    def __executeBatched(self, runChunk, argslist, batchSize: int, useSavepoints: bool,
+                               maxReTry: int, backoff: float) -> int:
+        ''' Run the chunks of argslist, rolling back and re-trying a failed chunk alone '''
+        rows = 0
+        args = iter(argslist)
+        with self.connection() as conn:
+            try:
+                with conn.cursor() as cur:
+                    for chunk in iter(lambda : list(itertools.islice(args, batchSize)), []):
+                        attempt = 0
+                        while True:
+                            try:
+                                if useSavepoints:
+                                    cur.execute("SAVEPOINT pyhelper_batch")
+                                runChunk(cur, chunk)
+                                if useSavepoints:
+                                    cur.execute("RELEASE SAVEPOINT pyhelper_batch")
+                                else:
+                                    conn.commit()
+                                break
+                            except retryablePgErrors() as error:
+                                if useSavepoints:
+                                    cur.execute("ROLLBACK TO SAVEPOINT pyhelper_batch")
+                                else:
+                                    conn.rollback()
+                                attempt += 1
+                                if attempt > maxReTry:
+                                    raise
+                                print("Re-trying the batch of %d rows (attempt %d). Error : " % (len(chunk), attempt), error)
+                                time.sleep(backoff * (2 ** (attempt - 1)))
+                        rows += len(chunk)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        return rows
+
+    def getS3(self) -> S3:
+        ''' S3 helper on the same boto session (used to stage/read the COPY/UNLOAD files) '''
+        if self.__s3 is None:
+            self.__s3 = S3(logging.getLogger(__name__), self.__boto)
+        return self.__s3
+
+    def sliceCount(self) -> int:
+        '''
+        Number of slices of the cluster (1 on a database without stv_slices, e.g. a plain Postgres).
+        Connection errors are raised and not cached.
+        '''
+        if self.__slices is None:
+            with self.connection() as conn:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("select count(*) from stv_slices")
+                        slices = max(1, cur.fetchone()[0])
+                    conn.commit()
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except psycopg2.Error as error:
+                    conn.rollback()     #Don't leave the (non pooled) connection in an aborted transaction
+                    print("Not able to get the slice count, assuming 1. Error : ", error)
+                    slices = 1
+            self.__slices = slices
+        return self.__slices
+
+    def copySQL(self, table: str, manifestUri: str, iamRole: str, fileFormat: str,
+                      columns: list = None, copyOptions: str = '') -> str:
+        ''' Build the COPY statement loading the files listed in the manifest '''
+        if fileFormat == 'parquet':
+            fmt = "FORMAT AS PARQUET"
+        else:
+            fmt = "FORMAT AS CSV GZIP IGNOREHEADER 1 EMPTYASNULL"
+        cols = " (%s)" % (", ".join(columns)) if columns and fileFormat != 'parquet' else ""
+        return "COPY %s%s FROM '%s' IAM_ROLE '%s' %s MANIFEST %s" % (table, cols, manifestUri, iamRole, fmt, copyOptions)
+
+    def bulkLoad(self, data, table: str, stagingS3: str, iamRole: str,
+                       fileFormat       : str  = 'parquet',
+                       mode             : str  = 'append',
+                       keyCols          : list = None,
+                       shards           : int  = None,
+                       targetShardBytes : int  = 128 * 1024 * 1024,
+                       maxWorkers       : int  = 8,
+                       cleanup          : bool = True,
+                       copyOptions      : str  = '') -> dict:
+        '''
+        Load a Pandas DF / arrow Table into the table with a single COPY of staged S3 files.
+        parms:
+            data            : Pandas DF or arrow Table. Columns must be in the order of the target table.
+            table           : Target table (schema.table)
+            stagingS3       : S3 prefix for the staged shards and the manifest (a unique sub folder is used)
+            iamRole         : IAM role Redshift assumes to read the staged files
+            fileFormat      : 'parquet' (snappy) or 'csv' (gzip)
+            mode            : 'append' -> COPY into the table
+                              'upsert' -> COPY into a temp staging table, then DELETE the matching keyCols + INSERT
+            shards          : Number of files. Defaults to a multiple of the cluster slice count with
+                              shards of about targetShardBytes (uncompressed)
+            cleanup         : Delete the staged files once loaded
+        Return,
+            Summary dict {'rows', 'shards', 'bytes', 'manifest', 'elapsed'}
+        '''
+        if fileFormat not in ('parquet', 'csv'):
+            raise ValueError("Invalid fileFormat '%s'. Supported: parquet, csv" % (fileFormat))
+        if mode not in ('append', 'upsert'):
+            raise ValueError("Invalid mode '%s'. Supported: append, upsert" % (mode))
+        if mode == 'upsert' and not keyCols:
+            raise ValueError("keyCols are needed for mode 'upsert'")
+
+        start = time.time()
+        s3    = self.getS3()
+        tbl   = data if isinstance(data, pa.Table) else pa.Table.from_pandas(data, preserve_index=False)
+        if shards is None:
+            slices = self.sliceCount()
+            shards = slices * max(1, math.ceil(math.ceil(tbl.nbytes / float(targetShardBytes)) / slices))
+        shards   = max(1, min(shards, tbl.num_rows))
+        prefix   = "%s/pyhelper-load-%s" % (stagingS3.rstrip('/'), uuid.uuid4().hex)
+        perShard = int(math.ceil(tbl.num_rows / float(shards)))
+
+        def writeShard(i):
+            part = tbl.slice(i * perShard, perShard)
+            if fileFormat == 'parquet':
+                uri  = "%s/part-%05d.parquet" % (prefix, i)
+                return (uri, s3.putParquet(part, uri))
+            uri  = "%s/part-%05d.csv.gz" % (prefix, i)
+            sink = pa.BufferOutputStream()
+            with pa.CompressedOutputStream(sink, 'gzip') as gz:
+                pcsv.write_csv(part, gz)
+            buf  = sink.getvalue()
+            s3.putBytes(uri, buf)
+            return (uri, buf.size)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as pool:
+                files = list(pool.map(writeShard, range(shards)))
+            manifest = "%s/manifest.json" % (prefix)
+            s3.putBytes(manifest, json.dumps({'entries': [{'url'      : uri,
+                                                           'mandatory': True,
+                                                           'meta'     : {'content_length': size}}
+                                                          for (uri, size) in files]}).encode('utf-8'))
+            columns = tbl.schema.names
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    if mode == 'append':
+                        cur.execute(self.copySQL(table, manifest, iamRole, fileFormat, columns, copyOptions))
+                    else:
+                        stage = "%s_stage_%s" % (table.split('.')[-1], uuid.uuid4().hex[:8])
+                        cur.execute("CREATE TEMP TABLE %s (LIKE %s)" % (stage, table))
+                        cur.execute(self.copySQL(stage, manifest, iamRole, fileFormat, columns, copyOptions))
+                        cur.execute("DELETE FROM %s USING %s WHERE %s" % (table, stage,
+                                        " AND ".join("%s.%s = %s.%s" % (table, k, stage, k) for k in keyCols)))
+                        cur.execute("INSERT INTO %s SELECT * FROM %s" % (table, stage))
+                        cur.execute("DROP TABLE %s" % (stage))
+                conn.commit()
+        except BaseException:
+            if not self.__pooled and self.__rsConn is not None:
+                self.__rsConn.rollback()
+            raise
+        finally:
+            if cleanup:
+                s3.deleteObject(prefix, recursive=True, bulk=True)
+
+        return {'rows'    : tbl.num_rows,
+                'shards'  : shards,
+                'bytes'   : sum(size for (_, size) in files),
+                'manifest': manifest,
+                'elapsed' : round(time.time() - start, 3)}
+
+    def unload(self, sql: str, s3Prefix: str, iamRole: str,
+                     asIterator    : bool = False,
+                     maxWorkers    : int  = 8,
+                     cleanup       : bool = True,
+                     unloadOptions : str  = ''):
+        '''
+        Extract the query results with `UNLOAD ... FORMAT PARQUET PARALLEL ON` (every slice writes its
+        own files) and read the files back concurrently.
+        parms:
+            sql          : Query to unload
+            s3Prefix     : S3 prefix for the unloaded files (a unique sub folder is used)
+            iamRole      : IAM role Redshift assumes to write the files
+            asIterator   : Return a generator of arrow RecordBatches instead of one arrow Table.
+                           At most `maxWorkers` files are read ahead of the consumer.
+            cleanup      : Delete the unloaded files once read. With asIterator, once the generator is
+                           exhausted, closed or garbage collected (even if it was never started).
+            unloadOptions: Extra UNLOAD options (e.g. "MAXFILESIZE 256 MB")
+        '''
+        s3     = self.getS3()
+        prefix = "%s/pyhelper-unload-%s/" % (s3Prefix.rstrip('/'), uuid.uuid4().hex)
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UNLOAD ('%s') TO '%s' IAM_ROLE '%s' FORMAT PARQUET PARALLEL ON %s" %
+                            (sql.replace("'", "''"), prefix, iamRole, unloadOptions))
+            conn.commit()
+
+        (bkt, key) = s3.getBucketNKeyTuple(prefix)
+        files = ["s3://%s/%s" % (bkt, k) for k in s3.listKeys(bkt, key) if not k.endswith('/')]
+        if asIterator:
+            done    = []
+            batches = self.__iterUnloaded(s3, files, maxWorkers, done)
+            if cleanup:
+                done.append(weakref.finalize(batches, s3.deleteObject, prefix, recursive=True, bulk=True))
+            return batches
+        try:
+            tables = list(self.__readUnloaded(s3, files, maxWorkers))
+        finally:
+            if cleanup:
+                s3.deleteObject(prefix, recursive=True, bulk=True)
+        return pa.concat_tables(tables) if tables else self.__emptyTable(sql)
+
+    def __iterUnloaded(self, s3: S3, files: list, maxWorkers: int, done: list):
+        ''' RecordBatches of the files, then run the `done` callbacks (the finalizer deleting the files) '''
+        try:
+            for tbl in self.__readUnloaded(s3, files, maxWorkers):
+                yield from tbl.to_batches()
+        finally:
+            for callback in done:
+                callback()
+
+    def __readUnloaded(self, s3: S3, files: list, maxWorkers: int):
+        ''' Generator of the arrow tables of the files, read on a pool with a bounded read ahead '''
+        with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as pool:
+            pending = deque()
+            for uri in files:
+                pending.append(pool.submit(s3.readParquet, uri))
+                if len(pending) >= maxWorkers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def __emptyTable(self, sql: str):
+        ''' Empty arrow table with the columns of the query (UNLOAD writes no file for an empty result) '''
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT * FROM (%s) pyhelper_empty LIMIT 0" % (sql.strip().rstrip(';')))
+                description = cur.description
+            conn.commit()
+        return pa.schema([pa.field(col[0], typ or pa.string())
+                          for col, typ in zip(description, arrowTypes(description))]).empty_table()
+
+    def streamSQL(self, sql, args = None,
+                       itersize  : int  = 10000,
+                       batchSize : int  = None,
+                       asArrow   : bool = False,
+                       schema           = None):
+        '''
+        Generator running the query on a named (server side) cursor and yielding the rows in batches.
+        The cursor is iterated, so at most `itersize` rows fetched from the server plus the batch being
+        built are held in memory at any time.
+        parms:
+            sql/args : Query and its (psycopg2 style) parameters
+            itersize : Rows fetched from the server per network round trip
+            batchSize: Rows per yielded batch (defaults to itersize)
+            asArrow  : Yield pyarrow RecordBatches instead of lists of tuples
+            schema   : pyarrow schema of the RecordBatches. Defaults to the column types of the query
+                       (see PG_ARROW_TYPES); the other columns take the first non null type of the values.
+        '''
+        batchSize = batchSize or itersize
+        with self.connection() as conn:
+            cur = conn.cursor(name="pyhelper_%s" % (uuid.uuid4().hex))
+            cur.itersize = itersize
+            try:
+                cur.execute(sql, args)
+                rowIter = iter(cur)
+                names   = None
+                while True:
+                    rows = list(itertools.islice(rowIter, batchSize))
+                    if not rows:
+                        break
+                    if not asArrow:
+                        yield rows
+                        continue
+
+                    if names is None:      #The description of a named cursor is only set after the first fetch
+                        names = schema.names if schema else [d[0] for d in cur.description]
+                        types = list(schema.types) if schema else arrowTypes(cur.description)
+                    arrays = [pa.array(col, type=typ if typ is not None and not pa.types.is_null(typ) else None)
+                              for col, typ in zip(zip(*rows), types)]
+                    types  = [arr.type if (typ is None or pa.types.is_null(typ)) and not pa.types.is_null(arr.type)
+                              else typ for arr, typ in zip(arrays, types)]   #Keep the batches consistent
+                    yield pa.RecordBatch.from_arrays(arrays, names=names)
+            except BaseException:
+                cur.close()
+                conn.rollback()
+                raise
+            cur.close()
+            conn.commit()
 '''
 def main():
 
@@ -1,21 +1,141 @@
-from __future__ import print_function
-from boto3 import Session  as bototSession
-from boto3 import resource
-from botocore.client import Config
-import time
-
-from s3fs import S3FileSystem
-import pyarrow         as pa
-import pyarrow.parquet as pq
-from pyarrow.compat import guid
+from __future__ import print_function, annotations
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING
+from uuid import uuid4
+import time, random, threading, json
+
+from .clients import REGISTRY
+from .._lazy  import lazyImport
+pa       = lazyImport('pyarrow')
+pq       = lazyImport('pyarrow.parquet')
+pc       = lazyImport('pyarrow.compute')
+np       = lazyImport('numpy')
+botoExc  = lazyImport('botocore.exceptions')
 from logging import RootLogger
+if TYPE_CHECKING:
+    from boto3 import Session as bototSession
+
+#Error codes for which a throttled/failed delete is worth re-trying
+RETRYABLE_S3_ERRORS = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                       'InternalError', 'ServiceUnavailable', 'RequestTimeout', '503')
+MAX_KEYS_PER_DELETE = 1000   #Hard limit of the S3 DeleteObjects API
+HIVE_NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+MIN_PART_SIZE       = 5 * 1024 * 1024   #S3 rejects multipart parts (but the last) smaller than 5MB
+
+def guid() -> str:
+    return uuid4().hex
+
+@lru_cache(maxsize=None)
+def parquetVersion() -> str:
+    ''' Parquet format '2.0' was split into '2.4'/'2.6' (and later removed) by pyarrow 2.x '''
+    return '2.0' if int(pa.__version__.split('.')[0]) < 2 else '2.6'
+
+def __getattr__(name: str):
+    #PARQUET_VERSION needs pyarrow, so it is resolved on first use rather than at import
+    if name == 'PARQUET_VERSION':
+        return parquetVersion()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+class S3MultipartFile:
+    '''
+    Write-only file object backed by an S3 multipart upload.
+    Only `partSize` bytes are held in memory. The upload is started lazily, so a file smaller
+    than one part is sent with a single `put_object`.
+    '''
+    def __init__(self, s3Client, bkt: str, key: str, partSize: int = 64 * 1024 * 1024):
+        self.__s3       = s3Client
+        self.__bkt      = bkt
+        self.__key      = key
+        self.__partSize = max(partSize, MIN_PART_SIZE)
+        self.__buf      = bytearray()
+        self.__pos      = 0
+        self.__uploadId = None
+        self.__parts    = []
+        self.__aborted  = False
+        self.closed     = False
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self.__pos
+
+    def flush(self):
+        pass
+
+    def write(self, data) -> int:
+        if self.__aborted:
+            return len(memoryview(data).cast('B'))     #Discarded, see abort()
+        if self.closed:
+            raise ValueError("I/O operation on closed file s3://%s/%s" % (self.__bkt, self.__key))
+        view = memoryview(data).cast('B')
+        self.__buf.extend(view)
+        self.__pos += len(view)
+        while len(self.__buf) >= self.__partSize:
+            self.__uploadPart(bytes(self.__buf[:self.__partSize]))
+            del self.__buf[:self.__partSize]
+        return len(view)
+
+    def __uploadPart(self, body: bytes):
+        if self.__uploadId is None:
+            self.__uploadId = self.__s3.create_multipart_upload(Bucket=self.__bkt, Key=self.__key)['UploadId']
+        partNo = len(self.__parts) + 1
+        resp   = self.__s3.upload_part(Bucket=self.__bkt, Key=self.__key, UploadId=self.__uploadId,
+                                       PartNumber=partNo, Body=body)
+        self.__parts.append({'PartNumber': partNo, 'ETag': resp['ETag']})
+
+    def close(self):
+        ''' Upload the remaining bytes and complete the multipart upload '''
+        if self.closed:
+            return
+        try:
+            if self.__uploadId is None:
+                self.__s3.put_object(Bucket=self.__bkt, Key=self.__key, Body=bytes(self.__buf))
+            else:
+                if self.__buf:
+                    self.__uploadPart(bytes(self.__buf))
+                self.__s3.complete_multipart_upload(Bucket=self.__bkt, Key=self.__key, UploadId=self.__uploadId,
+                                                    MultipartUpload={'Parts': self.__parts})
+        except Exception:
+            try:
+                self.abort()
+            except Exception:
+                pass        #e.g. NoSuchUpload: keep the original error
+            raise
+        self.__buf      = bytearray()
+        self.__uploadId = None
+        self.closed     = True
+
+    def abort(self):
+        '''
+        Discard the upload. Nothing becomes visible at the key. The later writes (e.g. the footer of a
+        parquet writer closed after the abort) are dropped instead of raising.
+        '''
+        self.__aborted = True
+        self.__buf     = bytearray()
+        self.closed    = True
+        if self.__uploadId is not None:
+            uploadId, self.__uploadId = self.__uploadId, None
+            self.__s3.abort_multipart_upload(Bucket=self.__bkt, Key=self.__key, UploadId=uploadId)
+
 
 class S3:
-    def __init__(self,log : RootLogger,boto: bototSession):
+    def __init__(self,log : RootLogger,boto: bototSession, existCacheTTL: float = 5.0):
         self.log     = log
-        self.__s3    = boto.client('s3',config=Config(signature_version='s3v4'))
-        self.__s3Res = boto.resource('s3')
-        self._s3fs = S3FileSystem()
+        self.__boto  = boto
+        self.__s3    = REGISTRY.client(boto, 's3', signature_version='s3v4')
+        self.__existTTL   = existCacheTTL   #Seconds to trust an existence check. 0 disables the cache
+        self.__existCache = {}              #(kind, uri) -> (expiresAt, exists)
+        self.__existLock  = threading.Lock()
+
+    @property
+    def _s3fs(self):
+        ''' S3FileSystem under the session's credentials, created (s3fs imported) on first use '''
+        return REGISTRY.s3fs(self.__boto)
 
     def getBucketNKeyTuple(self,uriStr: str) -> (str,str)  :
         splt = uriStr.replace("s3://","").split("/")
@@ -23,20 +143,77 @@ class S3:
         key = "/".join(splt)
         return (bkt,key)
 
-    def isFolderPresent(self,uri: str) -> bool:
+    def isFolderPresent(self,uri: str, useCache: bool = True) -> bool:
+        '''Returns T/F whether the folder exists. Lists at most 2 keys (single request).'''
         (bkt,key) = self.getBucketNKeyTuple(uri)
         self.log.debug("bkt:%s - key:%s" % (bkt,key))
-        objs = list(self.__s3Res.Bucket(bkt).objects.filter(Prefix=key))
-        return len(objs) > 1
+        return self.__cachedExists('folder', bkt, key, useCache,
+                    lambda : self.__s3.list_objects_v2(Bucket=bkt, Prefix=key, MaxKeys=2).get('KeyCount', 0) > 1)
 
-    def isFilePresent(self,uri: str) -> bool:
-        '''Returns T/F whether the file exists.'''
+    def isFilePresent(self,uri: str, useCache: bool = True) -> bool:
+        '''Returns T/F whether the file exists. Uses a single `head_object` request.'''
         (bkt,key) = self.getBucketNKeyTuple(uri)
-        objs = list(self.__s3Res.Bucket(bkt).objects.filter(Prefix=key))
-        return len(objs) == 1 and objs[0].key == key
+        return self.__cachedExists('file', bkt, key, useCache, lambda : self.__headObject(bkt, key))
+
+    def __headObject(self, bkt: str, key: str) -> bool:
+        try:
+            self.__s3.head_object(Bucket=bkt, Key=key)
+            return True
+        except botoExc.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def __cachedExists(self, kind: str, bkt: str, key: str, useCache: bool, check) -> bool:
+        ''' Answer the existence check from the TTL cache, or run `check()` and remember the answer '''
+        cacheKey = (kind, "s3://%s/%s" % (bkt, key.rstrip("/")))
+        now      = time.time()
+        if useCache and self.__existTTL > 0:
+            with self.__existLock:
+                hit = self.__existCache.get(cacheKey)
+            if hit and hit[0] > now:
+                return hit[1]
+
+        exists = check()
+        if self.__existTTL > 0:
+            with self.__existLock:
+                self.__existCache[cacheKey] = (now + self.__existTTL, exists)
+        return exists
+
+    def invalidateExistCache(self, uri: str = None):
+        '''
+        Drop the cached existence checks for the uri, everything under it and its parent folders.
+        If uri is None, the whole cache is cleared.
+        '''
+        with self.__existLock:
+            if uri is None:
+                self.__existCache.clear()
+                return
+            (bkt,key) = self.getBucketNKeyTuple(uri)
+            prefix    = "s3://%s/%s" % (bkt, key.rstrip("/"))
+            for cacheKey in [k for k in self.__existCache
+                               if k[1].startswith(prefix) or prefix.startswith(k[1])]:
+                del self.__existCache[cacheKey]
+
 
+    def deleteObject(self, s3UriStr: str, recursive: bool = False,
+                           bulk      : bool = False,
+                           maxWorkers: int  = 8,
+                           maxReTry  : int  = 5,
+                           backoff   : float= 0.2) -> dict :
+        '''
+        Delete the object(s) matching the prefix of the s3 uri.
+        parms:
+            s3UriStr  : Full s3 uri of the object/prefix
+            recursive : Treat the uri as a folder and delete everything under it
+            bulk      : Use batched `delete_objects` calls (up to 1000 keys each) on a thread pool
+            maxWorkers: Max number of concurrent `delete_objects` calls (bulk only)
+            maxReTry  : Max re-tries of a throttled/failed batch (bulk only)
+            backoff   : Base seconds of the exponential backoff between re-tries (bulk only)
 
-    def deleteObject(self, s3UriStr: str, recursive: bool = False) :
+        Return,
+            Summary dict {'deleted': <int>, 'failed': <int>, 'retried': <int>, 'errors': [..]}
+        '''
         (bkt,key) = self.getBucketNKeyTuple(s3UriStr)
 
         if recursive  and  not key.endswith("/")  :
@@ -44,10 +221,92 @@ class S3:
         elif (not recursive) and key.endswith("/") :
             key = key[:-1]
 
-        keyLst = self.__s3Res.Bucket(bkt).objects.filter(Prefix="%s" % (key))
-        for i,k in enumerate(keyLst):
-            self.log.debug("%3d Deleting s3 Object: %s" % (i,k))
-            self.__s3.delete_object(Bucket=k.bucket_name,Key=k.key)
+        if bulk :
+            summary = self.__bulkDelete(bkt, key, maxWorkers, maxReTry, backoff)
+        else:
+            summary = {'deleted': 0, 'failed': 0, 'retried': 0, 'errors': []}
+            keyLst = REGISTRY.resource(self.__boto, 's3').Bucket(bkt).objects.filter(Prefix="%s" % (key))
+            for i,k in enumerate(keyLst):
+                self.log.debug("%3d Deleting s3 Object: %s" % (i,k))
+                self.__s3.delete_object(Bucket=k.bucket_name,Key=k.key)
+                summary['deleted'] += 1
+
+        self.invalidateExistCache("s3://%s/%s" % (bkt, key))
+        return summary
+
+    def listKeys(self, bkt: str, prefix: str):
+        ''' Generator of all the keys under the prefix (paged by `list_objects_v2`) '''
+        for page in self.__s3.get_paginator('list_objects_v2').paginate(Bucket=bkt, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def __bulkDelete(self, bkt: str, prefix: str, maxWorkers: int, maxReTry: int, backoff: float) -> dict:
+        ''' Group the keys under the prefix into batches of 1000 and delete them concurrently '''
+        summary = {'deleted': 0, 'failed': 0, 'retried': 0, 'errors': []}
+
+        def batches():
+            batch = []
+            for k in self.listKeys(bkt, prefix):
+                batch.append(k)
+                if len(batch) == MAX_KEYS_PER_DELETE:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as pool:
+            pending = []
+            for batch in batches():
+                pending.append(pool.submit(self.__deleteBatch, bkt, batch, maxReTry, backoff))
+                if len(pending) >= maxWorkers * 2 :    #Don't list far ahead of the deletes
+                    self.__mergeDeleteSummary(summary, pending.pop(0).result())
+            for f in pending:
+                self.__mergeDeleteSummary(summary, f.result())
+
+        self.log.info("Deleted %d objects under s3://%s/%s (failed: %d, retried: %d)" %
+                      (summary['deleted'], bkt, prefix, summary['failed'], summary['retried']))
+        return summary
+
+    @staticmethod
+    def __mergeDeleteSummary(summary: dict, res: dict):
+        for k in ('deleted', 'failed', 'retried'):
+            summary[k] += res[k]
+        summary['errors'].extend(res['errors'])
+
+    def __deleteBatch(self, bkt: str, keys: list, maxReTry: int, backoff: float) -> dict:
+        ''' Delete one batch of keys. Re-tries the throttled keys with exponential backoff + jitter. '''
+        res     = {'deleted': 0, 'failed': 0, 'retried': 0, 'errors': []}
+        attempt = 0
+        while keys:
+            errors = []
+            try:
+                resp = self.__s3.delete_objects(Bucket = bkt,
+                                                Delete = {'Objects': [{'Key': k} for k in keys],
+                                                          'Quiet'  : True})
+                errors = resp.get('Errors', [])
+                res['deleted'] += len(keys) - len(errors)
+            except botoExc.ClientError as e:
+                code   = e.response.get('Error', {}).get('Code', '')
+                errors = [{'Key': k, 'Code': code, 'Message': str(e)} for k in keys]
+
+            retry = [e['Key'] for e in errors if e.get('Code') in RETRYABLE_S3_ERRORS]
+            fatal = [e        for e in errors if e.get('Code') not in RETRYABLE_S3_ERRORS]
+            if retry and attempt >= maxReTry:
+                fatal.extend(e for e in errors if e.get('Code') in RETRYABLE_S3_ERRORS)
+                retry = []
+
+            for e in fatal:
+                self.log.warning("Failed to delete s3://%s/%s : %s - %s" %
+                                 (bkt, e.get('Key'), e.get('Code'), e.get('Message')))
+            res['failed'] += len(fatal)
+            res['errors'].extend(fatal)
+
+            if retry:
+                attempt += 1
+                res['retried'] += len(retry)
+                time.sleep(backoff * (2 ** (attempt - 1)) * (1 + random.random()))
+            keys = retry
+        return res
 
     def mkdir(self,path):
         if not self._s3fs.exists(path):
@@ -57,6 +316,7 @@ class S3:
 
             except OSError:
                 assert self._s3fs.exists(path)
+        self.invalidateExistCache(path)
 
 
     def waitForFile(self,uri:str, maxReTry : int = 10, sleepFor : int = 10) -> bool:
@@ -76,12 +336,13 @@ class S3:
         while found == False and cnt < maxReTry :
             cnt += 1
             time.sleep(sleepFor)
-            if self.isFilePresent(uri) :
+            if self.isFilePresent(uri, useCache = False) :
                 found = True
             else:
-                cnt += 1
-                self.log.DEBUG("Still waiting for the file.")
-        self.log.info("File found.")
+                self.log.debug("Still waiting for the file.")
+        if found:
+            self.log.info("File found.")
+        return found
 
     def df2parquet(self,pandasDF, bucket:str,folder:str, file:str, overwrite:bool = False,
                      engine           : str  = 'auto',
@@ -105,9 +366,272 @@ class S3:
                             coerce_timestamps         = coerce_timestamps, #Limit the timestamp to miliseconds
                             allow_truncated_timestamps=True,               #Don't raise exception during truncation
                             use_dictionary            = use_dictionary,
-                            version                   = '2.0'
+                            version                   = parquetVersion()
         )
+        self.invalidateExistCache(s3Path)
+
+
+    def putBytes(self, uri: str, data):
+        ''' Upload the bytes/pyarrow Buffer as a single object (single PUT, i.e. atomic) '''
+        (bkt,key) = self.getBucketNKeyTuple(uri)
+        body      = pa.BufferReader(data) if isinstance(data, pa.Buffer) else data
+        self.__s3.put_object(Bucket=bkt, Key=key, Body=body)
+        self.invalidateExistCache(uri)
+
+    def table2ParquetBuffer(self, table,
+                                  compression      : str  = 'snappy',
+                                  use_dictionary   : bool = False,
+                                  coerce_timestamps: str  = 'ms',
+                                  row_group_size   : int  = None,
+                                  **kwargs):
+        ''' Serialize the arrow table into an in-memory parquet file (pyarrow Buffer) '''
+        sink = pa.BufferOutputStream()
+        pq.write_table(table                     = table,
+                       where                     = sink,
+                       compression               = compression,
+                       flavor                    = 'spark',           #Enable Spark compatibility
+                       coerce_timestamps         = coerce_timestamps, #Limit the timestamp to miliseconds
+                       allow_truncated_timestamps= True,              #Don't raise exception during truncation
+                       use_dictionary            = use_dictionary,
+                       row_group_size            = row_group_size,
+                       version                   = parquetVersion(),
+                       **kwargs)
+        return sink.getvalue()
 
+    def readParquet(self, uri: str, columns: list = None):
+        ''' Read one parquet object into an arrow Table (single GET, no s3fs) '''
+        (bkt,key) = self.getBucketNKeyTuple(uri)
+        body = self.__s3.get_object(Bucket=bkt, Key=key)['Body'].read()
+        return pq.read_table(pa.BufferReader(body), columns=columns)
+
+    def putParquet(self, table, uri: str, **kwargs) -> int:
+        ''' Write the arrow table as one parquet object. Returns the size of the object in bytes. '''
+        buf = self.table2ParquetBuffer(table, **kwargs)
+        self.putBytes(uri, buf)
+        return buf.size
+
+    @staticmethod
+    def splitByPartition(table, partition_cols: list):
+        '''
+        Generator of (partitionValues, subTable) for the arrow table.
+        The table is sorted once by the partition columns and sliced at the boundaries of the
+        sorted runs, so each sub table is a zero-copy slice without the partition columns.
+        '''
+        n = table.num_rows
+        if n == 0:
+            return
+        table   = table.sort_by([(c, 'ascending') for c in partition_cols])
+        changed = np.zeros(n - 1, dtype=bool)
+        for c in partition_cols:
+            col = table.column(c).combine_chunks()
+            if pa.types.is_dictionary(col.type):
+                col = col.cast(col.type.value_type)
+            nxt, cur = col.slice(1), col.slice(0, n - 1)
+            changed |= pc.or_(pc.fill_null(pc.not_equal(nxt, cur), False),
+                              pc.xor(pc.is_null(nxt), pc.is_null(cur))).to_numpy(zero_copy_only=False)
+
+        starts = [0] + (np.flatnonzero(changed) + 1).tolist()
+        ends   = starts[1:] + [n]
+        data   = table.select([c for c in table.schema.names if c not in partition_cols])
+        for start, end in zip(starts, ends):
+            keys = tuple(table.column(c)[start].as_py() for c in partition_cols)
+            yield keys, data.slice(start, end - start)
+
+    def pandas2ParquetPipelined(self,pandasDF, bucket:str,folder:str, file:str, overwrite:bool = False,
+                     compression      : str  = 'snappy',
+                     use_dictionary   : bool = False,
+                     coerce_timestamps: str  = 'ms',
+                     partition_cols   : list = None,
+                     row_group_size   : int  = None,
+                     maxWorkers       : int  = 8,
+                     maxInFlightBytes : int  = 256 * 1024 * 1024,
+                     writeSuccess     : bool = True,
+                     **kwargs
+                    ) -> dict:
+        '''
+        Write the Pandas DF (or arrow Table) as a partitioned parquet dataset, serializing and
+        uploading the partitions concurrently.
+        parms:
+            maxWorkers      : Number of partitions serialized/uploaded at the same time
+            maxInFlightBytes: Cap on the (arrow) bytes of the partitions being serialized/uploaded
+            writeSuccess    : Write the '_SUCCESS' manifest once all the partitions are uploaded
+
+        Return,
+            Report dict {'path', 'files', 'rows', 'bytes', 'elapsed', 'partitions' : [per partition timings]}
+        '''
+        s3Path =      "s3://%s/%s/%s" % (bucket, folder, file) if folder != None \
+                 else "s3://%s/%s" % (bucket, file)
+        self.log.info("Writing the Pandas DF to S3 path %s (%d workers)" % (s3Path, maxWorkers))
+        start = time.time()
+
+        table = pandasDF if isinstance(pandasDF, pa.Table) \
+                else pa.Table.from_pandas(pandasDF, preserve_index=False, nthreads=5)
+        partition_cols = partition_cols or []
+        if partition_cols and len(table.schema.names) == len(partition_cols):
+            raise ValueError('No data left to save outside partition columns')
+
+        if overwrite and self.isFolderPresent(s3Path, useCache=False):
+            self.deleteObject(s3Path, recursive=True, bulk=True)
+
+        parquetArgs = dict(compression      = compression,
+                           use_dictionary   = use_dictionary,
+                           coerce_timestamps= coerce_timestamps,
+                           row_group_size   = row_group_size, **kwargs)
+        budget   = threading.Condition()
+        inFlight = [0]
+
+        def upload(subdir, subtable, size):
+            try:
+                t0   = time.time()
+                buf  = self.table2ParquetBuffer(subtable, **parquetArgs)
+                t1   = time.time()
+                path = '/'.join([p for p in (s3Path, subdir) if p] +
+                                ["pyarow-%s.%s.parquet" % (guid(), compression)])
+                self.putBytes(path, buf)
+                t2   = time.time()
+                self.log.debug("Created the file: %s (%.3fs serialize, %.3fs upload)" % (path, t1 - t0, t2 - t1))
+                return {'partition'   : subdir,
+                        'file'        : path,
+                        'rows'        : subtable.num_rows,
+                        'bytes'       : buf.size,
+                        'serializeSec': round(t1 - t0, 3),
+                        'uploadSec'   : round(t2 - t1, 3)}
+            finally:
+                with budget:
+                    inFlight[0] -= size
+                    budget.notify_all()
+
+        parts = self.splitByPartition(table, partition_cols) if partition_cols else [((), table)]
+        futures = []
+        with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as pool:
+            for keys, subtable in parts:
+                subdir = '/'.join(['%s=%s' % (name, HIVE_NULL_PARTITION if val is None else val)
+                                   for name, val in zip(partition_cols, keys)])
+                size = subtable.nbytes
+                with budget:    #A partition bigger than the cap is still sent, but alone.
+                    budget.wait_for(lambda : inFlight[0] == 0 or inFlight[0] + size <= maxInFlightBytes)
+                    inFlight[0] += size
+                futures.append(pool.submit(upload, subdir, subtable, size))
+            timings = [f.result() for f in futures]
+
+        report = {'path'      : s3Path,
+                  'files'     : [t['file'] for t in timings],
+                  'rows'      : sum(t['rows']  for t in timings),
+                  'bytes'     : sum(t['bytes'] for t in timings),
+                  'elapsed'   : round(time.time() - start, 3),
+                  'partitions': timings}
+        if writeSuccess:
+            self.putBytes("%s/_SUCCESS" % (s3Path), json.dumps(report, indent=1).encode('utf-8'))
+
+        self.invalidateExistCache(s3Path)
+        self.log.info("Wrote %d rows in %d files to %s in %.3fs" %
+                      (report['rows'], len(timings), s3Path, report['elapsed']))
+        return report
+
+    def writeParquetStream(self, batches, bucket:str, folder:str, file:str,
+                     schema           = None,
+                     compression      : str  = 'snappy',
+                     use_dictionary   : bool = False,
+                     coerce_timestamps: str  = 'ms',
+                     row_group_size   : int  = None,
+                     partSize         : int  = 64 * 1024 * 1024,
+                     targetFileSize   : int  = 1024 * 1024 * 1024,
+                     writeSuccess     : bool = True,
+                     **kwargs
+                    ) -> list:
+        '''
+        Stream an iterator of Pandas DFs / arrow RecordBatches / arrow Tables into parquet files.
+        Each item becomes (at least) one row group; the bytes go straight into an S3 multipart
+        upload, so at most one part (+ the row group being encoded) is held in memory.
+        parms:
+            schema        : arrow schema of the data. Defaults to the schema of the first batch.
+            partSize      : Size of the multipart upload parts (min 5MB)
+            targetFileSize: Roll over to a new file once the current one reaches this size
+            writeSuccess  : Write the '_SUCCESS' manifest once all the files are completed
+
+        On failure the open upload is aborted and the files already completed by this call are deleted,
+        so a failed stream leaves nothing under the path; the original error is re-raised.
+
+        Return,
+            List of the s3 uri of the files written
+        '''
+        s3Path =      "s3://%s/%s/%s" % (bucket, folder, file) if folder != None \
+                 else "s3://%s/%s" % (bucket, file)
+        self.log.info("Streaming parquet to S3 path %s" % (s3Path))
+        (bkt,key) = self.getBucketNKeyTuple(s3Path)
+        prefix    = "pyarow-stream-%s" % (guid())
+        files     = []
+        rows      = 0
+        writer    = None
+        sink      = None
+
+        try:
+            for batch in batches:
+                if isinstance(batch, pa.Table):
+                    tbl = batch
+                elif isinstance(batch, pa.RecordBatch):
+                    tbl = pa.Table.from_batches([batch])
+                else:
+                    tbl = pa.Table.from_pandas(batch, schema=schema, preserve_index=False)
+                schema = schema or tbl.schema
+                if tbl.num_rows == 0:
+                    continue
+
+                if writer is None:
+                    fileKey = "%s/%s-%05d.%s.parquet" % (key, prefix, len(files), compression)
+                    sink    = S3MultipartFile(self.__s3, bkt, fileKey, partSize)
+                    writer  = pq.ParquetWriter(sink, schema,
+                                               compression               = compression,
+                                               flavor                    = 'spark',           #Enable Spark compatibility
+                                               coerce_timestamps         = coerce_timestamps, #Limit the timestamp to miliseconds
+                                               allow_truncated_timestamps= True,              #Don't raise exception during truncation
+                                               use_dictionary            = use_dictionary,
+                                               version                   = parquetVersion(),
+                                               **kwargs)
+                writer.write_table(tbl, row_group_size=row_group_size)
+                rows += tbl.num_rows
+
+                if sink.tell() >= targetFileSize:
+                    writer.close()
+                    sink.close()
+                    files.append("s3://%s/%s" % (bkt, fileKey))
+                    self.log.debug("Completed the file: %s (%d bytes)" % (files[-1], sink.tell()))
+                    writer = None
+                    sink   = None
+
+            if writer is not None:
+                writer.close()
+                sink.close()
+                files.append("s3://%s/%s" % (bkt, fileKey))
+                writer = None
+                sink   = None
+        except Exception:
+            if sink is not None:
+                try:
+                    sink.abort()
+                except Exception as e:
+                    self.log.warning("Could not abort the upload of %s: %s" % (fileKey, e))
+            if writer is not None:
+                try:
+                    writer.close()      #Release the native writer now (its footer goes to the aborted sink), not at GC
+                except Exception as e:
+                    self.log.debug("Could not close the parquet writer of %s: %s" % (fileKey, e))
+            for i in range(0, len(files), MAX_KEYS_PER_DELETE):
+                try:
+                    self.__s3.delete_objects(Bucket=bkt, Delete={'Objects': [{'Key': self.getBucketNKeyTuple(f)[1]}
+                                                                            for f in files[i:i + MAX_KEYS_PER_DELETE]],
+                                                                 'Quiet': True})
+                except Exception as e:
+                    self.log.warning("Could not delete the files of the failed stream %s: %s" % (s3Path, e))
+            raise
+
+        if writeSuccess:
+            self.putBytes("%s/_SUCCESS" % (s3Path), json.dumps({'path' : s3Path,
+                                                                'rows' : rows,
+                                                                'files': files}, indent=1).encode('utf-8'))
+        self.invalidateExistCache(s3Path)
+        self.log.info("Streamed %d rows in %d files to %s" % (rows, len(files), s3Path))
+        return files
 
     def pandas2Parquet(self,pandasDF, bucket:str,folder:str, file:str, overwrite:bool = False,
                      engine           : str  = 'auto',
@@ -123,7 +647,7 @@ class S3:
         self.log.info("Writing the Pandas DF to S3 path %s" % (s3Path))
 
         if overwrite and self.isFolderPresent(s3Path):
-            self.deleteObject(s3Path)
+            self.deleteObject(s3Path, bulk=True)
 
         if partition_cols is not None and len(partition_cols) > 0:
             part_keys = [pandasDF[col] for col in partition_cols]
@@ -152,7 +676,7 @@ class S3:
                 prefix = '/'.join([s3Path, subdir])
 
                 if (not overwrite) and self.isFolderPresent(prefix):
-                    self.deleteObject(prefix)
+                    self.deleteObject(prefix, recursive=True, bulk=True)
 
                 outfile   = "pyarow-%s.%s.parquet" % (guid() ,compression)
                 full_path = '/'.join([prefix, outfile])
@@ -167,11 +691,11 @@ class S3:
                                    allow_truncated_timestamps= True,              #Don't raise exception during truncation
                                    use_dictionary            = use_dictionary,
                                    row_group_size            = row_group_size,
-                                   version                   = '2.0',
+                                   version                   = parquetVersion(),
                                    **kwargs)
         else:
             outfile   = "pyarow-single-%s.%s.parquet" % ( guid() ,compression)
-            full_path = '/'.join([prefix, outfile])
+            full_path = '/'.join([s3Path, outfile])
             self.log.debug("Creating the file: %s" % (full_path))
             with self._s3fs.open(full_path, 'wb') as f:
                 pq.write_table(table                     = pa.Table.from_pandas(df = pandasDF,
@@ -185,9 +709,11 @@ class S3:
                                 allow_truncated_timestamps= True,              #Don't raise exception during truncation
                                 use_dictionary            = use_dictionary,
                                 row_group_size            = row_group_size,
-                                version                   = '2.0',
+                                version                   = parquetVersion(),
                                 **kwargs)
 
+        self.invalidateExistCache(s3Path)
+
         #df.to_parquet(fname          = s3Path,
         #              compression    = compression,
         #              partition_cols = partition_cols
@@ -1,26 +1,182 @@
 from __future__ import print_function # Python 2/3 compatibility
-import time,uuid
+import time,uuid,os,json,base64,hashlib,threading
+from concurrent.futures import ThreadPoolExecutor
+from .clients import REGISTRY
 #from  sts import STS    # --> uncomment this line if you are running with main()
 
+MAX_NAMES_PER_GET = 10      #get_parameters limit
+
+class ParameterCache:
+    '''
+    TTL cache of the decrypted parameters, keyed by (scope, name). The SSM objects use the region and the
+    caller identity as scope, so a value read under one account/role is never served to another one.
+    With diskPath set, the entries are also kept in a local file encrypted with Fernet (needs the
+    optional `cryptography` package) so the executors/processes of one host share the lookups.
+    The key is read from the environment variable `keyEnv` (any secret string, hashed into a Fernet key).
+    '''
+    def __init__(self, ttl: float = 300, diskPath: str = None, keyEnv: str = 'PYHELPER_SSM_CACHE_KEY'):
+        self.ttl       = ttl
+        self.diskPath  = diskPath
+        self.__entries = {}                #(scope, name) -> (expiresAt, entry)
+        self.__lock    = threading.Lock()
+        self.__fernet  = None
+        self.__loaded  = False
+        if diskPath:
+            try:
+                from cryptography.fernet import Fernet
+            except ImportError:
+                raise ImportError("ParameterCache(diskPath=...) needs the cryptography package")
+            secret = os.environ.get(keyEnv)
+            if not secret:
+                raise ValueError("ParameterCache(diskPath=...) needs the encryption key in $%s" % keyEnv)
+            self.__fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode('utf-8')).digest()))
+
+    def get(self, scope: str, names: list) -> (dict, list):
+        ''' Return ({name: entry} of the live entries, [names missing or expired]) '''
+        now = time.time()
+        self.__loadDisk(now)
+        found, missing = {}, []
+        with self.__lock:
+            for name in names:
+                hit = self.__entries.get((scope, name))
+                if hit and hit[0] > now:
+                    found[name] = hit[1]
+                else:
+                    missing.append(name)
+        return found, missing
+
+    def put(self, scope: str, entries: dict):
+        if not entries:
+            return
+        expiresAt = time.time() + self.ttl
+        with self.__lock:
+            for name, entry in entries.items():
+                self.__entries[(scope, name)] = (expiresAt, entry)
+        if self.__fernet:
+            self.__writeDisk()
+
+    def invalidate(self, scope: str = None, name: str = None):
+        ''' Drop one parameter, one scope or (no args) everything '''
+        with self.__lock:
+            for key in [k for k in self.__entries
+                        if (scope is None or k[0] == scope) and (name is None or k[1] == name)]:
+                del self.__entries[key]
+        if self.__fernet:
+            self.__writeDisk()
+
+    def __loadDisk(self, now: float, force: bool = False):
+        ''' Merge the live entries of the disk file (once, or on every write to pick the other processes\' entries) '''
+        if not self.__fernet or (self.__loaded and not force) or not os.path.exists(self.diskPath):
+            self.__loaded = True
+            return
+        try:
+            with open(self.diskPath, 'rb') as f:
+                rows = json.loads(self.__fernet.decrypt(f.read()).decode('utf-8'))
+        except Exception:
+            rows = []           #Corrupted file or rotated key: start over
+        with self.__lock:
+            for scope, name, expiresAt, entry in rows:
+                key = (scope, name)
+                if expiresAt > now and (key not in self.__entries or self.__entries[key][0] < expiresAt):
+                    self.__entries[key] = (expiresAt, entry)
+            self.__loaded = True
+
+    def __writeDisk(self):
+        ''' Write to a temp file (owner only) and rename it, so a concurrent reader never sees a partial file '''
+        now = time.time()
+        self.__loadDisk(now, force=True)
+        with self.__lock:
+            rows = [[k[0], k[1], v[0], v[1]] for k, v in self.__entries.items() if v[0] > now]
+        tmp = "%s.%s.tmp" % (self.diskPath, uuid.uuid4().hex)
+        fd  = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.__fernet.encrypt(json.dumps(rows).encode('utf-8')))
+        os.replace(tmp, self.diskPath)
+
+PARAMETER_CACHE = ParameterCache()
 
 class SSM:
-    def __init__(self, botoSession):
-        self.__ssm = botoSession.client('ssm')
+    def __init__(self, botoSession, cache: ParameterCache = PARAMETER_CACHE, maxWorkers: int = 4):
+        '''
+            cache     : ParameterCache shared by the SSM objects of the process (None to always call SSM)
+            maxWorkers: Concurrent get_parameters calls when more than 10 names are asked
+        '''
+        self.__boto       = botoSession
+        self.__ssm        = REGISTRY.client(botoSession, 'ssm')
+        self.__region     = self.__ssm.meta.region_name
+        self.__scope      = None
+        self.__cache      = cache
+        self.__maxWorkers = maxWorkers
 
+    @property
+    def scope(self) -> str:
+        '''
+        Cache scope: region and caller ARN (one sts:GetCallerIdentity call, on the first cached lookup).
+        Falls back to the access key when STS can't be reached.
+        '''
+        if self.__scope is None:
+            try:
+                identity = REGISTRY.client(self.__boto, 'sts').get_caller_identity()['Arn']
+            except Exception:
+                creds    = self.__boto.get_credentials()
+                identity = "key:%s" % (creds.access_key if creds else None)
+            self.__scope = "%s|%s" % (self.__region, identity)
+        return self.__scope
 
-    def get_parm(self,names) :
-        if isinstance(names,list) :
-            res = self.__ssm.get_parameters(Names=names, WithDecryption=True)
+
+    def get_parm(self, names, useCache: bool = True) -> dict:
+        '''
+        Decrypted values of one name or a list of names as {name: {'Type', 'Value'}}.
+        Names which don't exist are left out. The names are fetched in chunks of 10, concurrently.
+        '''
+        names = list(dict.fromkeys(names if isinstance(names, list) else [names]))
+        r     = {}
+        if useCache and self.__cache:
+            r, names = self.__cache.get(self.scope, names)
+        if not names:
+            return r
+
+        chunks = [names[i:i + MAX_NAMES_PER_GET] for i in range(0, len(names), MAX_NAMES_PER_GET)]
+        if len(chunks) == 1:
+            fetched = self.__getChunk(chunks[0])
         else:
-            res = self.__ssm.get_parameters(Names= [names], WithDecryption=True)
+            fetched = {}
+            with ThreadPoolExecutor(max_workers=max(1, min(self.__maxWorkers, len(chunks)))) as pool:
+                for res in pool.map(self.__getChunk, chunks):
+                    fetched.update(res)
 
-        r = {}
+        if self.__cache:
+            self.__cache.put(self.scope, fetched)
+        r.update(fetched)
+        return r
 
-        for x in res['Parameters']:
-            r [x['Name'] ] = {'Type' : x['Type'], 'Value': x['Value'] }
+    def get_by_path(self, path: str, recursive: bool = True, useCache: bool = True) -> dict:
+        '''
+        Decrypted values of all the parameters under `path` as {name: {'Type', 'Value'}}.
+        The listing itself is cached as well, under the path.
+        '''
+        listKey = "path:%s:%s" % (path, recursive)
+        if useCache and self.__cache:
+            found, _ = self.__cache.get(self.scope, [listKey])
+            if listKey in found:
+                r, missing = self.__cache.get(self.scope, found[listKey])
+                if not missing:
+                    return r
 
+        r = {}
+        paginator = self.__ssm.get_paginator('get_parameters_by_path')
+        for page in paginator.paginate(Path=path, Recursive=recursive, WithDecryption=True):
+            for x in page['Parameters']:
+                r[x['Name']] = {'Type': x['Type'], 'Value': x['Value']}
+
+        if self.__cache:
+            self.__cache.put(self.scope, dict(r, **{listKey: sorted(r)}))
         return r
 
+    def __getChunk(self, names: list) -> dict:
+        res = self.__ssm.get_parameters(Names=names, WithDecryption=True)
+        return {x['Name']: {'Type': x['Type'], 'Value': x['Value']} for x in res['Parameters']}
+
 
 '''
 def main():
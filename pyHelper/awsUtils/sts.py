@@ -1,26 +1,189 @@
-import os,sys, time,requests, re, getpass,base64
-from boto3 import client as botoClient
-from boto3 import Session as botoSession
-from botocore.session import get_session
-from bs4 import BeautifulSoup
+from __future__ import annotations
+import os,sys, time, re, getpass,base64, threading, datetime, logging, configparser
+from html.parser import HTMLParser
 from urllib.parse import urlparse
 from xml.etree import ElementTree as ET
-from botocore.credentials import RefreshableCredentials
-try:
-    import configParser
-except:
-    from six.moves import configparser
+from typing import TYPE_CHECKING
+from .._lazy import lazyImport
+requests  = lazyImport('requests')
+boto3     = lazyImport('boto3')
+botoCore  = lazyImport('botocore.session')
+botoCreds = lazyImport('botocore.credentials')
+bs4       = lazyImport('bs4')
+if TYPE_CHECKING:
+    from botocore.credentials import RefreshableCredentials
+
+class CredentialCache:
+    '''
+    Process wide cache of the RefreshableCredentials keyed by (roleArn, region, authType), shared by all
+    the STS instances (and so by every helper built on their boto sessions).
+    Each entry put with backgroundRefresh is refreshed in a background (daemon) timer shortly before
+    botocore would refresh it in the caller's thread. botocore's refresh lock + the per key creation lock make sure only one
+    thread calls STS at a time for a key.
+    A failed background refresh is re-tried with an exponential backoff (RETRY_BASE_SECS doubling up to
+    RETRY_MAX_SECS); once the credentials are expired and the refresh still fails the entry is dropped.
+    '''
+    #botocore refreshes synchronously once the credentials expire in less than 15 minutes
+    ADVISORY_REFRESH_SECS = 15 * 60
+    RETRY_BASE_SECS       = 30
+    RETRY_MAX_SECS        = 10 * 60
+
+    def __init__(self):
+        self.__entries  = {}
+        self.__keyLocks = {}
+        self.__lock     = threading.Lock()
+        self.__log      = logging.getLogger(__name__)
+
+    def keyLock(self, key: tuple):
+        ''' Lock to hold while building the credentials of the key '''
+        with self.__lock:
+            return self.__keyLocks.setdefault(key, threading.Lock())
+
+    def get(self, key: tuple):
+        with self.__lock:
+            return self.__entries.get(key)
+
+    def put(self, key: tuple, creds: RefreshableCredentials, backgroundRefresh: bool = True):
+        with self.__lock:
+            self.__entries[key] = creds
+        if backgroundRefresh:
+            self.__schedule(key, creds)
+
+    def invalidate(self, key: tuple = None):
+        with self.__lock:
+            if key is None:
+                self.__entries.clear()
+            else:
+                self.__entries.pop(key, None)
+
+    def __schedule(self, key: tuple, creds: RefreshableCredentials, failures: int = 0):
+        expiry = getattr(creds, '_expiry_time', None)
+        if expiry is None:
+            return
+        if failures:
+            delay = min(CredentialCache.RETRY_MAX_SECS, CredentialCache.RETRY_BASE_SECS * 2 ** (failures - 1))
+        else:
+            now   = datetime.datetime.now(expiry.tzinfo)
+            delay = max(1, (expiry - now).total_seconds() - CredentialCache.ADVISORY_REFRESH_SECS + 5)
+        timer = threading.Timer(delay, self.__refresh, (key, creds, failures))
+        timer.daemon = True
+        timer.start()
+
+    def __refresh(self, key: tuple, creds: RefreshableCredentials, failures: int = 0):
+        if self.get(key) is not creds:
+            return      #Replaced/invalidated meanwhile
+        before = getattr(creds, '_expiry_time', None)
+        error  = None
+        try:
+            creds.get_frozen_credentials()  #Refreshes (under botocore's lock) as we are in the advisory window
+        except Exception as e:
+            error = e
+        after = getattr(creds, '_expiry_time', None)
+        if error is None and (before is None or after is None or after > before):
+            self.__schedule(key, creds)
+            return
+
+        #botocore only logs a failed advisory refresh: the expiry not moving is a failure too
+        error = error or "the expiry was not extended"
+        if after is not None and after <= datetime.datetime.now(after.tzinfo):
+            self.__log.warning("Background refresh of the expired credentials for %s failed, dropping them: %s"
+                               % (key[0], error))
+            with self.__lock:
+                if self.__entries.get(key) is creds:
+                    del self.__entries[key]
+            return
+        self.__log.warning("Background refresh of the credentials for %s failed (attempt %d): %s"
+                           % (key[0], failures + 1, error))
+        self.__schedule(key, creds, failures + 1)
+
+CREDENTIAL_CACHE = CredentialCache()
+
+__stsClients     = {}
+__stsClientsLock = threading.Lock()
+
+def getStsClient(region: str):
+    ''' STS client of the region, shared by all the STS instances '''
+    with __stsClientsLock:
+        if region not in __stsClients:
+            __stsClients[region] = boto3.client("sts", region_name=region)
+        return __stsClients[region]
+
+SAML_ATTRIBUTE       = '{urn:oasis:names:tc:SAML:2.0:assertion}Attribute'
+SAML_ATTRIBUTE_VALUE = '{urn:oasis:names:tc:SAML:2.0:assertion}AttributeValue'
+SAML_ROLE_ATTRIBUTE  = 'https://aws.amazon.com/SAML/Attributes/Role'
+PRINCIPAL_ARN_CACHE  = {}     #roleArn -> PrincipalArn (saml-provider) resolved from an assertion
+
+class HTMLFormExtractor(HTMLParser):
+    '''
+    Streaming extractor of the <input> (name, value) and <form> (id, action) tags of a HTML page.
+    If stopAtInput is set, parsing stops as soon as an input with that name is seen.
+    '''
+    def __init__(self, stopAtInput: str = None):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.inputs   = []
+        self.forms    = []
+        self.found    = False
+        self.__stopAt = stopAtInput
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'input':
+            attrs = dict(attrs)
+            self.inputs.append((attrs.get('name') or '', attrs.get('value') or ''))
+            if self.__stopAt and attrs.get('name') == self.__stopAt:
+                self.found = True
+        elif tag == 'form':
+            attrs = dict(attrs)
+            self.forms.append((attrs.get('id'), attrs.get('action')))
+
+    def parse(self, text: str, chunkSize: int = 16384):
+        for i in range(0, len(text), chunkSize):
+            self.feed(text[i:i + chunkSize])
+            if self.found:
+                break
+        return self
+
+def extractFormTags(html: str, stopAtInput: str = None, fastParse: bool = True) -> (list, list):
+    ''' Returns the ([(name, value)] of the inputs, [(id, action)] of the forms) of the HTML page '''
+    if fastParse:
+        parser = HTMLFormExtractor(stopAtInput).parse(html)
+        return (parser.inputs, parser.forms)
+    soup = bs4.BeautifulSoup(html, "lxml")
+    return ([(t.get('name',''), t.get('value','')) for t in soup.find_all(re.compile('(INPUT|input)'))],
+            [(t.get('id'), t.get('action'))        for t in soup.find_all(re.compile('(FORM|form)'))])
+
+def findPrincipalArn(assertion: str, roleArn: str, chunkSize: int = 4096) -> (str, list):
+    '''
+    Scan the (base64) SAML assertion with an incremental (iterparse style) pull parser, fed in chunks,
+    and stop at the Role attribute value of the roleArn.
+    Returns (PrincipalArn or '', role values seen so far)
+    '''
+    awsroles = []
+    inRole   = False
+    xml      = base64.b64decode(assertion)
+    parser   = ET.XMLPullParser(events=('start', 'end'))
+    for i in range(0, len(xml), chunkSize):
+        parser.feed(xml[i:i + chunkSize])
+        for event, elem in parser.read_events():
+            if elem.tag == SAML_ATTRIBUTE:
+                inRole = event == 'start' and elem.get('Name') == SAML_ROLE_ATTRIBUTE
+            elif event == 'end' and inRole and elem.tag == SAML_ATTRIBUTE_VALUE:
+                txt = elem.text or ''
+                awsroles.append(txt)
+                if roleArn in txt:
+                    chunks = txt.split(',')
+                    return (chunks[0] if 'saml-provider' in chunks[0] else chunks[1], awsroles)
+    return ('', awsroles)
 
 class STS:
     def __init__(self, region=None, roleArn=None, duration=3600,
-                 user=None, pwd=None, authType=None, idpentryurl=None):
+                 user=None, pwd=None, authType=None, idpentryurl=None, fastParse=True):
         self.__region                = region or "us-east-1"
         self.__duration              = duration
         self.__authType              = authType or 'InstanceProfile'
         if roleArn != None:
             self.__roleArn = roleArn
         elif self.__authType == 'InstanceProfile' :
-            self.__roleArn = botoSession(region_name=self.__region)
+            self.__roleArn = boto3.Session(region_name=self.__region)
 
         self.__payload               = {}
         self.__credentials           = {}
@@ -35,19 +198,23 @@ class STS:
         self.__params                = {"RoleArn": self.__roleArn,"DurationSeconds": self.__duration}
         self.__useSAML               = True if authType == 'SAML' else False
         self.__awsconfigfile         = os.path.expanduser("~") + '/.aws/credentials' if self.__useSAML else ''
-        self.__req_session = requests.Session() # Initiate session handler
-        self.__stsClient             = botoClient("sts", region_name=self.__region)
-
-        if self.__useSAML :
-            if user == None:
-                print("\nUsername (domain\\userId):", end=''),
-                self.__user = input()
-                self.__pwd = getpass.getpass()
-                print("")
-            if self.__pwd == None:
-                print("\nPlease enter the credentials for the user {}".format(self.__user))
-                self.__pwd = getpass.getpass()
-                print("")
+        self.__fastParse             = fastParse    #Stdlib streaming parsers instead of BeautifulSoup/lxml + full XML tree
+        self.__req_session           = None     #requests.Session, opened on the first SAML login
+        self.__stsClient             = getStsClient(self.__region)
+        self.__cacheKey              = (str(self.__roleArn), self.__region, self.__authType)
+        self.__log                   = logging.getLogger(__name__)
+
+    def __promptCredentials__(self):
+        ''' Ask for the user/password, only when a SAML login is really needed '''
+        if self.__user == None:
+            print("\nUsername (domain\\userId):", end=''),
+            self.__user = input()
+            self.__pwd = getpass.getpass()
+            print("")
+        if self.__pwd == None:
+            print("\nPlease enter the credentials for the user {}".format(self.__user))
+            self.__pwd = getpass.getpass()
+            print("")
 
     def __call__(self, assume=True,region=None):
         self.assume_role()
@@ -55,16 +222,16 @@ class STS:
     def __setIDPAuthUrlAndPayload__(self):
         ''' Using the base URL, derive the final IDP Authorization Submit URL'''
         # Programmatically get the SAML assertion
+        if self.__req_session is None:
+            self.__req_session = requests.Session() # Initiate session handler
         formresponse = self.__req_session.get(self.__idpentryurl, verify=True)
         self.__idpauthformsubmiturl = formresponse.url    #final url after all the 302s
 
         # Parse the response and extract all the necessary values
         # in order to build a dictionary of all of the form values the IdP expects
-        formsoup = BeautifulSoup(formresponse.text, "lxml")
+        (inputs, forms) = extractFormTags(formresponse.text, fastParse=self.__fastParse)
         self.__payload = {}
-        for inputtag in formsoup.find_all(re.compile('(INPUT|input)')):
-            name = inputtag.get('name','')
-            value = inputtag.get('value','')
+        for (name, value) in inputs:
             if "user" in name.lower():
                 self.__payload[name] = self.__user #Make an educated guess that this is the right field for the username
             elif "email" in name.lower():
@@ -79,9 +246,7 @@ class STS:
         # from the entry url with the form action target
         # If the action tag doesn't exist, we just stick with the
         # idpauthformsubmiturl above
-        for inputtag in formsoup.find_all(re.compile('(FORM|form)')):
-            action = inputtag.get('action')
-            loginid = inputtag.get('id')
+        for (loginid, action) in forms:
             if (action and loginid == "loginForm"):
                 parsedurl = urlparse(self.__idpentryurl)
                 self.__idpauthformsubmiturl = parsedurl.scheme + "://" + parsedurl.netloc + action
@@ -92,13 +257,13 @@ class STS:
             self.__idpauthformsubmiturl, data=self.__payload, verify=True)
 
         # Decode the response and extract the SAML assertion
-        soup = BeautifulSoup(response.text, "lxml")
+        (inputs, _) = extractFormTags(response.text, stopAtInput='SAMLResponse', fastParse=self.__fastParse)
 
         # Look for the SAMLResponse attribute of the input tag (determined by
         # analyzing the debug print lines above)
-        for inputtag in soup.find_all('input'):
-            if(inputtag.get('name') == 'SAMLResponse'):
-                self.__assertion = inputtag.get('value')
+        for (name, value) in inputs:
+            if(name == 'SAMLResponse'):
+                self.__assertion = value
 
         # Better error handling is required for production use.
         if (self.__assertion == ''):
@@ -108,25 +273,34 @@ class STS:
 
     def __decideThePrincipalArn__(self):
         ''' Parse the input assertion and extract the PrincipalArn for the roleArn '''
+        if self.__roleArn in PRINCIPAL_ARN_CACHE:
+            self.__principalArn = PRINCIPAL_ARN_CACHE[self.__roleArn]
+            return
+
         awsroles = []
-        root = ET.fromstring(base64.b64decode(self.__assertion))
-        for saml2attribute in root.iter('{urn:oasis:names:tc:SAML:2.0:assertion}Attribute'):
-            if (saml2attribute.get('Name') == 'https://aws.amazon.com/SAML/Attributes/Role'):
-                for saml2attributevalue in saml2attribute.iter('{urn:oasis:names:tc:SAML:2.0:assertion}AttributeValue'):
-                    txt = saml2attributevalue.text
-                    awsroles.append(txt)
-                    if self.__roleArn in txt:
-                        chunks = txt.split(',')
-                        self.__principalArn = chunks[0] if 'saml-provider' in chunks[0] else chunks[1]
-
-        if self.__principalArn == '':
+        if self.__fastParse:
+            (self.__principalArn, awsroles) = findPrincipalArn(self.__assertion, self.__roleArn)
+        else:
+            root = ET.fromstring(base64.b64decode(self.__assertion))
+            for saml2attribute in root.iter(SAML_ATTRIBUTE):
+                if (saml2attribute.get('Name') == SAML_ROLE_ATTRIBUTE):
+                    for saml2attributevalue in saml2attribute.iter(SAML_ATTRIBUTE_VALUE):
+                        txt = saml2attributevalue.text
+                        awsroles.append(txt)
+                        if self.__roleArn in txt:
+                            chunks = txt.split(',')
+                            self.__principalArn = chunks[0] if 'saml-provider' in chunks[0] else chunks[1]
+
+        if self.__principalArn != '':
+            PRINCIPAL_ARN_CACHE[self.__roleArn] = self.__principalArn
+        else:
             #TODO: Insert valid error checking/handling
             print('Not able to find the RoleArn entered in the authorised list of RoleArns')
             print("RoleArn Requestead {}".format(self.__roleArn))
             print("List of Authorised roles,")
             i = 1
             for r in awsroles:
-                chunks = r.text.split(',')
+                chunks = r.split(',')
                 if 'saml-provider' in  chunks[0]:
                     print("\t{} - {} - {}".format(i,chunks[1],chunks[0]))
                 else:
@@ -149,6 +323,8 @@ class STS:
         config.set('saml', 'aws_access_key_id', self.__credentials["access_key"])
         config.set('saml', 'aws_secret_access_key',  self.__credentials["secret_key"])
         config.set('saml', 'aws_session_token', self.__credentials["token"])
+        config.set('saml', 'x_role_arn', self.__roleArn)
+        config.set('saml', 'x_expiry_time', self.__credentials["expiry_time"])
 
         # Write the updated config file
         with open(self.__awsconfigfile, 'w+') as configfile:
@@ -156,6 +332,50 @@ class STS:
 
         configfile.close
 
+    def __loadSAMLToken__(self, minValidSecs: int = CredentialCache.ADVISORY_REFRESH_SECS):
+        '''
+        Read back the token `__storeSAMLToken__` wrote for this role.
+        Returns the credential metadata or None if missing, for another role or about to expire.
+        '''
+        config = configparser.RawConfigParser()
+        config.read(self.__awsconfigfile)
+        if not config.has_section('saml') or \
+           not config.has_option('saml', 'x_expiry_time') or \
+           config.get('saml', 'x_role_arn', fallback='') != self.__roleArn:
+            return None
+        try:
+            expiry = datetime.datetime.fromisoformat(config.get('saml', 'x_expiry_time'))
+        except ValueError:
+            return None
+        if (expiry - datetime.datetime.now(expiry.tzinfo)).total_seconds() < minValidSecs:
+            return None
+        self.__credentials = {
+                "access_key" : config.get('saml', 'aws_access_key_id'),
+                "secret_key" : config.get('saml', 'aws_secret_access_key'),
+                "token"      : config.get('saml', 'aws_session_token'),
+                "expiry_time": config.get('saml', 'x_expiry_time'),
+            }
+        return self.__credentials
+
+    def __samlLogin__(self):
+        ''' Full SAML/ADFS round trip: log in to the IdP and pick the PrincipalArn from the assertion '''
+        self.__promptCredentials__()
+        self.__setIDPAuthUrlAndPayload__()
+        self.__setSAMLAssertion__()
+        self.__decideThePrincipalArn__()
+
+    def __refreshSAMLCred__(self):
+        ''' The SAML assertion is short lived, so a refresh needs a new IdP login '''
+        if not self.__canRefreshUnattended__() and threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("The SAML session for %s expires at %s, re-login required (assume_role from the "
+                               "main thread or pass user/pwd)" % (self.__roleArn, self.__credentials.get('expiry_time')))
+        self.__samlLogin__()
+        return self.__refreshCred__()
+
+    def __canRefreshUnattended__(self) -> bool:
+        ''' False when a refresh would prompt for the IdP user/password (SAML session read from the stored token) '''
+        return not self.__useSAML or (self.__user is not None and self.__pwd is not None)
+
     def __refreshCred__(self):
         ''' Refresh the token by calling assume_role '''
 
@@ -179,31 +399,52 @@ class STS:
 
         return self.__credentials
 
-    def assume_role(self):
-        ''' Assume the role. Uses SAML if requested. '''
+    def assume_role(self, useCache: bool = True):
+        '''
+        Assume the role. Uses SAML if requested.
+        The credentials are shared through the process wide CREDENTIAL_CACHE. For SAML, an unexpired
+        token of the same role stored in the 'saml' profile of ~/.aws/credentials is re-used as well,
+        skipping the IdP login.
+        '''
         if self.__authType == 'InstanceProfile' :
-            return botoSession(region_name=self.__region)
-        elif self.__useSAML == True:
-            self.__setIDPAuthUrlAndPayload__()
-            self.__setSAMLAssertion__()
-            self.__decideThePrincipalArn__()
-            session_credentials = RefreshableCredentials.create_from_metadata(
-                                    metadata      = self.__refreshCred__(),
-                                    refresh_using = self.__refreshCred__,
+            return boto3.Session(region_name=self.__region)
+
+        session_credentials = CREDENTIAL_CACHE.get(self.__cacheKey) if useCache else None
+        if session_credentials is None:
+            with CREDENTIAL_CACHE.keyLock(self.__cacheKey):
+                session_credentials = CREDENTIAL_CACHE.get(self.__cacheKey) if useCache else None
+                if session_credentials is None:
+                    session_credentials = self.__newCredentials__(useCache)
+                    unattended          = self.__canRefreshUnattended__()
+                    if not unattended:
+                        self.__log.warning("The SAML session for %s expires at %s and is not refreshed in the "
+                                           "background (no user/pwd), re-login required after that" %
+                                           (self.__roleArn, self.__credentials.get('expiry_time')))
+                    CREDENTIAL_CACHE.put(self.__cacheKey, session_credentials, backgroundRefresh=unattended)
+
+        s = botoCore.get_session()
+        s._credentials = session_credentials
+        if self.__region is None:
+            self.__region = s.get_config_variable('region')
+        s.set_config_variable('region', self.__region)
+        return boto3.Session(botocore_session=s)
+
+    def __newCredentials__(self, useStoredToken: bool = True) -> RefreshableCredentials:
+        if self.__useSAML == True:
+            metadata = self.__loadSAMLToken__() if useStoredToken else None
+            if metadata is None:
+                self.__samlLogin__()
+                metadata = self.__refreshCred__()
+            return botoCreds.RefreshableCredentials.create_from_metadata(
+                                    metadata      = metadata,
+                                    refresh_using = self.__refreshSAMLCred__,
                                     method        = 'sts-assume-role-with-saml'
                                 )
-        else:
-            session_credentials = RefreshableCredentials.create_from_metadata(
+        return botoCreds.RefreshableCredentials.create_from_metadata(
                                     metadata      = self.__refreshCred__(),
                                     refresh_using = self.__refreshCred__,
                                     method        = 'sts-assume-role'
                                 )
-        s = get_session()
-        s._credentials = session_credentials
-        if self.__region is None:
-            self.__region = s.get_config_variable('region')
-        s.set_config_variable('region', self.__region)
-        return botoSession(botocore_session=s)
 
 '''
 def main():
@@ -0,0 +1,179 @@
+from __future__ import print_function, annotations
+import io, csv, json, time, uuid, threading, logging
+from contextlib import contextmanager
+from urllib.request import urlopen
+from typing  import List, TYPE_CHECKING
+from logging import RootLogger
+if TYPE_CHECKING:
+    from pyspark import SparkContext
+
+#Stage level metrics of the Spark REST API summed per step (all the attempts of all the stages of its jobs)
+STAGE_METRICS = ['executorRunTime', 'inputBytes', 'inputRecords', 'outputBytes', 'outputRecords',
+                 'shuffleReadBytes', 'shuffleReadRecords', 'shuffleWriteBytes', 'shuffleWriteRecords',
+                 'memoryBytesSpilled', 'diskBytesSpilled', 'numTasks', 'numFailedTasks']
+REPORT_COLUMNS = ['step', 'startTime', 'executed', 'wallSecs', 'planSecs', 'jobIds', 'stageIds'] + STAGE_METRICS + ['filesWritten', 'attrs']
+
+class SparkMetrics:
+    '''
+    Per step (named DF) metrics collected without running extra actions: the Spark jobs of a step are
+    tagged with a job group, their ids/stages come from the status tracker and the stage metrics
+    (shuffle, spill, output rows...) from the REST API of the driver UI. Without the UI only the
+    timings and the job/stage ids are reported.
+    The Spark side is only read when the report is built, once the listener bus caught up.
+    A step which ran no Spark job (a lazy DF, persistType None) is reported as not executed: its time is
+    only the analysis/planning (planSecs), the work runs later in the step using the DF.
+    '''
+    def __init__(self, sc : SparkContext, log : RootLogger = None, restTimeout : float = 10):
+        self.__sc          = sc
+        self.__log         = log or logging.getLogger(__name__)
+        self.__restTimeout = restTimeout
+        self.__steps       = []
+        self.__active      = threading.local()
+        self.__prefix      = "pyhelper-%s" % (uuid.uuid4().hex[:8])
+
+    @contextmanager
+    def step(self, name : str, **attrs):
+        '''
+        Time the block and tag the Spark jobs it runs. A step inside a step (sql -> storeDF -> ...) is
+        accounted to the outer one.
+        '''
+        outer = getattr(self.__active, 'step', None)
+        if outer is not None:
+            outer['attrs'].update({k: v for k, v in attrs.items() if v is not None})
+            yield outer
+            return
+
+        rec = {'step'     : name or 'anonymous',
+               'group'    : "%s-%03d" % (self.__prefix, len(self.__steps)),
+               'startTime': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'attrs'    : {k: v for k, v in attrs.items() if v is not None},
+               'filesWritten': 0}
+        self.__steps.append(rec)
+        self.__active.step = rec
+        self.__sc.setJobGroup(rec['group'], "pyHelper step '%s'" % (rec['step']))
+        started = time.time()
+        try:
+            yield rec
+        finally:
+            rec['wallSecs'] = round(time.time() - started, 3)
+            self.__active.step = None
+            self.__sc.setLocalProperty("spark.jobGroup.id", None)
+            self.__sc.setLocalProperty("spark.job.description", None)
+
+    def note(self, **values):
+        ''' Add to the counters (ints) / attributes of the running step, if any '''
+        rec = getattr(self.__active, 'step', None)
+        if rec is None:
+            return
+        for k, v in values.items():
+            if isinstance(v, int) and isinstance(rec.get(k), int):
+                rec[k] += v
+            else:
+                rec['attrs'][k] = v
+
+    def isActive(self) -> bool:
+        ''' False once the SparkContext is stopped (its status tracker and UI are gone) '''
+        return getattr(self.__sc, '_jsc', None) is not None
+
+    def collect(self) -> List[dict]:
+        '''
+        One row per step with the job/stage ids and the summed stage metrics.
+        Once the SparkContext is stopped only the timings are left (executed/job ids/metrics are None).
+        '''
+        active = self.isActive()
+        if not active:
+            self.__log.warning("The SparkContext is stopped, the metrics report only has the step timings")
+        rest = self.__restBase() if active else None
+        rows = []
+        for rec in self.__steps:
+            jobIds, stageIds = self.stepJobs(rec) if active else (None, [])
+            executed = bool(jobIds) if active else None
+            row = dict(step         = rec['step'],
+                       startTime    = rec['startTime'],
+                       executed     = executed,
+                       wallSecs     = None if executed is False else rec.get('wallSecs'),
+                       planSecs     = rec.get('wallSecs') if executed is False else None,
+                       jobIds       = jobIds,
+                       stageIds     = stageIds if active else None,
+                       filesWritten = rec['filesWritten'],
+                       attrs        = rec['attrs'])
+            row.update(self.__stageMetrics(rest, stageIds))
+            rows.append(row)
+        return rows
+
+    def stepJobs(self, rec : dict) -> (List[int], List[int]):
+        ''' (job ids, stage ids) run by the step '''
+        tracker  = self.__sc.statusTracker()
+        jobIds   = sorted(tracker.getJobIdsForGroup(rec['group']))
+        stageIds = set()
+        for jobId in jobIds:
+            info = tracker.getJobInfo(jobId)    #None once dropped by the tracker (spark.ui.retainedJobs)
+            if info:
+                stageIds.update(info.stageIds)
+        return jobIds, sorted(stageIds)
+
+    def taskSummary(self, stageIds : List[int], quantiles : tuple = (0.5, 0.95, 1.0)) -> List[dict]:
+        '''
+        Task run time quantiles (ms) of the last attempt of each stage, from the REST API:
+        [{'stageId', 'numTasks', 'quantiles', 'runTimeMs': [...], 'skewRatio': last quantile (max) / median}]
+        '''
+        rest = self.__restBase()
+        if rest is None:
+            return []
+        out = []
+        for stageId in stageIds:
+            try:
+                attempts = self.__getJSON("%s/stages/%d?details=false" % (rest, stageId))
+                attempt  = max(attempts, key=lambda a: a.get('attemptId', 0))
+                summary  = self.__getJSON("%s/stages/%d/%d/taskSummary?quantiles=%s" %
+                                          (rest, stageId, attempt.get('attemptId', 0),
+                                           ",".join(str(q) for q in quantiles)))
+            except Exception as e:
+                self.__log.debug("No task summary for the stage %d: %s" % (stageId, e))
+                continue
+            runTimes = summary.get('executorRunTime', [])
+            median   = runTimes[list(quantiles).index(0.5)] if 0.5 in quantiles and runTimes else None
+            out.append({'stageId'  : stageId,
+                        'numTasks' : attempt.get('numTasks'),
+                        'quantiles': list(quantiles),
+                        'runTimeMs': runTimes,
+                        'skewRatio': round(runTimes[-1] / median, 2) if median else None})
+        return out
+
+    def __getJSON(self, url : str):
+        with urlopen(url, timeout=self.__restTimeout) as r:
+            return json.loads(r.read().decode('utf-8'))
+
+    def render(self, fmt : str = 'json') -> str:
+        ''' The report as JSON (list of rows) or CSV (lists/attrs as JSON strings) '''
+        rows = self.collect()
+        if fmt == 'json':
+            return json.dumps(rows, indent=2, default=str)
+        out = io.StringIO()
+        wrtr = csv.DictWriter(out, fieldnames=REPORT_COLUMNS, extrasaction='ignore')
+        wrtr.writeheader()
+        for row in rows:
+            wrtr.writerow({k: json.dumps(v) if isinstance(v, (list, dict)) else v for k, v in row.items()})
+        return out.getvalue()
+
+    def __restBase(self) -> str:
+        url = self.__sc.uiWebUrl
+        if not url:
+            self.__log.info("Spark UI disabled, the metrics report has no stage metrics")
+            return None
+        return "%s/api/v1/applications/%s" % (url.rstrip('/'), self.__sc.applicationId)
+
+    def __stageMetrics(self, rest : str, stageIds : List[int]) -> dict:
+        tot = dict.fromkeys(STAGE_METRICS, None if rest is None else 0)
+        if rest is None:
+            return tot
+        for stageId in stageIds:
+            try:
+                attempts = self.__getJSON("%s/stages/%d?details=false" % (rest, stageId))
+            except Exception as e:      #Stage dropped from the UI store (spark.ui.retainedStages) or UI down
+                self.__log.debug("No metrics for the stage %d: %s" % (stageId, e))
+                continue
+            for attempt in attempts:
+                for k in STAGE_METRICS:
+                    tot[k] += attempt.get(k, 0) or 0
+        return tot
@@ -1,17 +1,105 @@
-from __future__ import print_function
-import sys, re, logging
-from typing                import List
+from __future__ import print_function, annotations
+import sys, os, re, json, time, atexit, hashlib, logging, tempfile
+from contextlib            import nullcontext
+from typing                import List, TYPE_CHECKING
 from logging               import RootLogger
-from boto3                 import Session as bototSession
 
-from pyspark               import SparkConf, SparkContext
-from pyspark.sql           import SparkSession, SQLContext
-from pyspark.sql.dataframe import DataFrame
-from pyspark.sql.types     import StructType
-
-from pyspark.storagelevel  import StorageLevel
+from pyHelper._lazy        import lazyImport
+pyspark  = lazyImport('pyspark')
+pysql    = lazyImport('pyspark.sql')
+pytypes  = lazyImport('pyspark.sql.types')
+F        = lazyImport('pyspark.sql.functions')
+if TYPE_CHECKING:
+    from boto3                 import Session as bototSession
+    from pyspark.sql.dataframe import DataFrame
+    from pyspark.sql.types     import StructType
+    from pyspark.storagelevel  import StorageLevel
 
 from pyHelper.awsUtils.s3  import S3
+from pyHelper.pySparkUtils.SparkMetrics import SparkMetrics
+from pyHelper.pySparkUtils import SqlTokenizer
+
+DEFAULT_PART_BYTES = 128 * 1024 * 1024   #Target size of a partition when sizing from the plan statistics
+UNKNOWN_PLAN_SIZE  = (1 << 63) - 1       #spark.sql.defaultSizeInBytes: the plan has no size estimate
+MAT_CACHE_META     = "_pyhelper_meta.json"  #'_' prefixed: skipped by the Spark readers of the entry
+SALT_COL           = "_pyhelper_salt"
+HOT_COL            = "_pyhelper_hot"
+
+#Applied to every session, then the profile(s) of --sparkProfile, then the --sparkConf overrides
+BASE_SPARK_CONF = {
+    "spark.rpc.askTimeout"             : "1200",
+    "spark.network.timeout"            :  "1200",
+    "spark.broadcast.blockSize"        : "16m",
+    "spark.sql.broadcastTimeout"       : "1200",
+    "spark.broadcast.compress"         : "true",
+    "spark.rdd.compress"               : "true",
+    "fs.s3.enableServerSideEncryption" : "true",
+    "spark.kryo.unsafe"                : "false",
+    "spark.kryoserializer.buffer"      :"10240",
+    "spark.kryoserializer.buffer.max"  :"2040m",
+    "spark.io.compression.codec"       : "org.apache.spark.io.SnappyCompressionCodec",
+    "spark.serializer"                 : "org.apache.spark.serializer.KryoSerializer",
+    "mapreduce.fileoutputcommitter.algorithm.version"              :"2",
+    "spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version" :"2",
+}
+
+SPARK_PROFILES = {
+    "default"          : {},
+    #Few small queries on a laptop / edge node: few partitions, quick broadcast, AQE merging tiny partitions
+    "small-interactive": {
+        "spark.sql.shuffle.partitions"                    : "16",
+        "spark.sql.adaptive.enabled"                      : "true",
+        "spark.sql.adaptive.coalescePartitions.enabled"   : "true",
+        "spark.sql.autoBroadcastJoinThreshold"            : "33554432",
+        "spark.sql.files.maxPartitionBytes"               : "33554432",
+        "spark.memory.fraction"                           : "0.6",
+        "spark.ui.showConsoleProgress"                    : "false",
+    },
+    #Large joins/aggregations: many shuffle partitions sized by AQE, skew splitting, bigger shuffle buffers
+    "wide-shuffle"     : {
+        "spark.sql.shuffle.partitions"                    : "2000",
+        "spark.sql.adaptive.enabled"                      : "true",
+        "spark.sql.adaptive.coalescePartitions.enabled"   : "true",
+        "spark.sql.adaptive.advisoryPartitionSizeInBytes" : "268435456",
+        "spark.sql.adaptive.skewJoin.enabled"             : "true",
+        "spark.sql.autoBroadcastJoinThreshold"            : "10485760",
+        "spark.shuffle.file.buffer"                       : "1m",
+        "spark.reducer.maxSizeInFlight"                   : "96m",
+        "spark.shuffle.io.maxRetries"                     : "10",
+        "spark.memory.fraction"                           : "0.7",
+        "spark.memory.storageFraction"                    : "0.3",
+    },
+    #Star joins on mid size dimensions: broadcast up to 512MB, more storage memory for the broadcasts
+    "broadcast-heavy"  : {
+        "spark.sql.autoBroadcastJoinThreshold"            : "536870912",
+        "spark.sql.adaptive.enabled"                      : "true",
+        "spark.sql.broadcastTimeout"                      : "3600",
+        "spark.broadcast.blockSize"                       : "32m",
+        "spark.driver.maxResultSize"                      : "4g",
+        "spark.memory.fraction"                           : "0.7",
+        "spark.memory.storageFraction"                    : "0.5",
+    },
+    #Large writes to S3: S3A fast (block) upload in parallel multipart parts, v2 file committer
+    "s3-write-heavy"   : {
+        "spark.hadoop.fs.s3a.fast.upload"                 : "true",
+        "spark.hadoop.fs.s3a.fast.upload.buffer"          : "disk",
+        "spark.hadoop.fs.s3a.fast.upload.active.blocks"   : "8",
+        "spark.hadoop.fs.s3a.multipart.size"              : "134217728",
+        "spark.hadoop.fs.s3a.multipart.threshold"         : "268435456",
+        "spark.hadoop.fs.s3a.threads.max"                 : "64",
+        "spark.hadoop.fs.s3a.connection.maximum"          : "128",
+        "spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version" : "2",
+        "spark.sql.files.maxRecordsPerFile"               : "5000000",
+        "spark.speculation"                               : "false",
+    },
+    #To stack on s3-write-heavy: S3A magic committer (no rename on commit). Needs the spark-hadoop-cloud jar
+    "s3-magic-committer": {
+        "spark.hadoop.fs.s3a.committer.name"              : "magic",
+        "spark.hadoop.fs.s3a.committer.magic.enabled"     : "true",
+        "spark.sql.sources.commitProtocolClass"           : "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol",
+        "spark.sql.parquet.output.committer.class"        : "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter",
+    },
+}
 class SparkUtils:
     def __init__(self,log        : RootLogger   = None,
                       parms      : dict         = None,
@@ -28,9 +116,23 @@ class SparkUtils:
         self.__initFlags()
         self.__setupSparkSession__(appName)
 
-        self.__dfltRDDParts = \
-                int(self.__spark.conf.get("spark.executor.instances", "20")) * \
-                int(self.__spark.conf.get("spark.executor.cores", "4")) * 2
+        #Per DF timings/job metrics (-collectMetrics), reported to --metricsReport by stop() or at exit
+        self.metrics = None
+        if "-collectMetrics" in self.__parms or "--metricsReport" in self.__parms:
+            self.metrics = SparkMetrics(self.__sc, log)
+            if "--metricsReport" in self.__parms:
+                atexit.register(self.writeMetricsReport)
+
+        if "-aqeSkewJoin" in self.__parms:
+            self.enableAdaptiveSkewJoin()
+
+        #2 tasks per core: the executors asked for if fixed, else the cores the scheduler has (local[*], dynamic allocation)
+        if self.__spark.conf.get("spark.executor.instances", None):
+            self.__dfltRDDParts = \
+                    int(self.__spark.conf.get("spark.executor.instances")) * \
+                    int(self.__spark.conf.get("spark.executor.cores", "1")) * 2
+        else:
+            self.__dfltRDDParts = max(1, self.__sc.defaultParallelism) * 2
 
 
     def __initFlags(self):
@@ -45,63 +147,69 @@ class SparkUtils:
         self.__saveDF     = True if self.__parms["--saveDFAs"] != "NONE" else False
 
         self.__fileFmt    = self.__parms.get("--fileFormat","parquet")
+        self.__targetPartBytes = int(self.__parms.get("--targetPartitionBytes", DEFAULT_PART_BYTES))
+
+        self.__tempHiveDB = self.__parms.get("--tempHiveDB")
 
         if (self.__runEnv == "aws"):
             self.__tempS3     = self.__parms.get("--tempS3","hdfs:///temp/s3")
         if (self.__runEnv != "local" ):
             self.__tempHDFS   = self.__parms.get("--tempHDFS","hdfs:///temp")
+        else:
+            #'HDFS' persists go to the local file system in local mode
+            self.__tempHDFS   = self.__parms.get("--tempHDFS",
+                                                 "file://%s" % os.path.join(tempfile.gettempdir(), "pyHelper"))
+        if (self.__runEnv != "aws"):
             self.log.warn("For persist type 'S3', 'HDFS' will be used as the --runEnv != 'aws'")
 
+        #Materialization cache of the HDFS/S3 persisted DFs, re-used by the re-runs (-matCache)
+        self.__matCacheURI = None
+        if "-matCache" in self.__parms:
+            self.__matCacheURI = self.__parms.get("--matCacheURI",
+                                    "%s/_matcache" % (self.__tempS3 if self.__runEnv == "aws" else self.__tempHDFS))
+        self.__matCacheMaxAge   = float(self.__parms.get("--matCacheMaxAgeHrs", "72")) * 3600
+        self.__matCacheMaxBytes = int(float(self.__parms.get("--matCacheMaxGB", "500")) * (1 << 30))
+        self.__matCacheEvicted  = False
+        self.__matCacheUsed     = set()     #Entries read/written by this run, never evicted by it
+
     def __setupSparkSession__(self,appName : str = None):
         '''
         Init the Spark environemnt with few default configurations and start the spark session.
         '''
-        self.__conf = SparkConf()
-        hmConf = {
-            "spark.rps.askTimeout"             : "1200",
-            "spark.network.timeout"            :  "1200",
-            "spark.broadcast.blockSize"        : "16m",
-            "spark.sql.broadcastTimeout"       : "1200",
-            "spark.broadcast.compress"         : "true",
-            "spark.rdd.compress"               : "true",
-            "fs.s3.enableServerSideEncryption" : "true",
-            "spark.kryo.unsafe"                : "false",
-            "spark.kryoserializer.buffer"      :"10240",
-            "spark.kryoserializer.buffer.max"  :"2040m",
-            "spark.io.compression.codec"       : "org.apache.spark.io.SnappyCompressionCodec",
-            "spark.serializer"                 : "org.apache.spark.serializer.KryoSerializer",
-            "mapreduce.fileoutputcommitter.algorithm.version"              :"2",
-            "spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version" :"2",
-
-        }
-        self.__conf.setAll(hmConf)
-        SparkContext.setSystemProperty("com.amazonaws.services.s3.enableV4", "true")
-        SparkContext.setSystemProperty("com.amazonaws.services.s3.enforceV4", "true")
-        self.__spark = SparkSession \
+        self.__conf = pyspark.SparkConf()
+        if self.__runEnv == "local":
+            self.__conf.setIfMissing("spark.master", self.__parms.get("--master", "local[*]"))
+        self.__sparkConf = SparkUtils.resolveSparkConf(self.__parms.get("--sparkProfile", "default"),
+                                                       self.__parms.get("--sparkConf"))
+        self.log.info("Spark profile '%s': %s" % (self.__parms.get("--sparkProfile", "default"), self.__sparkConf))
+        self.__conf.setAll(list(self.__sparkConf.items()))
+        pyspark.SparkContext.setSystemProperty("com.amazonaws.services.s3.enableV4", "true")
+        pyspark.SparkContext.setSystemProperty("com.amazonaws.services.s3.enforceV4", "true")
+        self.__spark = pysql.SparkSession \
                         .builder \
                         .config(conf=self.__conf) \
                         .appName(appName or "PySparkApp") \
                         .enableHiveSupport() \
                         .getOrCreate()
         self.__sc = self.__spark.sparkContext
-        self.sqlC = SQLContext(self.__sc)
+        self.sqlC = pysql.SQLContext(self.__sc)
         self.__sc.setSystemProperty("com.amazonaws.services.s3.enableV4", "true")
         self.__sc.setSystemProperty("com.amazonaws.services.s3.enforceV4", "true")
         self.__sc.setLogLevel(self.__parms.get("--logLevel", "INFO"))
 
-        hdpCnf = self.__sc.hadoopConfiguration
-        hdpCnf.setAll({
+        hdpCnf = self.__sc._jsc.hadoopConfiguration()
+        def setAll(conf : dict):    #Hadoop's Configuration has no setAll
+            for k, v in conf.items():
+                hdpCnf.set(k, v)
+        setAll({
                 "io.file.buffer.size"                             : "65536",
                 "mapreduce.fileoutputcommitter.algorithm.version" : "2",
                 "fs.s3a.endpoint"                                 : "%s.amazonaws.com" % ( self.__parms.get("--awsRegion",'s3.us-east-1' ))
             })
-        if (self.__parms.get("--runEnv", "AWS") == "AWS"):
-            from botocore.credentials import InstanceMetadataProvider, InstanceMetadataFetcher
-            provider = InstanceMetadataProvider(iam_role_fetcher=InstanceMetadataFetcher(timeout=1000, num_attempts=2))
-            creds = provider.load()
-            hdpCnf.setAll({
-                "fs.s3a.access.key"                       : creds.access_key,
-                "fs.s3a.secret.key"                       : creds.secret_key,
+        if (self.__runEnv == "aws"):
+            #No keys are set: S3A keeps its default credential provider chain (instance profile / container
+            #role), which also refreshes them
+            setAll({
                 "fs.s3a.server-side-encryption-algorithm" : "SSE-KMS",
                 "fs.s3.enableServerSideEncryption"        : "true",
                 "fs.s3.impl"                              : "org.apache.hadoop.fs.s3a.S3AFileSystem",
@@ -109,6 +217,23 @@ class SparkUtils:
                 "fs.s3a.endpoint"                         : "s3.%s.amazonaws.com" % (self.__parms.get("--awsRegion", "us-east-1"))
             })
 
+    @staticmethod
+    def resolveSparkConf(profiles : str = "default", overrides = None) -> dict:
+        '''
+            Spark conf of the profiles (comma separated, applied in order over BASE_SPARK_CONF, see SPARK_PROFILES)
+            with the per key overrides on top: a dict or a "key=value,key=value" string (--sparkConf).
+        '''
+        conf = dict(BASE_SPARK_CONF)
+        for name in [p.strip() for p in (profiles or "default").split(",") if p.strip()]:
+            if name not in SPARK_PROFILES:
+                raise ValueError("Unknown spark profile '%s'. Available: %s" % (name, ", ".join(SPARK_PROFILES)))
+            conf.update(SPARK_PROFILES[name])
+        if isinstance(overrides, str):
+            #Split on the commas starting a new 'key=' only, the values may hold commas
+            overrides = dict(kv.split("=", 1) for kv in re.split(r',(?=\s*[A-Za-z][\w.\-]*=)', overrides) if kv.strip())
+        conf.update({k.strip(): str(v).strip() for k, v in (overrides or {}).items()})
+        return conf
+
     def sql(self, dfName : str,
                   query : str,
                   partitions : int =0,
@@ -121,100 +246,125 @@ class SparkUtils:
         HIVE, HDFS, S3
 
         '''
-        if persistType == None :
-            _df = self.__spark.sql(self.handleHints(query))
-            if partitions == 0 :
-                df = _df
-            elif df.rdd.getNumPartitions < partitions :
-                df = _df.repartition(partitions)
-            else:
-                df = _df.coalesce(partitions)
-            return df
-        else:
+        with self.__step(dfName, persistType = persistType, partitions = partitions):
+            if persistType == None :
+                return self.repartitionDF(dataFrame  = self.__spark.sql(self.handleHints(query)),
+                                          partitions = partitions)
             df = self.storeDF(
-                df            = self.sql(query,partitions),
+                df            = self.sql(None, query, partitions),
                 dfName        = dfName,
                 persistType   = persistType,
                 partitions    = partitions,
-                partitionCols = self.getPartitionColumnsFromSQL(query)
+                partitionCols = self.getPartitionColumnsFromSQL(query),
+                sqlText       = self.handleHints(query)
             )
 
-        if dfName:
-            df.createOrReplaceTempView(dfName)
+            if dfName:
+                df.createOrReplaceTempView(dfName)
 
-        if self.__printcount:
-            self.log.info("Number of Records in DF '%s' : %d " % (dfName,df.count()))
+            if self.__printcount:
+                self.log.info("Number of Records in DF '%s' : %d " % (dfName,df.count()))
+            return df
 
     def storeDF(self, df            : DataFrame,
                       dfName        : str,
                       persistType   : str,
                       partitions    : int,
-                      partitionCols : List[str]
+                      partitionCols : List[str],
+                      sqlText       : str = None
                ):
         '''
         Store the input dataframe, read the persisted datafrme and return the new one.
         If Memory/Disk persistance requested, we run take(1) on the datafrme to force persist.
+        With -matCache and the SQL of the DF, the HDFS/S3 persists go through the materialization cache.
         '''
-        if self.__explainDF or \
-            "NULL|NONE".index(persistType.toUpperCase()) < 0 :
+        with self.__step(dfName, persistType = persistType, partitions = partitions):
+            return self.__storeDF(df, dfName, persistType, partitions, partitionCols, sqlText)
+
+    def __storeDF(self, df            : DataFrame,
+                        dfName        : str,
+                        persistType   : str,
+                        partitions    : int,
+                        partitionCols : List[str],
+                        sqlText       : str = None
+                 ):
+        persistType = (persistType or "NONE").upper()
+        if self.__explainDF or persistType not in ("NULL", "NONE") :
             self.log.info("Execution pland for building the DF '%s'" % (dfName))
             df.explain()
             self.log.info("\n\n\n")
 
-        saveType = self.__parms["--saveDFAs"] \
-            if self.__saveDF and \
-               "HIVE|NULL".index(persistType.toUpperCase()) < 0 \
+        saveType = self.__parms["--saveDFAs"].upper() \
+            if self.__saveDF and persistType not in ("HIVE", "NULL") \
             else \
-                persistType.toUpperCase()
+                persistType
 
-        if saveType == "S3" and self.__runEnv == "aws":
+        if saveType == "S3" and self.__runEnv != "aws":
             saveType = "HDFS"
             self.log.debug("Resetting the persist type to 'HDFS' as the --runEnv != 'aws'")
 
+        #Only the columns of the DF can be used in partitionBy (the SQL may use aliases/expressions).
+        #Spark resolves the names case insensitively, the DF keeps the case of the select.
+        dfCols        = {c.lower(): c for c in df.columns}
+        partitionCols = [dfCols[c.lower()] for c in (partitionCols or []) if c.lower() in dfCols]
+
         df1 = df if saveType != "HDFS" and \
                     saveType != "HIVE" and \
                     saveType != "S3" \
-                 else self.repartitionDF(dataFrame= df, partitions = partitions)
+                 else self.repartitionDF(dataFrame= df, partitions = partitions, partitionCols = partitionCols)
 
         if  saveType == "NULL" or saveType == "NONE":
             return df1
+        elif saveType in ("HDFS", "S3") and self.__matCacheURI and sqlText:
+            fingerprint = self.fingerprint(sqlText, df, saveType, partitions)
+            if fingerprint:
+                return self.persistCached(fingerprint, dfName, df1, partitionCols)
+            return self.persistExternal( self.__tempHDFS if saveType == "HDFS" else self.__tempS3,
+                                         dfName, df1, partitionCols)
         elif saveType == "HDFS":
-            return self.persistExternal( self.__tempHDFS, dfName, df, partitionCols)
+            return self.persistExternal( self.__tempHDFS, dfName, df1, partitionCols)
         elif saveType == "S3":
-            return self.persistExternal( self.__tempS3, dfName, df, partitionCols)
-        elif saveType == "":
-            return self.persist2Hive(dfName,df,partitionCols)
+            return self.persistExternal( self.__tempS3, dfName, df1, partitionCols)
+        elif saveType == "HIVE":
+            return self.persist2Hive(dfName,df1,partitionCols)
         elif saveType == "CHECK_POINT":
             return df.cache().checkpoint(eager=True)
         else:
-            return self.persistLocal(dfName, df, persistType)
+            return self.persistLocal(dfName, df, saveType)
 
     def persistExternal(self, parentDirURI  : str,
                               fileName      : str,
                               df            : DataFrame,
                               partitionCols : List[str] = None,
                               overwrite     : bool      = True,
-                              fileFormat    : str       = None, **kwargs):
-
-        fullPath = "%s%s"  % (parentDirURI,fileName or "") if parentDirURI.endswith("/") else \
-                   "%s/%s" % (parentDirURI,fileName or "")
-        fullPath = fullPath.replace("//", "/")
-        schma = df.schema()
-        fileFormat    = fileFormat or self.__fileFmt
+                              fileFormat    : str       = None, **kwargs) -> DataFrame:
+        '''
+        Write the DF under `parentDirURI/fileName` and return a DF reading it back with the schema of the
+        input DF (no schema inference pass). The column order of the input DF is kept, partitionBy moves
+        the partition columns to the end otherwise.
+        '''
+        fullPath   = SparkUtils.joinURI(parentDirURI, fileName)
+        schma      = df.schema
+        fileFormat = (fileFormat or self.__fileFmt).lower()
         self.write2ExtrFile(fullPath      = fullPath,
                             fileFormat    = fileFormat,
                             df            = df,
                             partitionCols = partitionCols,
                             overwrite     = overwrite, **kwargs)
         df.unpersist()
-        if fileFormat == "parquet" :
-            return self.readParquet( uri = fullPath, schema = schma,  **kwargs)
-        elif fileFormat == "orc" :
-            return self.readOrc( uri = fullPath, schema = schma, **kwargs)
+        if fileFormat == "orc" :
+            rdf = self.readOrc( uriString = fullPath, schema = schma, **kwargs)
         elif fileFormat == "csv" :
-            return self.readCSV( uri = fullPath, schema = schma, **kwargs)
+            rdf = self.readCSV( uriString = fullPath, schema = schma, **kwargs)
         else :
-            return self.readParquet( uri = fullPath, schema = schma, **kwargs)
+            rdf = self.readParquet( uriString = fullPath, schema = schma, **kwargs)
+        return rdf.select(*df.columns) if partitionCols else rdf
+
+    @staticmethod
+    def joinURI(parentDirURI : str, fileName : str = None) -> str:
+        ''' Join the parts and collapse the duplicate '/' in the path, keeping the scheme ('s3://', 'hdfs:///', 'file:///') '''
+        m = re.match(r'^([a-zA-Z][\w+.-]*:/*)?(.*)$', "%s/%s" % (parentDirURI, fileName or ""))
+        return (m.group(1) or "") + re.sub(r'/{2,}', '/', m.group(2)).rstrip("/")
 
     def readParquet(self,uriString : str,
                          schema:StructType = None,
@@ -227,13 +377,22 @@ class SparkUtils:
             rdr.schema(schema)
         return rdr.load(uriString)
 
-    def readOrc(self,uriString : str, schema: StructType, **kwargs):
+    def readOrc(self,uriString : str, schema: StructType = None, **kwargs):
         self.log.info("Reading the ORC file in '%s'" % uriString)
-        pass ##TODO
+        rdr = self.__spark.read.format("orc")
+        if schema:
+            rdr.schema(schema)
+        return rdr.load(uriString)
 
-    def readCSV(self,uriString : str, schema: StructType, **kwargs):
+    def readCSV(self,uriString : str, schema: StructType = None, header : bool = True, **kwargs):
+        ''' Without a schema, the column types are inferred (an extra pass on the data) '''
         self.log.info("Reading the CSV file in '%s'" % uriString)
-        pass ##TODO
+        rdr = self.__spark.read.format("csv").option("header", str(header).lower())
+        if schema:
+            rdr.schema(schema)
+        else:
+            rdr.option("inferSchema", "true")
+        return rdr.load(uriString)
 
     def write2ExtrFile(self,
                        fileFormat    : str,
@@ -241,33 +400,259 @@ class SparkUtils:
                        df            : DataFrame,
                        partitionCols : List[str] = None,
                        overwrite     : bool      = True, **kwargs ):
+        '''
+        Write the DF as parquet/orc/csv (partitioned by partitionCols) and check the job committed,
+        i.e. the output committer wrote `_SUCCESS`. Raises IOError when the marker is missing.
+        '''
+        self.log.info("Writing the DF as %s to '%s' partitioned by %s" % (fileFormat, fullPath, partitionCols or []))
+        wrtr = df.write.format(fileFormat).mode("overwrite" if overwrite else "errorifexists")
+        if fileFormat == "csv":
+            wrtr = wrtr.option("header", "true")
+        if partitionCols:
+            wrtr = wrtr.partitionBy(*partitionCols)
+        wrtr.save(fullPath)
+
+        marker = "%s/_SUCCESS" % (fullPath)
+        found  = self.pathExists(marker)
+        if not found and fullPath.startswith("s3") and self.__runEnv == "aws":
+            found = self.__s3.waitForFile(marker.replace("s3a://", "s3://", 1))
+        if not found:
+            raise IOError("The write to '%s' did not commit, '%s' is missing" % (fullPath, marker))
+        if self.metrics:
+            self.metrics.note(filesWritten = self.__countFiles(fullPath), path = fullPath)
+
+    def fingerprint(self, sqlText     : str,
+                          df          : DataFrame,
+                          persistType : str = None,
+                          partitions  : int = 0) -> str:
+        '''
+        Key of the materialization cache: the (hint processed) SQL text, the resolved plan (so a redefined
+        upstream temp view changes the key), the size and mtime of every input file of the DF and the
+        settings changing the output. None when the DF doesn't read files (in memory / local relations),
+        as changes in such inputs can't be detected.
+        '''
+        files = sorted(df.inputFiles())
+        if not files:
+            self.log.debug("DF has no input files, not using the materialization cache")
+            return None
+        key = [" ".join(sqlText.split()), SparkUtils.planText(df), str(persistType).upper(), partitions,
+               self.__fileFmt, self.__fileStats(files)]
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
 
-        if fullPath.startswith("s3") :
-           self.__s3.waitForFile("%s/_SUCCESS" % (fullPath))
-
-         #TODO:Yet to Implement
-
+    @staticmethod
+    def planText(df : DataFrame) -> str:
+        '''
+        The canonicalized analyzed plan of the DF: the temp views are expanded and the expression ids
+        normalized, so the text is the same across runs for the same logic. semanticHash() isn't used as
+        it is only stable within a JVM.
+        '''
+        return df._jdf.queryExecution().analyzed().canonicalized().toString()
+
+    def __fileStats(self, files : List[str]) -> list:
+        ''' [path, length, mtime] of the files, one listStatus per parent folder instead of one call per file '''
+        jvm   = self.__sc._jvm
+        conf  = self.__sc._jsc.hadoopConfiguration()
+        known = {}
+        for parent in sorted(set(f.rsplit("/", 1)[0] for f in files)):
+            path = jvm.org.apache.hadoop.fs.Path(parent)
+            fs   = path.getFileSystem(conf)
+            if fs.exists(path):
+                for st in fs.listStatus(path):
+                    known[st.getPath().toString()] = (st.getLen(), st.getModificationTime())
+        stats = []
+        for f in files:
+            if f not in known:          #Folders (Hive table locations) or paths not qualified the same way
+                path = jvm.org.apache.hadoop.fs.Path(f)
+                st   = path.getFileSystem(conf).getFileStatus(path)
+                known[f] = (st.getLen(), st.getModificationTime())
+            stats.append([f, known[f][0], known[f][1]])
+        return stats
+
+    def persistCached(self, fingerprint   : str,
+                            dfName        : str,
+                            df            : DataFrame,
+                            partitionCols : List[str] = None) -> DataFrame:
+        '''
+        Return the DF persisted under the fingerprint by a previous run if there's one not older than
+        --matCacheMaxAgeHrs (cache hit), else persist it there (cache miss), so a re-run only computes the
+        steps after the failure. The last use is kept in the entry meta (setTimes isn't supported on S3).
+        '''
+        entry = SparkUtils.joinURI(self.__matCacheURI, fingerprint)
+        meta  = self.__readMatMeta(entry)
+        if meta and time.time() - SparkUtils.__matUsedAt(meta) > self.__matCacheMaxAge:
+            self.log.info("Materialization cache entry for '%s' expired: %s" % (dfName, entry))
+            meta = None
+        if meta:
+            self.log.info("Materialization cache hit for '%s': %s" % (dfName, entry))
+            self.__matCacheUsed.add(fingerprint)
+            meta["usedAt"] = time.time()
+            self.__writeText("%s/%s" % (entry, MAT_CACHE_META), json.dumps(meta))
+            schma = pytypes.StructType.fromJson(meta["schema"])
+            if meta["format"] == "orc":
+                rdf = self.readOrc(uriString = entry, schema = schma)
+            elif meta["format"] == "csv":
+                rdf = self.readCSV(uriString = entry, schema = schma)
+            else:
+                rdf = self.readParquet(uriString = entry, schema = schma)
+            return rdf.select(*meta["columns"])
+
+        self.log.info("Materialization cache miss for '%s', persisting to %s" % (dfName, entry))
+        if not self.__matCacheEvicted:
+            self.evictMatCache()
+        self.__matCacheUsed.add(fingerprint)
+        rdf = self.persistExternal(self.__matCacheURI, fingerprint, df, partitionCols)
+        self.__writeText("%s/%s" % (entry, MAT_CACHE_META),
+                         json.dumps({"dfName" : dfName,
+                                     "format" : self.__fileFmt.lower(),
+                                     "columns": df.columns,
+                                     "schema" : json.loads(df.schema.json()),
+                                     "created": time.time(),
+                                     "usedAt" : time.time()}))
+        return rdf
 
+    @staticmethod
+    def __matUsedAt(meta : dict) -> float:
+        ''' Last use (epoch secs) of a cache entry, from its meta '''
+        return meta.get("usedAt") or meta.get("created") or 0
 
+    def evictMatCache(self, maxAgeSecs : float = None, maxBytes : int = None):
+        '''
+        Drop the cache entries older than --matCacheMaxAgeHrs (last used), then the least recently used
+        ones until the cache fits in --matCacheMaxGB. Entries without meta (failed or running writes) age
+        from the creation of their folder. The entries used by this run are kept, its DFs may read them.
+        '''
+        self.__matCacheEvicted = True
+        maxAgeSecs = self.__matCacheMaxAge   if maxAgeSecs is None else maxAgeSecs
+        maxBytes   = self.__matCacheMaxBytes if maxBytes   is None else maxBytes
+        jvm  = self.__sc._jvm
+        root = jvm.org.apache.hadoop.fs.Path(self.__matCacheURI)
+        fs   = root.getFileSystem(self.__sc._jsc.hadoopConfiguration())
+        if not fs.exists(root):
+            return
+
+        now, entries = time.time() * 1000, []
+        for st in fs.listStatus(root):
+            if not st.isDirectory() or st.getPath().getName() in self.__matCacheUsed:
+                continue
+            meta   = jvm.org.apache.hadoop.fs.Path(st.getPath(), MAT_CACHE_META)
+            usedAt = SparkUtils.__matUsedAt(json.loads(self.__readText(meta.toString()))) * 1000 \
+                     if fs.exists(meta) else st.getModificationTime()
+            entries.append((usedAt, fs.getContentSummary(st.getPath()).getLength(), st.getPath()))
+
+        entries.sort(key = lambda e: e[0])
+        total = sum(e[1] for e in entries)
+        for usedAt, size, path in entries:
+            if now - usedAt <= maxAgeSecs * 1000 and total <= maxBytes:
+                continue
+            self.log.info("Evicting the materialization cache entry %s (%d bytes)" % (path.toString(), size))
+            fs.delete(path, True)
+            total -= size
+
+    def __readMatMeta(self, entry : str) -> dict:
+        ''' Meta of a committed cache entry or None '''
+        metaURI = "%s/%s" % (entry, MAT_CACHE_META)
+        if not (self.pathExists("%s/_SUCCESS" % (entry)) and self.pathExists(metaURI)):
+            return None
+        return json.loads(self.__readText(metaURI))
+
+    def __readText(self, uriString : str) -> str:
+        jvm  = self.__sc._jvm
+        path = jvm.org.apache.hadoop.fs.Path(uriString)
+        strm = path.getFileSystem(self.__sc._jsc.hadoopConfiguration()).open(path)
+        try:
+            return jvm.org.apache.commons.io.IOUtils.toString(strm, "UTF-8")
+        finally:
+            strm.close()
+
+    def __writeText(self, uriString : str, text : str):
+        jvm  = self.__sc._jvm
+        path = jvm.org.apache.hadoop.fs.Path(uriString)
+        strm = path.getFileSystem(self.__sc._jsc.hadoopConfiguration()).create(path, True)
+        try:
+            strm.write(bytearray(text.encode("utf-8")))
+        finally:
+            strm.close()
+
+    def __step(self, dfName : str, **attrs):
+        ''' Metrics step of the named DF (no-op without -collectMetrics) '''
+        return self.metrics.step(dfName, **attrs) if self.metrics else nullcontext()
+
+    def __countFiles(self, uriString : str) -> int:
+        ''' Data files under the path (the '_' / '.' prefixed markers are not counted) '''
+        jvm  = self.__sc._jvm
+        path = jvm.org.apache.hadoop.fs.Path(uriString)
+        fs   = path.getFileSystem(self.__sc._jsc.hadoopConfiguration())
+        itr  = fs.listFiles(path, True)
+        cnt  = 0
+        while itr.hasNext():
+            if not itr.next().getPath().getName().startswith(("_", ".")):
+                cnt += 1
+        return cnt
+
+    def writeMetricsReport(self, uriString : str = None) -> str:
+        '''
+        Write the per DF metrics (see SparkMetrics) to uriString (default --metricsReport) as CSV if it
+        ends with '.csv' else JSON. Paths without a scheme are local files. Returns the report.
+        '''
+        uriString = uriString or self.__parms.get("--metricsReport")
+        if not self.metrics or not uriString:
+            return None
+        remote = re.match(r'^[a-zA-Z][\w+.-]*://', uriString)
+        if remote and not self.metrics.isActive():
+            self.log.warning("The SparkContext is stopped, can't write the metrics report to '%s' "
+                             "(call SparkUtils.stop() instead of spark.stop())" % (uriString))
+            return None
+        report = self.metrics.render("csv" if uriString.lower().endswith(".csv") else "json")
+        if remote:
+            self.__writeText(uriString, report)
+        else:
+            with open(uriString, "w") as f:
+                f.write(report)
+        self.log.info("Metrics report written to '%s'" % (uriString))
+        return report
+
+    def stop(self):
+        ''' Write the metrics report (--metricsReport) while the SparkContext is still up, then stop the session '''
+        if self.metrics and "--metricsReport" in self.__parms:
+            self.writeMetricsReport()
+            atexit.unregister(self.writeMetricsReport)
+        self.__spark.stop()
+
+    def pathExists(self, uriString : str) -> bool:
+        ''' Check the path through the Hadoop FileSystem of the session (any scheme the cluster can read) '''
+        jvm  = self.__sc._jvm
+        path = jvm.org.apache.hadoop.fs.Path(uriString)
+        return path.getFileSystem(self.__sc._jsc.hadoopConfiguration()).exists(path)
 
     def persist2Hive(self, table         : str,
                            df            : DataFrame,
                            partitionCols : List[str]
-                    ):
-        pass #TODO:Yet to Implement
+                    ) -> DataFrame:
+        '''
+        Save the DF as a (managed) table in --tempHiveDB (if set) and return a DF reading the table.
+        '''
+        fullName = "%s.%s" % (self.__tempHiveDB, table) if self.__tempHiveDB else table
+        self.log.info("Saving the DF as the table '%s' partitioned by %s" % (fullName, partitionCols or []))
+        wrtr = df.write.format(self.__fileFmt).mode("overwrite")
+        if partitionCols:
+            wrtr = wrtr.partitionBy(*partitionCols)
+        wrtr.saveAsTable(fullName)
+        df.unpersist()
+        return self.__spark.table(fullName).select(*df.columns)
 
     def persistLocal(self, dfName      : str,
                            df          : DataFrame,
                            persistType : str
-                    ):
+                    ) -> DataFrame:
         ''' Persist the input Datafrmae locally (memory/disk/none) and runs `df.take(1)` to force persist.
         '''
-        lvl = self.getSparkPersistType(persistType.toUpperCase())
+        lvl = self.getSparkPersistType(persistType.upper())
         if lvl:
-            df.persist()
+            df.persist(lvl)
 
-        if (self.__printcount == None) :
+        if not self.__printcount :      #Else the count in sql() materializes it
             df.take(1)
+        return df
 
     def getSparkPersistType(self, persistTypStr: str) -> StorageLevel :
         '''
@@ -283,6 +668,7 @@ class SparkUtils:
                 `StorageLevel.MEMORY_AND_DISK_2`
                 `StorageLevel.OFF_HEAP`
         '''
+        StorageLevel = pyspark.StorageLevel
 
         if   persistTypStr == "NONE"              : return None
         elif persistTypStr == "DISK_ONLY"         : return StorageLevel.DISK_ONLY
@@ -296,68 +682,281 @@ class SparkUtils:
             self.log.warn("Invalid Persist Type %s received. Defaulting to NONE" % (persistTypStr))
             return None
 
-    def repartitionDF(self,dataFrame  : DataFrame,
-                           partitions : int = 0):
+    def repartitionDF(self,dataFrame     : DataFrame,
+                           partitions    : int       = 0,
+                           partitionCols : List[str] = None,
+                           targetBytes   : int       = None):
         '''
             Repartition the inuput dataframe
 
-            parms: df          -> dataframe
-                   partitions  -> new partitions count. Defaulted to 0 i.e Don't partition
+            parms: df            -> dataframe
+                   partitions    -> new partitions count. Defaulted to 0 i.e Don't partition
+                   partitionCols -> columns to hash partition on (repartition by columns)
+                   targetBytes   -> bytes per partition when sizing from the plan statistics (--targetPartitionBytes)
 
             logic,
                 if partitions = 0 , Don't repartitions
-                if partitions = -1, Repartions to the default number (NumOfExecutors * ExecutorCores * 2)
+                if partitions = -1, Size the partitions from the estimated size of the DF (targetBytes each).
+                                    Falls back to the default number (NumOfExecutors * ExecutorCores * 2)
+                                    when the plan has no size estimate.
                 if partitions > 0 , Repartition/coalesce to the input number
         '''
-        curParts = dataFrame.rdd.getNumPartitions
-        finalParts = min(curParts, partitions)
+        if partitions == 0:
+            return dataFrame
+
+        #The current partitions are not needed to repartition by columns
+        curParts, sizeBytes = self.partitionStats(dataFrame, withPartitions = not partitionCols)
+        plan = SparkUtils.planPartitions(curParts      = curParts,
+                                         sizeBytes     = sizeBytes,
+                                         requested     = partitions,
+                                         targetBytes   = targetBytes or self.__targetPartBytes,
+                                         dfltParts     = self.__dfltRDDParts,
+                                         partitionCols = partitionCols)
+        self.log.info("Partition plan: %s" % (plan))
+
+        if plan["action"] == "coalesce":
+            return dataFrame.coalesce(plan["partitions"])
+        elif plan["action"] == "repartition":
+            return dataFrame.repartition(plan["partitions"])
+        elif plan["action"] == "repartitionByCols":
+            return dataFrame.repartition(plan["partitions"], *partitionCols)
+        return dataFrame
 
-        if curParts == partitions or partitions == 0:
-            finalParts = -1
-        elif partitions == -1:
-            finalParts = self.__dfltRDDParts
-        elif partitions > 0:
-            finalParts = partitions
-        else :
-            pass #finalParts is pre-populated.
+    @staticmethod
+    def partitionStats(dataFrame : DataFrame, withPartitions : bool = True) -> (int, int):
+        '''
+            (current partitions or None, estimated size in bytes or None) read from the plans, nothing is executed:
+            the partitions from the physical plan (see planNumPartitions) and the size from the statistics of
+            the optimized logical plan (file sizes / table stats). The Dataset's RDD isn't used: with AQE,
+            building it runs the shuffle and broadcast stages.
+        '''
+        qe       = dataFrame._jdf.queryExecution()
+        curParts = SparkUtils.planNumPartitions(qe.sparkPlan()) if withPartitions else None
+        try:
+            stats     = qe.optimizedPlan().stats()
+            sizeBytes = int(str(stats.sizeInBytes()))   #py4j hands back an int or a BigInt object depending on the version
+        except Exception:
+            sizeBytes = None
+        #spark.sql.defaultSizeInBytes (Long.MaxValue) is reported when Spark can't estimate the size
+        if sizeBytes is not None and sizeBytes >= UNKNOWN_PLAN_SIZE:
+            sizeBytes = None
+        return curParts, sizeBytes
 
-        self.log.debug("Current Partitions: %d , Requested: %d,  Final: %d " % (curParts,partitions,finalParts) )
+    @staticmethod
+    def planNumPartitions(plan) -> int:
+        '''
+            Output partitions of a (JVM) physical plan before the exchanges are planned, None when only the
+            execution knows them (shuffles sized by AQE, local relations...). Known from the plan partitioning,
+            else through the nodes keeping the partitions of their child down to a file scan (split planning
+            on the listed files, no job) or a union (sum of its children).
+        '''
+        parts = plan.outputPartitioning().numPartitions()
+        if parts > 0:
+            return parts
+        name     = plan.getClass().getSimpleName()
+        children = plan.children()
+        if name == "FileSourceScanExec":
+            try:
+                return plan.inputRDD().getNumPartitions()
+            except Exception:       #e.g. dynamic partition pruning filters, only known at run time
+                return None
+        if name == "UnionExec":
+            counts = [SparkUtils.planNumPartitions(children.apply(i)) for i in range(children.size())]
+            return None if None in counts else sum(counts)
+        if children.size() != 1 or any(d.getClass().getSimpleName() != "UnspecifiedDistribution$"
+                                       for d in SparkUtils.__seq(plan.requiredChildDistribution())):
+            return None
+        return SparkUtils.planNumPartitions(children.apply(0))
 
-        if finalParts != -1:
-            return  dataFrame
-        elif curParts > finalParts:
-            return dataFrame.coalesce(finalParts)
-        else :
-            return dataFrame.repartition(finalParts)
+    @staticmethod
+    def __seq(jseq) -> list:
+        ''' Python list of a Scala Seq '''
+        return [jseq.apply(i) for i in range(jseq.size())]
+
+    @staticmethod
+    def planPartitions(curParts      : int,
+                       sizeBytes     : int,
+                       requested     : int,
+                       targetBytes   : int,
+                       dfltParts     : int,
+                       partitionCols : List[str] = None) -> dict:
+        '''
+            Decide how to reach the requested partitioning. Returns
+            {"action": none|coalesce|repartition|repartitionByCols, "partitions", "current", "sizeBytes", "reason"}
+            Pure function of the plan statistics, so it can be checked without a cluster. When the current
+            partitions aren't known (curParts None) the DF is repartitioned, coalesce could keep more partitions.
+        '''
+        if requested == -1 and sizeBytes is not None:
+            target = max(1, -(-sizeBytes // max(1, targetBytes)))
+            reason = "size %d bytes / %d bytes per partition" % (sizeBytes, targetBytes)
+        elif requested == -1:
+            target = dfltParts
+            reason = "no size estimate, default partitions"
+        else:
+            target = requested
+            reason = "requested"
+
+        plan = {"current": curParts, "sizeBytes": sizeBytes, "partitions": target, "reason": reason}
+        if partitionCols:
+            plan["action"] = "repartitionByCols"
+        elif curParts is None:
+            plan["action"] = "repartition"
+        elif target == curParts:
+            plan["action"] = "none"
+        elif target < curParts:
+            plan["action"] = "coalesce"     #Narrow dependency, no shuffle
+        else:
+            plan["action"] = "repartition"
+        return plan
 
+    def sparkVersion(self) -> tuple:
+        ''' (major, minor) of the running Spark '''
+        return tuple(int(v) for v in re.findall(r'\d+', self.__sc.version)[:2])
+
+    def enableAdaptiveSkewJoin(self, skewFactor     : float = 5,
+                                     thresholdBytes : int   = 256 * 1024 * 1024,
+                                     force          : bool  = False) -> dict:
+        '''
+            Turn on the adaptive query execution skew join handling (Spark 3.0+): a partition larger than
+            skewFactor * median and thresholdBytes is split (and the other side replicated) at run time.
+            force: also when it adds a shuffle (Spark 3.3+). Returns the settings applied ({} before Spark 3).
+        '''
+        ver = self.sparkVersion()
+        if ver < (3, 0):
+            self.log.warn("Spark %s has no adaptive skew join, use skewJoin() instead" % (self.__sc.version))
+            return {}
+        conf = {"spark.sql.adaptive.enabled"                                  : "true",
+                "spark.sql.adaptive.skewJoin.enabled"                         : "true",
+                "spark.sql.adaptive.skewJoin.skewedPartitionFactor"           : str(skewFactor),
+                "spark.sql.adaptive.skewJoin.skewedPartitionThresholdInBytes" : str(int(thresholdBytes))}
+        if force and ver >= (3, 3):
+            conf["spark.sql.adaptive.forceOptimizeSkewedJoin"] = "true"
+        for k, v in conf.items():
+            self.__spark.conf.set(k, v)
+        self.log.info("Adaptive skew join settings: %s" % (conf))
+        return conf
+
+    def analyzeSkew(self, view           : str,
+                          keyCols        : List[str],
+                          sampleFraction : float = 0.01,
+                          topN           : int   = 20,
+                          hotShare       : float = None,
+                          seed           : int   = 42) -> dict:
+        '''
+            Sample the join keys of the view (name or DF) and report the heavy hitters.
+            A key is hot when it holds more than `hotShare` of the rows, by default 5 times the share of
+            a shuffle partition (5 / spark.sql.shuffle.partitions): its partition would be a straggler.
+            Returns {"view", "keys", "sampledRows", "heavyHitters": [{"key", "estRows", "share"}], "hotKeys"}
+        '''
+        df       = self.__spark.table(view) if isinstance(view, str) else view
+        hotShare = hotShare or 5.0 / int(self.__spark.conf.get("spark.sql.shuffle.partitions", "200"))
+        smpl     = df.select(*keyCols).sample(withReplacement = False, fraction = sampleFraction, seed = seed)
+        counts   = smpl.groupBy(*keyCols).count()
+        stats    = counts.agg(F.sum("count").alias("rows")).collect()[0]
+        sampled  = stats["rows"] or 0
+        top      = counts.orderBy(F.col("count").desc()).limit(topN).collect() if sampled else []
+
+        hitters = [{"key"    : tuple(r[c] for c in keyCols),
+                    "estRows": int(r["count"] / sampleFraction),
+                    "share"  : round(r["count"] / float(sampled), 4)} for r in top]
+        report = {"view"        : view if isinstance(view, str) else "<DataFrame>",
+                  "keys"        : list(keyCols),
+                  "sampledRows" : sampled,
+                  "heavyHitters": hitters,
+                  "hotKeys"     : [h["key"] for h in hitters if h["share"] > hotShare]}
+        self.log.info("Skew of %s on %s: %d hot keys in %d sampled rows, top %s" %
+                      (report["view"], keyCols, len(report["hotKeys"]), sampled, hitters[:5]))
+        return report
+
+    def skewJoin(self, left        : DataFrame,
+                       right       : DataFrame,
+                       keyCols     : List[str],
+                       how         : str       = "inner",
+                       strategy    : str       = "salt",
+                       hotKeys     : list      = None,
+                       saltBuckets : int       = 16,
+                       seed        : int       = 42) -> DataFrame:
+        '''
+            Join two views (names or DFs) on keyCols, the skewed (large) side being `left`, handling its hot
+            keys (from analyzeSkew when not given) with,
+                salt : the hot keys rows of left get a random salt in [0, saltBuckets), the matching rows
+                       of right are replicated once per salt, so a hot key is spread over saltBuckets tasks
+                split: the hot keys rows are joined separately with the (small) hot keys rows of right
+                       broadcast; the other rows with a regular join
+            how: inner or left. Without hot keys, a plain join.
+        '''
+        if how not in ("inner", "left"):
+            raise ValueError("skewJoin supports the inner/left joins, not '%s'" % (how))
+        ldf = self.__spark.table(left)  if isinstance(left, str)  else left
+        rdf = self.__spark.table(right) if isinstance(right, str) else right
+        if hotKeys is None:
+            hotKeys = self.analyzeSkew(ldf, keyCols)["hotKeys"]
+        if not hotKeys:
+            return ldf.join(rdf, keyCols, how)
+
+        hotDF = self.__spark.createDataFrame([tuple(k) for k in hotKeys], ldf.select(*keyCols).schema)
+        hot   = F.broadcast(hotDF)
+        self.log.info("skewJoin: %s on %d hot keys of %s" % (strategy, len(hotKeys), keyCols))
+        if strategy == "split":
+            cold = ldf.join(hot, keyCols, "left_anti").join(rdf.join(hot, keyCols, "left_anti"), keyCols, how)
+            warm = ldf.join(hot, keyCols, "left_semi").join(F.broadcast(rdf.join(hot, keyCols, "left_semi")), keyCols, how)
+            return cold.unionByName(warm)
+        elif strategy != "salt":
+            raise ValueError("Unknown skewJoin strategy '%s' (salt, split)" % (strategy))
+
+        flag = F.broadcast(hotDF.withColumn(HOT_COL, F.lit(True)))
+        lslt = ldf.join(flag, keyCols, "left") \
+                  .withColumn(SALT_COL, F.when(F.col(HOT_COL), (F.rand(seed) * saltBuckets).cast("int"))
+                                         .otherwise(F.lit(0))) \
+                  .drop(HOT_COL)
+        rslt = rdf.join(flag, keyCols, "left") \
+                  .withColumn(SALT_COL, F.explode(F.when(F.col(HOT_COL), F.array(*[F.lit(i) for i in range(saltBuckets)]))
+                                                   .otherwise(F.array(F.lit(0))))) \
+                  .drop(HOT_COL)
+        return lslt.join(rslt, keyCols + [SALT_COL], how).drop(SALT_COL)
+
+    def compareTaskDurations(self, variants : dict) -> dict:
+        '''
+            Run each DF of {name: DF} (noop write, nothing is kept) and report its wall time and the task run
+            time quantiles of its stages: a skew fix shows as a lower max/median ratio and wall time.
+            Needs the Spark UI (REST API) for the task durations.
+        '''
+        metrics = self.metrics or SparkMetrics(self.__sc, self.log)
+        report  = {}
+        for name, df in variants.items():
+            with metrics.step("compare:%s" % (name)) as rec:
+                if self.sparkVersion() >= (3, 0):
+                    df.write.format("noop").mode("overwrite").save()
+                else:
+                    df.foreachPartition(lambda rows: None)
+            _, stageIds = metrics.stepJobs(rec)
+            stages = metrics.taskSummary(stageIds)
+            ratios = [s["skewRatio"] for s in stages if s["skewRatio"]]
+            report[name] = {"wallSecs"    : rec["wallSecs"],
+                            "maxSkewRatio": max(ratios) if ratios else None,
+                            "maxTaskMs"   : max([s["runTimeMs"][-1] for s in stages if s["runTimeMs"]] or [None]),
+                            "stages"      : stages}
+            self.log.info("%-20s wall %8.2fs  max task %s ms  max/median %s" %
+                          (name, rec["wallSecs"], report[name]["maxTaskMs"], report[name]["maxSkewRatio"]))
+        return report
 
     def handleHints(self,query : str):
         '''
             Removes the SparkSQL hints if the -useHist parm is not set.
 
-            Example:- If sql = 'select /* hists */ cols.. from ..'
+            Example:- If sql = 'select /*+ hints */ cols.. from ..'
                if -useHist is not set,
-                  return 'select cols.. from ..'
+                  return 'select   cols.. from ..'
                else
-                  return 'select /* hists */ cols.. from ..'
+                  return 'select /*+ hints */ cols.. from ..'
+            Only the comments are removed, a '/*' in a string literal is kept.
         '''
         if self.__useHist:
             return query
         else:
-            return  re.sub(r'/\*+.*\*/', '', query)
+            return SqlTokenizer.stripHints(query)
 
     @staticmethod
-    def getPartitionColumnsFromSQL(query):
-        s = query.toLowerCase().strip().replace("\n", " ")
-        inx = s.index(" cluster ")
-        lst = []
-        if inx > 0:
-            lst.extend((map(lambda x: x.strip(), s[inx + 12 :].split(","))))
-        else :
-            frm = s.index(" distribute ")
-            to = s.index(" sort ", frm + 15) if frm > 0 else 0
-            if to > frm:
-                lst.extend((map(lambda x: x.strip(), s[frm + 15: to ].split(","))))
-            else:
-                lst.extend((map(lambda x: x.strip(), s[frm + 15:].split(","))))
-        return lst
+    def getPartitionColumnsFromSQL(query : str) -> List[str]:
+        ''' Columns of the top level 'cluster by' / 'distribute by' / 'partition by' clause of the query ([] if none) '''
+        return list(SqlTokenizer.partitionColumns(query))
@@ -0,0 +1,115 @@
+'''
+Single pass tokenizer of Spark SQL text, enough to find the partitioning clauses and the hints of a query
+without being fooled by strings, comments, sub-queries or window specs.
+
+    partitionColumns("select a, b from t distribute by t.a, b sort by c")   -> ('a', 'b')
+    stripHints("select /*+ BROADCAST(d) */ * from f join d on ...")      -> "select   * from f join d on ..."
+
+The results are memoized per query text (the same statements are re-run by the jobs).
+'''
+import re
+from collections import namedtuple
+from functools   import lru_cache
+
+Token = namedtuple('Token', ['kind', 'text', 'depth'])     #depth: parenthesis nesting level of the token
+
+_TOKEN_RE = re.compile(r"""
+     (?P<hint>/\*\+.*?\*/)
+    |(?P<comment>/\*.*?\*/|--[^\n]*)
+    |(?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    |(?P<quoted>`(?:[^`]|``)*`)
+    |(?P<ws>\s+)
+    |(?P<word>[A-Za-z_][\w$]*)
+    |(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)
+    |(?P<punct>.)
+""", re.S | re.X)
+
+#Clauses (followed by BY) giving the partitioning of the statement, by precedence
+PARTITION_CLAUSES = ('CLUSTER', 'DISTRIBUTE', 'PARTITION', 'PARTITIONED')
+#Words ending a column list at its own depth
+_LIST_END = {'SORT', 'ORDER', 'LIMIT', 'UNION', 'INTERSECT', 'EXCEPT', 'MINUS', 'WINDOW', 'HAVING', 'CLUSTER',
+             'DISTRIBUTE', 'PARTITION', 'PARTITIONED', 'STORED', 'LOCATION', 'TBLPROPERTIES', 'OPTIONS',
+             'COMMENT', 'AS', 'SELECT', 'INSERT', 'CLUSTERED', 'SORTED', 'ROW', 'ROWS', 'RANGE'}
+_TRIVIA   = ('ws', 'comment', 'hint')
+
+@lru_cache(maxsize=256)
+def tokenize(sql: str) -> tuple:
+    ''' Tuple of Token(kind, text, depth); kind is hint, comment, string, quoted, ws, word, number or punct '''
+    tokens, depth = [], 0
+    for m in _TOKEN_RE.finditer(sql):
+        kind, text = m.lastgroup, m.group()
+        if kind == 'punct' and text == ')':
+            depth = max(0, depth - 1)
+        tokens.append(Token(kind, text, depth))
+        if kind == 'punct' and text == '(':
+            depth += 1
+    return tuple(tokens)
+
+@lru_cache(maxsize=256)
+def partitionColumns(sql: str) -> tuple:
+    '''
+    Columns of the top level CLUSTER BY, else DISTRIBUTE BY, else PARTITION(ED) BY clause of the statement.
+    Expressions which aren't plain (qualified) columns can't be used to partition the output and are skipped.
+    Names are returned unqualified and unquoted, in the case of the query.
+    '''
+    toks  = [t for t in tokenize(sql) if t.kind not in _TRIVIA]
+    found = {}
+    for i, t in enumerate(toks[:-1]):
+        nxt = toks[i + 1]
+        if t.depth == 0 and t.kind == 'word' and t.text.upper() in PARTITION_CLAUSES and \
+           nxt.kind == 'word' and nxt.text.upper() == 'BY':
+            found[t.text.upper()] = _columnList(toks, i + 2, typed = t.text.upper() == 'PARTITIONED')
+    for clause in PARTITION_CLAUSES:
+        if found.get(clause):
+            return found[clause]
+    return ()
+
+@lru_cache(maxsize=256)
+def hints(sql: str) -> tuple:
+    ''' Text of the hint comments (/*+ ... */) '''
+    return tuple(t.text for t in tokenize(sql) if t.kind == 'hint')
+
+@lru_cache(maxsize=256)
+def stripHints(sql: str) -> str:
+    ''' The query without its block comments (hints included), each replaced by a space; strings are untouched '''
+    return ''.join(' ' if t.kind == 'hint' or (t.kind == 'comment' and t.text.startswith('/*')) else t.text
+                   for t in tokenize(sql))
+
+def _columnList(toks: list, start: int, typed: bool = False) -> tuple:
+    ''' Plain columns of the comma separated list starting at toks[start], in parenthesis or not '''
+    if start >= len(toks):
+        return ()
+    depth = toks[start].depth
+    if toks[start].text == '(':
+        depth, start = depth + 1, start + 1
+
+    items, item = [], []
+    for t in toks[start:]:
+        if t.depth < depth or t.text == ';' or \
+           (t.depth == depth and t.kind == 'word' and t.text.upper() in _LIST_END):
+            break
+        if t.depth == depth and t.text == ',':
+            items.append(item)
+            item = []
+        else:
+            item.append(t)
+    items.append(item)
+
+    cols = []
+    for item in items:
+        name = _columnName(item[:1] if typed else item)     #PARTITIONED BY (col type, ...): the name only
+        if name:
+            cols.append(name)
+    return tuple(cols)
+
+def _columnName(item: list) -> str:
+    ''' Last part of `a`, `t.a`, `db.t.a` (backticks removed); None for any other expression '''
+    if not item or len(item) % 2 == 0:
+        return None
+    for i, t in enumerate(item):
+        if i % 2 == 0 and t.kind not in ('word', 'quoted'):
+            return None
+        if i % 2 == 1 and t.text != '.':
+            return None
+    last = item[-1]
+    return last.text[1:-1].replace('``', '`') if last.kind == 'quoted' else last.text
@@ -0,0 +1,51 @@
+import os, shutil, logging
+import pytest
+
+@pytest.fixture(autouse=True)
+def awsEnv(monkeypatch):
+    ''' Dummy credentials/region so no test can reach a real AWS account '''
+    for k, v in {'AWS_ACCESS_KEY_ID'    : 'testing',
+                 'AWS_SECRET_ACCESS_KEY': 'testing',
+                 'AWS_SESSION_TOKEN'    : 'testing',
+                 'AWS_DEFAULT_REGION'   : 'us-east-1'}.items():
+        monkeypatch.setenv(k, v)
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+
+@pytest.fixture(scope='session')
+def sparkDir(tmp_path_factory):
+    ''' Warehouse/metastore folder of the local SparkSession shared by the tests, stopped at the end '''
+    pyspark = pytest.importorskip('pyspark')
+    if not (os.environ.get('JAVA_HOME') or shutil.which('java')):
+        pytest.skip("no Java runtime for the local SparkSession (set JAVA_HOME)")
+    path    = tmp_path_factory.mktemp('spark')
+    yield path
+    if pyspark.SparkContext._active_spark_context is not None:
+        pyspark.SparkContext._active_spark_context.stop()
+
+@pytest.fixture
+def sparkUtils(sparkDir, tmp_path):
+    '''
+    Factory of local mode SparkUtils: sparkUtils('-matCache', sparkConf="k=v", **{'--parm': value}).
+    All of them share one SparkSession; the persists go under the tmp_path of the test.
+    '''
+    from pyHelper.pySparkUtils.SparkUtils import SparkUtils
+
+    def build(*flags, sparkConf: str = None, **parms):
+        conf = "spark.sql.warehouse.dir=%s/warehouse,spark.driver.extraJavaOptions=-Dderby.system.home=%s" % \
+               (sparkDir, sparkDir)
+        args = {'--master'      : 'local[2]',
+                '--logLevel'    : 'WARN',
+                '--sparkProfile': 'small-interactive',
+                '--sparkConf'   : "%s,%s" % (conf, sparkConf) if sparkConf else conf,
+                '--tempHDFS'    : "file://%s/hdfs" % (tmp_path)}
+        args.update(parms)
+        args.update(dict.fromkeys(flags, True))
+        return SparkUtils(log=logging.getLogger('pyHelper.tests'), parms=args, appName='pyHelper-tests')
+    return build
+
+@pytest.fixture
+def spark(sparkUtils):
+    ''' The shared local SparkSession (built with the settings of sparkUtils) '''
+    from pyspark.sql import SparkSession
+    sparkUtils()
+    return SparkSession.builder.getOrCreate()
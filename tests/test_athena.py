@@ -0,0 +1,131 @@
+import pytest
+
+pytest.importorskip('boto3')
+pa = pytest.importorskip('pyarrow')
+
+import pyHelper.awsUtils.athena as athenaModule
+from pyHelper.awsUtils.athena import Athena, AthenaResultCache
+
+class StubAthena:
+    '''
+    Athena client whose queries go through `states` (one state per status poll, the last one sticks).
+    Result pages: one integer column 'i' with the rows 1, 2, 3.
+    '''
+    def __init__(self, states=('RUNNING', 'SUCCEEDED'), failing=()):
+        self.states      = list(states)
+        self.failing     = set(failing)
+        self.polls       = {}
+        self.batchCalls  = []
+        self.singleCalls = 0
+        self.started     = []
+
+    def start_query_execution(self, QueryString, **kwargs):
+        self.started.append(QueryString)
+        return {'QueryExecutionId': 'q%d' % (len(self.started))}
+
+    def __execution(self, queryId):
+        n     = self.polls[queryId] = self.polls.get(queryId, 0) + 1
+        state = self.states[min(n, len(self.states)) - 1]
+        if state == 'SUCCEEDED' and queryId in self.failing:
+            state = 'FAILED'
+        return {'QueryExecutionId': queryId, 'StatementType': 'DML',
+                'Status'          : {'State': state, 'StateChangeReason': 'stub failure'},
+                'Statistics'      : {'EngineExecutionTimeInMillis': 0}}
+
+    def get_query_execution(self, QueryExecutionId):
+        self.singleCalls += 1
+        return {'QueryExecution': self.__execution(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.batchCalls.append(list(QueryExecutionIds))
+        return {'QueryExecutions': [self.__execution(q) for q in QueryExecutionIds]}
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, **kwargs):
+        row = lambda v: {'Data': [{'VarCharValue': v}]}
+        yield {'ResultSet': {'ResultSetMetadata': {'ColumnInfo': [{'Name': 'i', 'Type': 'integer'}]},
+                             'Rows': [row('i'), row('1'), row('2'), row('3')]}}
+
+class StubSession:
+    def __init__(self, athena):
+        self.athena = athena
+
+    def client(self, service, **kwargs):
+        return self.athena
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(athenaModule.time, 'sleep', slept.append)
+    return slept
+
+def newAthena(stub, **kwargs):
+    return Athena(StubSession(stub), 's3://pyhelper-test/results', None, **kwargs)
+
+def test_wait_all_polls_in_batches_of_50(sleeps):
+    stub    = StubAthena(states=('RUNNING', 'RUNNING', 'SUCCEEDED'))
+    athena  = newAthena(stub, pollInitial=0.05, pollMax=1.0)
+    handles = [athena.submit("select %d" % i) for i in range(120)]
+    assert athena.wait_all(handles) is handles
+    assert all(h.done() for h in handles)
+    assert [len(ids) for ids in stub.batchCalls] == [50, 50, 20] * 3
+    assert stub.singleCalls == 0
+    assert sleeps == [0.05, 0.1]
+    assert handles[7].result() == [('i',), ('1',), ('2',), ('3',)]
+    assert stub.singleCalls == 0        #result() reuses the execution seen by wait_all
+
+def test_wait_all_backoff_is_capped(sleeps):
+    stub   = StubAthena(states=('RUNNING',) * 8 + ('SUCCEEDED',))
+    athena = newAthena(stub, pollInitial=0.05, pollMax=0.3)
+    athena.wait_all([athena.submit("select 1")])
+    assert sleeps == [0.05, 0.1, 0.2] + [0.3] * 5
+
+def test_wait_all_failed_query_raises_on_result(sleeps):
+    stub    = StubAthena(failing={'q2'})
+    athena  = newAthena(stub)
+    handles = athena.wait_all([athena.submit("select %d" % i) for i in range(3)])
+    assert [h.state() for h in handles] == ['SUCCEEDED', 'FAILED', 'SUCCEEDED']
+    with pytest.raises(Exception, match='stub failure'):
+        handles[1].result()
+    assert len(handles[2].result()) == 4
+
+def test_wait_all_timeout(sleeps):
+    athena = newAthena(StubAthena(states=('RUNNING',)))
+    with pytest.raises(TimeoutError):
+        athena.wait_all([athena.submit("select 1")], timeout=-1)
+
+@pytest.mark.parametrize('sql, readOnly', [
+    ("-- comment\n select 1",                        True),
+    ("/* c */ (WITH a AS (SELECT 1) SELECT * FROM a)", True),
+    ("show tables",                                  True),
+    ("DESCRIBE t",                                   True),
+    ("insert into t select 1",                       False),
+    ("CREATE TABLE x AS SELECT 1",                   False),
+    ("UNLOAD (SELECT 1) TO 's3://b/p'",              False),
+    ("MSCK REPAIR TABLE t",                          False),
+])
+def test_read_only_statements(sql, readOnly):
+    assert AthenaResultCache.isReadOnly(sql) is readOnly
+
+def test_cache_serves_selects_only(sleeps):
+    stub   = StubAthena()
+    athena = newAthena(stub, cache=AthenaResultCache())
+    for _ in range(2):
+        athena.query("select i from t")
+        athena.query("insert into t select 1")
+    assert stub.started == ["select i from t", "insert into t select 1", "insert into t select 1"]
+    assert athena.cacheStats()['hits'] == 1
+
+def test_disk_cache_evicts_least_recently_read(tmp_path):
+    cache = AthenaResultCache(diskDir=str(tmp_path), maxDiskBytes=300)
+    value = [('x' * 40,)]
+    cache.put('k0', value)
+    for i in range(1, 8):
+        cache.put('k%d' % i, value)
+        assert cache.get('k0') == value     #Kept as the most recently read
+    files = sorted(p.name for p in tmp_path.iterdir())
+    assert 'k0.json' in files and 'k1.json' not in files
+    assert sum(p.stat().st_size for p in tmp_path.iterdir()) <= 300
+    assert cache.stats()['diskEvictions'] == 8 - len(files)
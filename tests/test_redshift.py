@@ -0,0 +1,359 @@
+import os, gc, json, uuid, datetime
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+boto3    = pytest.importorskip('boto3')
+pa       = pytest.importorskip('pyarrow')
+
+import pyHelper.awsUtils.redshift as redshiftModule
+from pyHelper.awsUtils.redshift import Redshift
+
+class FakeCursor:
+    '''
+    Cursor of FakeConnection. The first value of each mogrified row is taken as the row id; a statement
+    carrying a row id listed in conn.failOn raises the error mapped to it (once if it is retryable).
+    '''
+    def __init__(self, conn):
+        self.connection  = conn
+        self.description = None
+        self.__rowIds    = []
+        self.__result    = None
+
+    def mogrify(self, sql, args):
+        self.__rowIds.append(args[0])
+        sql = sql.decode() if isinstance(sql, bytes) else sql
+        return (sql % tuple(repr(a) for a in args)).encode()
+
+    def execute(self, sql, args=None):
+        sql    = sql.decode() if isinstance(sql, bytes) else sql
+        rowIds = self.__rowIds
+        self.__rowIds = []
+        self.__result    = self.connection.execute(sql, rowIds)
+        self.description = self.connection.descriptions.get(sql)
+
+    def fetchone(self):
+        return self.__result
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class FakeConnection:
+    '''
+    Keeps the row ids of the committed / pending (open transaction) statements, with savepoints.
+    conn.results maps a statement to the row fetched by fetchone, or to the error it raises,
+    conn.descriptions to the cursor description it sets.
+    '''
+    encoding = 'UTF8'
+    status   = 1
+    closed   = 0
+
+    def __init__(self):
+        self.statements   = []
+        self.committed    = []
+        self.pending      = []
+        self.savepoint    = None
+        self.failOn       = {}
+        self.results      = {}
+        self.descriptions = {}
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def execute(self, sql, rowIds):
+        self.statements.append(sql)
+        result = self.results.get(sql)
+        if isinstance(result, type) and issubclass(result, Exception):
+            raise result(sql)
+        if result is not None:
+            return result
+        if sql == "SAVEPOINT pyhelper_batch":
+            self.savepoint = len(self.pending)
+        elif sql == "RELEASE SAVEPOINT pyhelper_batch":
+            self.savepoint = None
+        elif sql == "ROLLBACK TO SAVEPOINT pyhelper_batch":
+            del self.pending[self.savepoint:]
+        else:
+            for rowId in rowIds:
+                error = self.failOn.get(rowId)
+                if error is not None:
+                    if issubclass(error, psycopg2.extensions.TransactionRollbackError):
+                        del self.failOn[rowId]
+                    raise error("row %s" % (rowId))
+            self.pending.extend(rowIds)
+
+    def commit(self):
+        self.statements.append('COMMIT')
+        self.committed.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.statements.append('ROLLBACK')
+        self.pending = []
+
+    def close(self):
+        self.closed = 1
+
+class StubRedshiftClient:
+    def describe_clusters(self, ClusterIdentifier):
+        return {'Clusters': [{'Endpoint': {'Address': 'localhost', 'Port': 5439}}]}
+
+    def get_cluster_credentials(self, DurationSeconds, **kwargs):
+        return {'DbUser': 'user', 'DbPassword': 'pwd',
+                'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=DurationSeconds)}
+
+class StubSession:
+    ''' Stub Redshift API; the other services are real boto3 clients (moto in the tests using S3) '''
+    def client(self, service, **kwargs):
+        return StubRedshiftClient() if service == 'redshift' else boto3.client(service, **kwargs)
+
+@pytest.fixture
+def conn(monkeypatch):
+    fake = FakeConnection()
+    monkeypatch.setattr(redshiftModule.psycopg2, 'connect', lambda **kwargs: fake)
+    monkeypatch.setattr(redshiftModule.time, 'sleep', lambda secs: None)
+    return fake
+
+@pytest.fixture
+def rs(conn):
+    return Redshift(StubSession(), 'us-east-1', 'cluster', 'db', 'user')
+
+ROWS = [(i, "v%d" % i) for i in range(25)]
+
+def test_execute_many_commits_each_batch(rs, conn):
+    assert rs.executeMany("INSERT INTO t (a, b) VALUES %s", ROWS, pageSize=4, batchSize=10) == 25
+    assert conn.committed == list(range(25))
+    inserts = [s for s in conn.statements if s.startswith('INSERT')]
+    assert len(inserts) == 3 + 3 + 2        #Batches of 10/10/5 rows, 4 rows per statement
+    assert conn.statements.count('COMMIT') == 4
+
+def test_failed_row_rolls_back_its_batch_only(rs, conn):
+    conn.failOn[15] = psycopg2.DataError
+    with pytest.raises(psycopg2.DataError):
+        rs.executeMany("INSERT INTO t (a, b) VALUES %s", ROWS, pageSize=4, batchSize=10)
+    assert conn.committed == list(range(10))    #Batches are committed on their own (Redshift has no SAVEPOINT)
+    assert conn.pending   == []
+
+def test_failed_row_with_savepoints_rolls_back_everything(rs, conn):
+    conn.failOn[15] = psycopg2.DataError
+    with pytest.raises(psycopg2.DataError):
+        rs.executeMany("INSERT INTO t (a, b) VALUES %s", ROWS, pageSize=4, batchSize=10, useSavepoints=True)
+    assert conn.committed == []
+    assert "SAVEPOINT pyhelper_batch" in conn.statements
+
+def test_conflict_retries_the_batch(rs, conn):
+    conn.failOn[15] = psycopg2.extensions.TransactionRollbackError
+    assert rs.executeMany("INSERT INTO t (a, b) VALUES %s", ROWS, pageSize=4, batchSize=10,
+                          useSavepoints=True) == 25
+    assert conn.committed == list(range(25))
+    assert conn.statements.count("ROLLBACK TO SAVEPOINT pyhelper_batch") == 1
+
+def test_conflict_gives_up_after_max_retries(rs, conn):
+    class AlwaysConflict(psycopg2.extensions.TransactionRollbackError):
+        pass
+    def conflictOnRow0(sql, rowIds, execute=conn.execute):
+        if 0 in rowIds:
+            raise AlwaysConflict("row 0")
+        execute(sql, rowIds)
+    conn.execute = conflictOnRow0
+    with pytest.raises(AlwaysConflict):
+        rs.executeBatch("UPDATE t SET b = %s WHERE a = %s", [(i, 'x') for i in range(5)], maxReTry=2)
+    assert conn.committed == []
+    assert conn.statements.count('ROLLBACK') == 4     #3 attempts + the final rollback
+
+def test_execute_batch(rs, conn):
+    assert rs.executeBatch("UPDATE t SET b = %s WHERE a = %s", ROWS, pageSize=5, batchSize=20) == 25
+    updates = [s for s in conn.statements if s.startswith('UPDATE')]
+    assert len(updates) == 5
+    assert updates[0].count('UPDATE') == 5
+
+@pytest.fixture
+def s3(conn):
+    moto = pytest.importorskip('moto')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='pyhelper-test')
+        yield client
+
+def stagedKeys(s3):
+    return [o['Key'] for o in s3.list_objects_v2(Bucket='pyhelper-test').get('Contents', [])]
+
+@pytest.mark.parametrize('fileFormat', ['parquet', 'csv'])
+def test_bulk_load_copies_a_manifest_of_the_shards(rs, conn, s3, fileFormat):
+    tbl     = pa.table({'a': list(range(100)), 'b': ["v%d" % i for i in range(100)]})
+    summary = rs.bulkLoad(tbl, 's.t', 's3://pyhelper-test/stage', 'arn:aws:iam::1:role/r',
+                          fileFormat=fileFormat, shards=4, cleanup=False)
+    assert summary['rows'] == 100 and summary['shards'] == 4
+    copies = [s for s in conn.statements if s.startswith('COPY')]
+    assert copies == ["COPY s.t%s FROM '%s' IAM_ROLE 'arn:aws:iam::1:role/r' %s MANIFEST " %
+                      (" (a, b)" if fileFormat == 'csv' else "", summary['manifest'],
+                       "FORMAT AS PARQUET" if fileFormat == 'parquet' else "FORMAT AS CSV GZIP IGNOREHEADER 1 EMPTYASNULL")]
+    assert conn.statements[-1] == 'COMMIT'
+
+    manifestKey = summary['manifest'].split('/', 3)[3]
+    manifest    = json.loads(s3.get_object(Bucket='pyhelper-test', Key=manifestKey)['Body'].read())
+    entries     = manifest['entries']
+    assert len(entries) == 4
+    assert sorted(e['url'].split('/', 3)[3] for e in entries) == sorted(k for k in stagedKeys(s3) if k != manifestKey)
+    assert sum(e['meta']['content_length'] for e in entries) == summary['bytes']
+
+def test_bulk_load_upsert_and_cleanup(rs, conn, s3):
+    tbl = pa.table({'a': [1, 2, 3], 'b': ['x', 'y', 'z']})
+    rs.bulkLoad(tbl, 's.t', 's3://pyhelper-test/stage', 'arn:r', mode='upsert', keyCols=['a'], shards=1)
+    verbs = [s.split()[0] for s in conn.statements]
+    assert verbs == ['CREATE', 'COPY', 'DELETE', 'INSERT', 'DROP', 'COMMIT']
+    stage = conn.statements[0].split()[3]
+    assert conn.statements[2] == "DELETE FROM s.t USING %s WHERE s.t.a = %s.a" % (stage, stage)
+    assert stagedKeys(s3) == []
+
+def test_bulk_load_failed_copy_cleans_up(rs, conn, s3):
+    def failCopy(sql, rowIds, execute=conn.execute):
+        if sql.startswith('COPY'):
+            raise psycopg2.InternalError("S3ServiceException")
+        execute(sql, rowIds)
+    conn.execute = failCopy
+    with pytest.raises(psycopg2.InternalError):
+        rs.bulkLoad(pa.table({'a': [1]}), 's.t', 's3://pyhelper-test/stage', 'arn:r', shards=1)
+    assert conn.statements[-1] == 'ROLLBACK'
+    assert stagedKeys(s3) == []
+
+SLICES_SQL = "select count(*) from stv_slices"
+
+def test_bulk_load_shards_per_slice_without_pooling(rs, conn, s3):
+    conn.results[SLICES_SQL] = (4,)
+    summary = rs.bulkLoad(pa.table({'a': list(range(10))}), 's.t', 's3://pyhelper-test/stage', 'arn:r')
+    assert summary['shards'] == 4
+    assert conn.statements[:2] == [SLICES_SQL, 'COMMIT']
+
+def test_slice_count_falls_back_to_1_and_rolls_back(rs, conn, s3):
+    conn.results[SLICES_SQL] = psycopg2.ProgrammingError     #No stv_slices: a plain Postgres
+    summary = rs.bulkLoad(pa.table({'a': list(range(10))}), 's.t', 's3://pyhelper-test/stage', 'arn:r')
+    assert summary['shards'] == 1
+    assert conn.statements[:3] == [SLICES_SQL, 'ROLLBACK', conn.statements[2]]
+    assert conn.statements[2].startswith('COPY')
+    assert rs.sliceCount() == 1 and conn.statements.count(SLICES_SQL) == 1
+
+def test_slice_count_does_not_cache_connection_errors(rs, conn):
+    conn.results[SLICES_SQL] = psycopg2.OperationalError
+    with pytest.raises(psycopg2.OperationalError):
+        rs.sliceCount()
+    conn.results[SLICES_SQL] = (2,)
+    assert rs.sliceCount() == 2
+
+def unloadTo(conn, s3, tables):
+    ''' Make the UNLOAD statements write the arrow tables as parquet files under their TO prefix '''
+    pq = pytest.importorskip('pyarrow.parquet')
+    def unload(sql, rowIds, execute=conn.execute):
+        execute(sql, rowIds)
+        if sql.startswith('UNLOAD'):
+            prefix = unloadPrefix(sql).split('/', 3)[3]
+            for i, tbl in enumerate(tables):
+                buf = pa.BufferOutputStream()
+                pq.write_table(tbl, buf)
+                s3.put_object(Bucket='pyhelper-test', Key="%s%04d_part_00.parquet" % (prefix, i),
+                              Body=buf.getvalue().to_pybytes())
+    conn.execute = unload
+
+def unloadPrefix(sql):
+    return sql.split(" TO '", 1)[1].split("'", 1)[0]
+
+UNLOADED = [pa.table({'a': [1, 2], 'b': ['x', 'y']}), pa.table({'a': [3], 'b': ['z']}),
+            pa.table({'a': [4, 5], 'b': ['u', None]})]
+
+def test_unload_reads_the_files_into_one_table(rs, conn, s3):
+    unloadTo(conn, s3, UNLOADED)
+    tbl = rs.unload("SELECT a, b FROM t WHERE b <> 'q'", 's3://pyhelper-test/out', 'arn:r', maxWorkers=2,
+                    unloadOptions="MAXFILESIZE 256 MB")
+    assert tbl.to_pydict() == pa.concat_tables(UNLOADED).to_pydict()
+    (unload,) = [s for s in conn.statements if s.startswith('UNLOAD')]
+    prefix    = unloadPrefix(unload)
+    assert prefix.startswith('s3://pyhelper-test/out/pyhelper-unload-') and prefix.endswith('/')
+    assert unload == ("UNLOAD ('SELECT a, b FROM t WHERE b <> ''q''') TO '%s' IAM_ROLE 'arn:r' "
+                      "FORMAT PARQUET PARALLEL ON MAXFILESIZE 256 MB" % (prefix))
+    assert stagedKeys(s3) == []
+
+def test_unload_without_cleanup_keeps_the_files(rs, conn, s3):
+    unloadTo(conn, s3, UNLOADED)
+    rs.unload("SELECT a, b FROM t", 's3://pyhelper-test/out', 'arn:r', cleanup=False)
+    assert len(stagedKeys(s3)) == 3
+
+def test_empty_unload_keeps_the_schema(rs, conn, s3):
+    unloadTo(conn, s3, [])
+    conn.descriptions["SELECT * FROM (SELECT a, n FROM t) pyhelper_empty LIMIT 0"] = \
+        [('a', 23, None, 4, None, None, None), ('n', 1700, None, None, 10, 2, None)]
+    tbl = rs.unload("SELECT a, n FROM t;", 's3://pyhelper-test/out', 'arn:r')
+    assert tbl.num_rows == 0
+    assert tbl.schema == pa.schema([('a', pa.int32()), ('n', pa.decimal128(10, 2))])
+
+def test_unload_iterator_cleans_up_once_exhausted(rs, conn, s3):
+    unloadTo(conn, s3, UNLOADED)
+    batches = rs.unload("SELECT a, b FROM t", 's3://pyhelper-test/out', 'arn:r', asIterator=True, maxWorkers=1)
+    assert len(stagedKeys(s3)) == 3                     #Nothing is read before the first batch is asked for
+    assert sum(b.num_rows for b in batches) == 5
+    assert stagedKeys(s3) == []
+
+@pytest.mark.parametrize('consumed', [0, 1])
+def test_unload_iterator_cleans_up_when_dropped(rs, conn, s3, consumed):
+    unloadTo(conn, s3, UNLOADED)
+    batches = rs.unload("SELECT a, b FROM t", 's3://pyhelper-test/out', 'arn:r', asIterator=True)
+    for _ in range(consumed):
+        next(batches)
+    del batches                                         #Never started (finalizer) / suspended (generator close)
+    gc.collect()
+    assert stagedKeys(s3) == []
+
+PG_DSN = os.environ.get('PYHELPER_TEST_PG_DSN')
+pgOnly = pytest.mark.skipif(not PG_DSN, reason="set PYHELPER_TEST_PG_DSN to run against a Postgres")
+
+@pytest.fixture
+def pg(monkeypatch):
+    ''' (pooled Redshift on the Postgres of PYHELPER_TEST_PG_DSN, name of a scratch table dropped at the end) '''
+    pgConnect = psycopg2.connect
+    monkeypatch.setattr(redshiftModule.psycopg2, 'connect', lambda **kwargs: pgConnect(PG_DSN))
+    rs    = Redshift(StubSession(), 'us-east-1', 'pg', 'db', 'user', pooled=True, maxConn=2)
+    table = "pyhelper_t_%s" % (uuid.uuid4().hex[:8])
+    rs.runSQL("CREATE TABLE %s (a int PRIMARY KEY, b text NOT NULL)" % (table))
+    try:
+        yield rs, table
+    finally:
+        rs.runSQL("DROP TABLE IF EXISTS %s" % (table))
+        rs.close()
+
+@pgOnly
+@pytest.mark.parametrize('useSavepoints, committed', [(False, 10), (True, 0)])
+def test_postgres_failed_row_inside_a_batch(pg, useSavepoints, committed):
+    rs, table = pg
+    rows = ROWS[:15] + [(15, None)] + ROWS[16:]
+    with pytest.raises(psycopg2.IntegrityError):
+        rs.executeMany("INSERT INTO %s (a, b) VALUES %%s" % (table), rows, pageSize=4, batchSize=10,
+                       useSavepoints=useSavepoints)
+    assert rs.runSQL("SELECT count(*) FROM %s" % (table))[0][0] == committed
+
+@pgOnly
+def test_postgres_stream_sql(pg):
+    rs, table = pg
+    rs.executeMany("INSERT INTO %s (a, b) VALUES %%s" % (table), ROWS)
+    sql = "SELECT a, b, a::numeric(10,2) AS n, TIMESTAMPTZ '2024-01-02 03:04:05.123456+00' AS ts, " \
+          "(SELECT string_agg(name, ',') FROM pg_cursors) AS cursors FROM %s ORDER BY a" % (table)
+
+    batches = list(rs.streamSQL(sql, itersize=4, batchSize=10))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert [r[:2] for b in batches for r in b] == ROWS
+    assert batches[0][0][4].startswith('pyhelper_')      #Run on a named (server side) cursor
+
+    batches = list(rs.streamSQL(sql, itersize=4, batchSize=10, asArrow=True))
+    assert [b.num_rows for b in batches] == [10, 10, 5]
+    assert all(b.schema == batches[0].schema for b in batches)
+    assert batches[0].schema.types[:4] == [pa.int32(), pa.string(), pa.decimal128(10, 2), pa.timestamp('us', tz='UTC')]
+    assert batches[0].column(3)[0].as_py().microsecond == 123456
+
+    stream = rs.streamSQL(sql, itersize=2, batchSize=2)
+    assert len(next(stream)) == 2
+    stream.close()                                      #Early close: the cursor is closed, the connection returned
+    assert rs.runSQL("SELECT count(*) FROM pg_cursors")[0][0] == 0
+    assert rs.runSQL("SELECT count(*) FROM %s" % (table))[0][0] == 25
@@ -0,0 +1,116 @@
+import gc, sys, logging
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto  = pytest.importorskip('moto')
+
+import pyHelper.awsUtils.s3 as s3Module
+from pyHelper.awsUtils.s3 import S3
+
+BKT = 'pyhelper-test'
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setattr(s3Module.time, 'sleep', lambda secs: None)
+    with moto.mock_aws():
+        boto = boto3.Session(region_name='us-east-1')
+        boto.client('s3').create_bucket(Bucket=BKT)
+        yield S3(logging.getLogger(__name__), boto)
+
+def putKeys(s3, prefix, n):
+    client = s3._S3__s3
+    for i in range(n):
+        client.put_object(Bucket=BKT, Key="%s/%04d" % (prefix, i), Body=b'x')
+
+def remainingKeys(s3):
+    return sorted(s3.listKeys(BKT, ''))
+
+def failDeletes(s3, monkeypatch, codeFor):
+    '''
+    Make delete_objects report the keys for which codeFor(key, call) returns an error code in `Errors`
+    (as S3 does for a partial failure) and really delete the others.
+    '''
+    client = s3._S3__s3
+    real   = client.delete_objects
+    calls  = []
+
+    def deleteObjects(Bucket, Delete):
+        calls.append([o['Key'] for o in Delete['Objects']])
+        errors, ok = [], []
+        for o in Delete['Objects']:
+            code = codeFor(o['Key'], len(calls))
+            if code:
+                errors.append({'Key': o['Key'], 'Code': code, 'Message': code})
+            else:
+                ok.append(o)
+        if ok:
+            real(Bucket=Bucket, Delete=dict(Delete, Objects=ok))
+        return {'Errors': errors} if errors else {}
+
+    monkeypatch.setattr(client, 'delete_objects', deleteObjects)
+    return calls
+
+def test_bulk_delete_batches_of_1000(s3, monkeypatch):
+    putKeys(s3, 'p/x', 2500)
+    putKeys(s3, 'p/y', 1)
+    calls   = failDeletes(s3, monkeypatch, lambda key, call: None)
+    summary = s3.deleteObject("s3://%s/p/x" % BKT, recursive=True, bulk=True)
+    assert summary == {'deleted': 2500, 'failed': 0, 'retried': 0, 'errors': []}
+    assert sorted(len(c) for c in calls) == [500, 1000, 1000]
+    assert remainingKeys(s3) == ['p/y/0000']
+
+def test_bulk_delete_reports_per_key_errors(s3, monkeypatch):
+    putKeys(s3, 'p', 10)
+    denied  = {'p/0003', 'p/0007'}
+    failDeletes(s3, monkeypatch, lambda key, call: 'AccessDenied' if key in denied else None)
+    summary = s3.deleteObject("s3://%s/p" % BKT, recursive=True, bulk=True)
+    assert summary['deleted'] == 8
+    assert summary['failed']  == 2
+    assert summary['retried'] == 0
+    assert sorted(e['Key'] for e in summary['errors']) == sorted(denied)
+    assert remainingKeys(s3) == sorted(denied)
+
+def test_bulk_delete_retries_only_the_throttled_keys(s3, monkeypatch):
+    putKeys(s3, 'p', 10)
+    calls   = failDeletes(s3, monkeypatch, lambda key, call: 'SlowDown' if key == 'p/0005' and call < 3 else None)
+    summary = s3.deleteObject("s3://%s/p" % BKT, recursive=True, bulk=True)
+    assert summary == {'deleted': 10, 'failed': 0, 'retried': 2, 'errors': []}
+    assert calls[1:] == [['p/0005'], ['p/0005']]
+    assert remainingKeys(s3) == []
+
+def test_bulk_delete_gives_up_after_max_retries(s3, monkeypatch):
+    putKeys(s3, 'p', 3)
+    calls   = failDeletes(s3, monkeypatch, lambda key, call: 'SlowDown' if key == 'p/0001' else None)
+    summary = s3.deleteObject("s3://%s/p" % BKT, recursive=True, bulk=True, maxReTry=2)
+    assert summary['deleted'] == 2
+    assert summary['failed']  == 1
+    assert summary['retried'] == 2
+    assert [e['Code'] for e in summary['errors']] == ['SlowDown']
+    assert len(calls) == 3
+    assert remainingKeys(s3) == ['p/0001']
+
+def streamBatches(n, failAfter=None):
+    pa = pytest.importorskip('pyarrow')
+    for i in range(n):
+        if i == failAfter:
+            raise RuntimeError("source failed")
+        yield pa.record_batch({'a': list(range(i * 100, (i + 1) * 100))})
+
+def test_parquet_stream_rolls_over_and_writes_success(s3):
+    pq    = pytest.importorskip('pyarrow.parquet')
+    files = s3.writeParquetStream(streamBatches(3), BKT, 'out', 'tbl', targetFileSize=1)
+    assert len(files) == 3
+    assert remainingKeys(s3) == sorted([f.split('/', 3)[3] for f in files] + ['out/tbl/_SUCCESS'])
+    assert sum(s3.readParquet(f).num_rows for f in files) == 300
+
+@pytest.mark.parametrize('targetFileSize', [1, 1 << 30])     #Failing with completed files / with a file open
+def test_failed_parquet_stream_leaves_nothing(s3, monkeypatch, targetFileSize):
+    pytest.importorskip('pyarrow')
+    unraisable = []
+    monkeypatch.setattr(sys, 'unraisablehook', unraisable.append)
+    with pytest.raises(RuntimeError, match='source failed'):
+        s3.writeParquetStream(streamBatches(5, failAfter=2), BKT, 'out', 'tbl', targetFileSize=targetFileSize)
+    gc.collect()
+    assert unraisable == []
+    assert remainingKeys(s3) == []
+    assert s3._S3__s3.list_multipart_uploads(Bucket=BKT).get('Uploads', []) == []
@@ -0,0 +1,279 @@
+import json, logging
+import pytest
+
+from pyHelper.pySparkUtils.SparkUtils import SparkUtils
+
+@pytest.mark.parametrize('curParts, sizeBytes, requested, partitionCols, action, partitions', [
+    (8, None, 2,  None,  'coalesce',          2),
+    (2, None, 8,  None,  'repartition',       8),
+    (4, None, 4,  None,  'none',              4),
+    (4, 3000, -1, None,  'repartition',       10),   #3000 bytes / 300 per partition
+    (4, 1000, -1, None,  'none',              4),
+    (4, None, -1, None,  'repartition',       16),   #No size estimate: the default partitions
+    (4, None, 4,  ['k'], 'repartitionByCols', 4),
+    (None, None, 2, None, 'repartition',      2),    #Current partitions unknown until run (AQE)
+])
+def test_plan_partitions(curParts, sizeBytes, requested, partitionCols, action, partitions):
+    plan = SparkUtils.planPartitions(curParts=curParts, sizeBytes=sizeBytes, requested=requested,
+                                     targetBytes=300, dfltParts=16, partitionCols=partitionCols)
+    assert (plan['action'], plan['partitions']) == (action, partitions)
+
+def test_repartition_df(sparkUtils, spark):
+    utils = sparkUtils()
+    df    = spark.range(0, 1000, numPartitions=8)
+    assert SparkUtils.partitionStats(df)[0] == 8
+    assert utils.repartitionDF(df, 0) is df
+    assert utils.repartitionDF(df, 2).rdd.getNumPartitions()  == 2
+    assert utils.repartitionDF(df, 12).rdd.getNumPartitions() == 12
+    assert utils.repartitionDF(df, 5, partitionCols=['id']).rdd.getNumPartitions() == 5
+
+def test_repartition_df_sized_from_the_plan(sparkUtils, spark, tmp_path):
+    utils = sparkUtils()
+    spark.range(0, 200000, numPartitions=4).write.parquet("file://%s/sized" % (tmp_path))
+    df    = spark.read.parquet("file://%s/sized" % (tmp_path))
+    parts, sizeBytes = SparkUtils.partitionStats(df)
+    assert sizeBytes and sizeBytes > 0
+    target = max(1, sizeBytes // 3)
+    assert utils.repartitionDF(df, -1, targetBytes=target).rdd.getNumPartitions() == -(-sizeBytes // target)
+
+def test_plan_num_partitions_matches_the_rdd(sparkUtils, spark, tmp_path):
+    sparkUtils()
+    spark.range(0, 1000, numPartitions=5).write.parquet("file://%s/np" % (tmp_path))
+    src = spark.read.parquet("file://%s/np" % (tmp_path))
+    for df in [src, src.where("id > 3").select("id"), src.union(spark.range(0, 10, numPartitions=3)),
+               src.coalesce(1), spark.range(0, 10, numPartitions=6)]:
+        assert SparkUtils.partitionStats(df)[0] == df.rdd.getNumPartitions()
+    assert SparkUtils.partitionStats(src.groupBy("id").count())[0] is None
+
+def test_partition_planning_runs_no_job(sparkUtils, spark, tmp_path):
+    utils = sparkUtils()
+    assert spark.conf.get('spark.sql.adaptive.enabled') == 'true'
+    spark.range(0, 1000, numPartitions=4).write.parquet("file://%s/nojob" % (tmp_path))
+    src    = spark.read.parquet("file://%s/nojob" % (tmp_path))
+    aggDF  = src.groupBy((src.id % 10).alias("k")).count()
+    joinDF = src.join(aggDF.withColumnRenamed("k", "id"), "id")
+    sc     = spark.sparkContext
+    sc.setJobGroup("pyhelper-plan-only", "partition planning")
+    try:
+        for df in (aggDF, joinDF, src):
+            SparkUtils.partitionStats(df)
+            utils.repartitionDF(df, 4)
+            utils.repartitionDF(df, -1)
+        assert list(sc.statusTracker().getJobIdsForGroup("pyhelper-plan-only")) == []
+        assert utils.repartitionDF(aggDF, 4).rdd.getNumPartitions() == 4
+    finally:
+        sc.setLocalProperty("spark.jobGroup.id", None)
+
+def sampleDF(spark):
+    return spark.createDataFrame([(i, "k%d" % (i % 3), float(i)) for i in range(30)], "id int, part string, v double")
+
+@pytest.mark.parametrize('fileFormat', ['parquet', 'orc', 'csv'])
+def test_persist_external_round_trip(sparkUtils, spark, tmp_path, fileFormat):
+    utils = sparkUtils()
+    df    = sampleDF(spark)
+    rdf   = utils.persistExternal("file://%s/ext" % (tmp_path), "t_%s" % (fileFormat), df,
+                                  partitionCols=['part'], fileFormat=fileFormat)
+    assert rdf.columns == df.columns            #partitionBy moved 'part' last, persistExternal restores the order
+    assert [f.dataType for f in rdf.schema] == [f.dataType for f in df.schema]
+    assert sorted(rdf.collect()) == sorted(df.collect())
+    assert sorted(p.name for p in (tmp_path / 'ext' / ("t_%s" % (fileFormat))).iterdir()
+                  if p.is_dir()) == ['part=k0', 'part=k1', 'part=k2']
+
+def test_store_df_hdfs_persist(sparkUtils, spark, tmp_path):
+    utils = sparkUtils()
+    sampleDF(spark).createOrReplaceTempView('persist_src')
+    df = utils.sql('persisted', "select id, part, v from persist_src distribute by part", persistType='HDFS')
+    assert all(f.startswith("file://%s/hdfs/persisted/" % (tmp_path)) for f in df.inputFiles())
+    assert spark.table('persisted').count() == 30
+
+def test_write_without_success_marker_raises(sparkUtils, spark, tmp_path):
+    utils  = sparkUtils()
+    hdpCnf = spark.sparkContext._jsc.hadoopConfiguration()
+    hdpCnf.set("mapreduce.fileoutputcommitter.marksuccessfuljobs", "false")
+    try:
+        with pytest.raises(IOError, match='did not commit'):
+            utils.write2ExtrFile(fileFormat='parquet', fullPath="file://%s/nomarker" % (tmp_path), df=sampleDF(spark))
+    finally:
+        hdpCnf.unset("mapreduce.fileoutputcommitter.marksuccessfuljobs")
+
+def test_mat_cache_fingerprint_hit_and_miss(sparkUtils, spark, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    utils = sparkUtils('-matCache')
+    src   = "file://%s/src" % (tmp_path)
+    query = "select id, id * 2 as twice from mat_src"
+    spark.range(0, 100).write.parquet(src)
+    spark.read.parquet(src).createOrReplaceTempView('mat_src')
+
+    df = spark.sql(query)
+    assert utils.fingerprint(query, df, 'hdfs') == utils.fingerprint(" select id,  id * 2 as twice\nfrom mat_src ", df, 'HDFS')
+    assert utils.fingerprint(query, df, 'HDFS') != utils.fingerprint(query, df, 'S3')
+
+    first = utils.sql('mat_a', query, persistType='HDFS')
+    assert 'Materialization cache miss' in caplog.text
+    assert all('/hdfs/_matcache/' in f for f in first.inputFiles())
+
+    caplog.clear()
+    again = utils.sql('mat_b', query, persistType='HDFS')
+    assert 'Materialization cache hit' in caplog.text
+    assert sorted(again.inputFiles()) == sorted(first.inputFiles())
+    assert sorted(again.collect()) == sorted(first.collect())
+
+    #A changed input (new files) gives a new fingerprint
+    spark.range(0, 50).write.mode('overwrite').parquet(src)
+    spark.read.parquet(src).createOrReplaceTempView('mat_src')
+    caplog.clear()
+    changed = utils.sql('mat_c', query, persistType='HDFS')
+    assert 'Materialization cache miss' in caplog.text
+    assert changed.count() == 50
+
+def test_mat_cache_skips_in_memory_inputs(sparkUtils, spark):
+    utils = sparkUtils('-matCache')
+    assert utils.fingerprint("select 1", spark.range(0, 10), 'HDFS') is None
+
+def skewedViews(spark):
+    #Half the rows on the key 0, the other keys unique
+    spark.createDataFrame([(0 if i % 2 == 0 else i, i) for i in range(20000)], "k int, v int").createOrReplaceTempView('skewed')
+    spark.createDataFrame([(k, "d%d" % (k)) for k in range(0, 20000, 3)], "k int, d string").createOrReplaceTempView('skew_dim')
+
+def test_analyze_skew_finds_the_hot_key(sparkUtils, spark):
+    utils = sparkUtils()
+    skewedViews(spark)
+    report = utils.analyzeSkew('skewed', ['k'], sampleFraction=0.2, hotShare=0.1)
+    assert report['hotKeys'] == [(0,)]
+    assert report['heavyHitters'][0]['key'] == (0,)
+    assert 0.4 < report['heavyHitters'][0]['share'] < 0.6
+
+@pytest.mark.parametrize('strategy', ['salt', 'split'])
+@pytest.mark.parametrize('how', ['inner', 'left'])
+def test_skew_join_matches_the_plain_join(sparkUtils, spark, strategy, how):
+    utils = sparkUtils()
+    skewedViews(spark)
+    cols   = ['k', 'v', 'd']
+    joined = utils.skewJoin('skewed', 'skew_dim', ['k'], how=how, strategy=strategy, hotKeys=[(0,)], saltBuckets=4)
+    plain  = spark.table('skewed').join(spark.table('skew_dim'), ['k'], how)
+    assert sorted(joined.select(*cols).collect()) == sorted(plain.select(*cols).collect())
+
+def test_skew_join_rejects_other_joins(sparkUtils, spark):
+    utils = sparkUtils()
+    skewedViews(spark)
+    with pytest.raises(ValueError, match='inner/left'):
+        utils.skewJoin('skewed', 'skew_dim', ['k'], how='right', hotKeys=[(0,)])
+
+def test_enable_adaptive_skew_join(sparkUtils, spark):
+    utils = sparkUtils()
+    conf  = utils.enableAdaptiveSkewJoin(skewFactor=3, thresholdBytes=1024, force=True)
+    try:
+        assert spark.conf.get('spark.sql.adaptive.skewJoin.enabled') == 'true'
+        assert spark.conf.get('spark.sql.adaptive.skewJoin.skewedPartitionFactor') == '3'
+        assert spark.conf.get('spark.sql.adaptive.skewJoin.skewedPartitionThresholdInBytes') == '1024'
+        assert conf['spark.sql.adaptive.forceOptimizeSkewedJoin'] == 'true'
+    finally:
+        for k in conf:
+            spark.conf.unset(k)
+
+def test_resolve_spark_conf_merge_order():
+    from pyHelper.pySparkUtils.SparkUtils import BASE_SPARK_CONF, SPARK_PROFILES
+    assert SparkUtils.resolveSparkConf() == BASE_SPARK_CONF
+    conf = SparkUtils.resolveSparkConf("small-interactive, wide-shuffle")
+    assert conf['spark.sql.shuffle.partitions'] == SPARK_PROFILES['wide-shuffle']['spark.sql.shuffle.partitions']
+    assert conf['spark.rdd.compress'] == BASE_SPARK_CONF['spark.rdd.compress']
+    conf = SparkUtils.resolveSparkConf("wide-shuffle", {'spark.sql.shuffle.partitions': 64, ' spark.x ': ' y '})
+    assert (conf['spark.sql.shuffle.partitions'], conf['spark.x']) == ('64', 'y')
+
+def test_resolve_spark_conf_string_overrides_keep_commas_in_values():
+    conf = SparkUtils.resolveSparkConf("default", "spark.driver.extraJavaOptions=-Da=1,-Db=2, spark.sql.shuffle.partitions=8,"
+                                                  "spark.jars=a.jar,b.jar")
+    assert conf['spark.driver.extraJavaOptions'] == '-Da=1,-Db=2'
+    assert conf['spark.sql.shuffle.partitions']  == '8'
+    assert conf['spark.jars']                    == 'a.jar,b.jar'
+
+def test_resolve_spark_conf_unknown_profile():
+    with pytest.raises(ValueError, match="Unknown spark profile 'nope'"):
+        SparkUtils.resolveSparkConf("default,nope")
+
+def test_profile_override_applied_to_the_session(sparkUtils, spark):
+    sparkUtils(sparkConf="spark.sql.shuffle.partitions=64", **{'--sparkProfile': 'wide-shuffle'})
+    assert spark.conf.get('spark.sql.shuffle.partitions') == '64'
+    assert spark.conf.get('spark.sql.adaptive.skewJoin.enabled') == 'true'
+
+def test_mat_cache_misses_on_a_redefined_upstream_view(sparkUtils, spark, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    utils = sparkUtils('-matCache')
+    spark.range(0, 100).write.parquet("file://%s/up_src" % (tmp_path))
+    spark.read.parquet("file://%s/up_src" % (tmp_path)).createOrReplaceTempView('up_src')
+
+    spark.sql("select id from up_src where id < 10").createOrReplaceTempView('up')
+    assert utils.sql('down', "select count(*) c from up", persistType='HDFS').collect()[0].c == 10
+
+    spark.sql("select id from up_src where id < 50").createOrReplaceTempView('up')
+    caplog.clear()
+    assert utils.sql('down', "select count(*) c from up", persistType='HDFS').collect()[0].c == 50
+    assert 'Materialization cache miss' in caplog.text
+
+def matCacheEntries(tmp_path):
+    return sorted(p.name for p in (tmp_path / 'hdfs' / '_matcache').iterdir() if p.is_dir())
+
+def test_mat_cache_expired_entry_is_a_miss(sparkUtils, spark, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    spark.range(0, 20).write.parquet("file://%s/age_src" % (tmp_path))
+    spark.read.parquet("file://%s/age_src" % (tmp_path)).createOrReplaceTempView('age_src')
+    sparkUtils('-matCache').sql('aged', "select id from age_src", persistType='HDFS')
+
+    caplog.clear()
+    rerun = sparkUtils('-matCache', **{'--matCacheMaxAgeHrs': '0'})
+    assert rerun.sql('aged', "select id from age_src", persistType='HDFS').count() == 20
+    assert 'expired' in caplog.text and 'Materialization cache miss' in caplog.text
+
+def test_mat_cache_eviction_keeps_the_entries_of_the_run(sparkUtils, spark, tmp_path):
+    spark.range(0, 20).write.parquet("file://%s/evict_src" % (tmp_path))
+    spark.read.parquet("file://%s/evict_src" % (tmp_path)).createOrReplaceTempView('evict_src')
+    utils = sparkUtils('-matCache')
+    df    = utils.sql('kept', "select id from evict_src", persistType='HDFS')
+    entry = matCacheEntries(tmp_path)
+    assert len(entry) == 1
+
+    utils.evictMatCache(maxAgeSecs=0, maxBytes=0)
+    assert matCacheEntries(tmp_path) == entry and df.count() == 20
+
+    #A hit records its use in the meta, the next run evicts by that time
+    hit  = sparkUtils('-matCache')
+    hit.sql('kept', "select id from evict_src", persistType='HDFS')
+    meta = json.loads((tmp_path / 'hdfs' / '_matcache' / entry[0] / '_pyhelper_meta.json').read_text())
+    assert meta['usedAt'] > meta['created']
+
+    sparkUtils('-matCache').evictMatCache(maxAgeSecs=0, maxBytes=0)
+    assert matCacheEntries(tmp_path) == []
+
+def test_metrics_report(sparkUtils, spark, tmp_path):
+    from pyHelper.pySparkUtils.SparkMetrics import REPORT_COLUMNS
+    utils = sparkUtils('-collectMetrics')
+    sampleDF(spark).createOrReplaceTempView('metrics_src')
+    utils.sql('m_persisted', "select part, count(*) c from metrics_src group by part", persistType='HDFS')
+    utils.sql('m_lazy', "select * from metrics_src")
+
+    rows = {r['step']: r for r in json.loads(utils.writeMetricsReport(str(tmp_path / 'metrics.json')))}
+    persisted, lazy = rows['m_persisted'], rows['m_lazy']
+    assert persisted['executed'] is True and persisted['jobIds']
+    assert persisted['filesWritten'] > 0
+    assert persisted['shuffleWriteBytes'] > 0 and persisted['outputRecords'] == 3
+    assert persisted['wallSecs'] > 0 and persisted['planSecs'] is None
+    assert persisted['attrs']['persistType'] == 'HDFS'
+    assert lazy['executed'] is False and lazy['jobIds'] == []     #Runs in the step using the DF
+    assert lazy['wallSecs'] is None and lazy['planSecs'] is not None
+    assert json.loads((tmp_path / 'metrics.json').read_text()) == list(rows.values())
+
+    csvReport = utils.writeMetricsReport(str(tmp_path / 'metrics.csv'))
+    assert csvReport.splitlines()[0].split(',') == REPORT_COLUMNS
+    assert len(csvReport.splitlines()) == 3
+
+def test_compare_task_durations(sparkUtils, spark):
+    utils = sparkUtils()
+    spark.createDataFrame([(0 if i % 2 == 0 else i, i) for i in range(5000)], "k int, v int").createOrReplaceTempView('cmp_src')
+    report = utils.compareTaskDurations({'plain' : spark.sql("select k, count(*) c from cmp_src group by k"),
+                                         'salted': spark.sql("select k, sum(c) c from (select k, count(*) c from cmp_src"
+                                                             " group by k, v % 4) group by k")})
+    assert sorted(report) == ['plain', 'salted']
+    for name, variant in report.items():
+        assert variant['wallSecs'] > 0
+        assert variant['stages'] and all(s['numTasks'] > 0 for s in variant['stages'])
+        assert variant['maxTaskMs'] is not None and variant['maxSkewRatio'] is not None
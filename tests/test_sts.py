@@ -0,0 +1,109 @@
+import threading, datetime
+import pytest
+
+from pyHelper.awsUtils.sts import CredentialCache
+
+KEY = ('arn:aws:iam::1:role/r', 'us-east-1', 'saml')
+
+def utcIn(secs):
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=secs)
+
+class FakeCredentials:
+    '''
+    Stand-in for botocore's RefreshableCredentials: get_frozen_credentials "refreshes" to a new expiry,
+    or raises (result is an exception) / keeps the expiry (result is None, a failed advisory refresh).
+    '''
+    def __init__(self, expiresIn):
+        self._expiry_time = utcIn(expiresIn)
+        self.result       = 3600
+        self.calls        = 0
+
+    def get_frozen_credentials(self):
+        self.calls += 1
+        if isinstance(self.result, Exception):
+            raise self.result
+        if self.result is not None:
+            self._expiry_time = utcIn(self.result)
+        return ('key', 'secret', 'token')
+
+class FakeTimer:
+    ''' Records the scheduled refreshes, run by the tests with fire() '''
+    scheduled = []
+
+    def __init__(self, delay, fn, args):
+        self.delay, self.fn, self.args, self.daemon = delay, fn, args, False
+
+    def start(self):
+        FakeTimer.scheduled.append(self)
+
+    @staticmethod
+    def fire():
+        timer = FakeTimer.scheduled.pop(0)
+        timer.fn(*timer.args)
+        return timer
+
+@pytest.fixture
+def cache(monkeypatch):
+    FakeTimer.scheduled = []
+    monkeypatch.setattr(threading, 'Timer', FakeTimer)
+    return CredentialCache()
+
+def test_refresh_scheduled_before_the_advisory_window(cache):
+    creds = FakeCredentials(3600)
+    cache.put(KEY, creds)
+    assert cache.get(KEY) is creds
+    (timer,) = FakeTimer.scheduled
+    assert timer.daemon
+    assert 3600 - CredentialCache.ADVISORY_REFRESH_SECS - 5 < timer.delay <= 3600 - CredentialCache.ADVISORY_REFRESH_SECS + 5
+
+    creds.result = 7200
+    FakeTimer.fire()
+    assert creds.calls == 1
+    (timer,) = FakeTimer.scheduled
+    assert timer.delay > 7200 - CredentialCache.ADVISORY_REFRESH_SECS - 5
+
+def test_no_timer_without_background_refresh(cache):
+    cache.put(KEY, FakeCredentials(3600), backgroundRefresh=False)
+    assert FakeTimer.scheduled == []
+
+@pytest.mark.parametrize('result', [RuntimeError("sts down"), None])
+def test_failed_refresh_backs_off_exponentially(cache, result):
+    creds = FakeCredentials(600)        #In the advisory window: botocore only logs a failed refresh (None)
+    creds.result = result
+    cache.put(KEY, creds)
+    assert FakeTimer.scheduled[0].delay == 1
+    delays = []
+    for _ in range(7):
+        FakeTimer.fire()
+        delays.append(FakeTimer.scheduled[0].delay)
+    assert delays == [30, 60, 120, 240, 480, 600, 600]
+    assert cache.get(KEY) is creds
+
+    creds.result = 3600                 #STS is back
+    FakeTimer.fire()
+    assert FakeTimer.scheduled[0].delay > 3600 - CredentialCache.ADVISORY_REFRESH_SECS - 5
+
+def test_expired_credentials_are_dropped_when_the_refresh_fails(cache):
+    creds = FakeCredentials(-10)
+    creds.result = RuntimeError("sts down")
+    cache.put(KEY, creds)
+    FakeTimer.fire()
+    assert creds.calls == 1
+    assert cache.get(KEY) is None
+    assert FakeTimer.scheduled == []
+
+def test_invalidated_entries_are_not_refreshed(cache):
+    creds = FakeCredentials(3600)
+    cache.put(KEY, creds)
+    cache.invalidate(KEY)
+    FakeTimer.fire()
+    assert creds.calls == 0 and FakeTimer.scheduled == []
+
+    replaced = FakeCredentials(3600)
+    cache.put(KEY, creds)
+    cache.put(KEY, replaced)
+    FakeTimer.fire()                    #The timer of the replaced credentials
+    assert creds.calls == 0 and cache.get(KEY) is replaced
+
+    cache.invalidate()
+    assert cache.get(KEY) is None